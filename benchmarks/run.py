@@ -0,0 +1,152 @@
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic_feed import FEED_SIZES, generate_feed, generate_regions
+from feed.cache import cache_dir_for, compile_feed, read_gtfs
+from transfers.precompute import build_router, precompute_routes, time_intervals
+from transfers.raptor import departing_between
+from transfers.route_store import RouteStore, build_route_store
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(base_dir, 'results')
+
+# Origins timed for the single queries, picked from the filtered stops
+QUERY_ORIGINS = 20
+
+# Limits of the precompute and the queries, the ones precompute.py runs with
+TIME_LIMIT = pd.Timedelta(hours=8)
+MAX_TRANSFERS = 3
+
+
+def timed(function, repeat=1):
+    """Wall times in seconds of repeat calls of function, and its last result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return {'runs': repeat, 'min': min(times), 'median': statistics.median(times), 'max': max(times)}, result
+
+
+def bench_feed_loading(gtfs_dir, work_dir):
+    shutil.rmtree(cache_dir_for(gtfs_dir), ignore_errors=True)
+    compile_stats, _ = timed(lambda: compile_feed(gtfs_dir))
+    load_stats, _ = timed(lambda: read_gtfs('stop_times', gtfs_dir, categorical=True), repeat=5)
+    return {'compile_feed': compile_stats, 'read_stop_times': load_stats}
+
+
+def bench_queries(gtfs_dir, work_dir):
+    router_stats, raptor = timed(lambda: build_router(gtfs_dir))
+    stops_df = read_gtfs('cleaned_filtered_stops', gtfs_dir)
+    origins = stops_df['stop_id'].iloc[:QUERY_ORIGINS].tolist()
+
+    # What find_reachable_destinations does for a city: the day's profiles, then one interval
+    def query(origin):
+        profiles = raptor.reachable_profiles([origin], MAX_TRANSFERS, (0, 24 * 3600), TIME_LIMIT)
+        start, end = time_intervals['morning']
+        return departing_between(profiles, pd.Timedelta(seconds=start), pd.Timedelta(seconds=end))
+
+    times = [timed(lambda: query(origin))[0]['median'] for origin in origins]
+    return {'build_router': router_stats,
+            'reachable_destinations': {'runs': len(times), 'min': min(times), 'median': statistics.median(times),
+                                       'max': max(times)}}
+
+
+def bench_precompute(gtfs_dir, work_dir):
+    routes_path = os.path.join(work_dir, 'precomputed_routes.csv')
+    precompute_stats, _ = timed(lambda: precompute_routes(TIME_LIMIT, MAX_TRANSFERS, gtfs_dir=gtfs_dir,
+                                                          output_path=routes_path, processes=1))
+    store_path = os.path.join(work_dir, 'precomputed_routes.sqlite')
+    store_stats, _ = timed(lambda: build_route_store(pd.read_csv(routes_path), store_path))
+
+    # The route store lookup behind get_reachable_stops on the destinations page
+    store = RouteStore(store_path)
+    cities = store.origins.iloc[:QUERY_ORIGINS].tolist()
+    times = [timed(lambda: store.lookup(city, 5, 1, 'all_day'), repeat=3)[0]['median'] for city in cities]
+    with open(routes_path) as f:
+        precomputed_rows = sum(1 for _ in f) - 1
+    return {'precompute_routes': precompute_stats, 'build_route_store': store_stats,
+            'route_store_lookup': {'runs': len(times), 'min': min(times), 'median': statistics.median(times),
+                                   'max': max(times)},
+            'precomputed_rows': precomputed_rows}
+
+
+def bench_heatmap(gtfs_dir, work_dir):
+    # The heatmap reads its paths from module settings, point them at the synthetic feed
+    from heatmap import heatmap, regions
+    stops_df = read_gtfs('stops', gtfs_dir)
+    regions_path = generate_regions(os.path.join(work_dir, 'regions', 'regions.shp'), stops_df)
+    settings = heatmap.gtfs_dir, heatmap.regions_path, regions.CACHE_DIR
+    heatmap.gtfs_dir, heatmap.regions_path = gtfs_dir, regions_path
+    regions.CACHE_DIR = os.path.join(work_dir, 'heatmap-cache')
+
+    def process_data():
+        heatmap.load_data.clear()
+        heatmap.process_data.clear()
+        return heatmap.process_data()
+
+    try:
+        cold_stats, _ = timed(process_data)
+        warm_stats, _ = timed(process_data, repeat=3)
+    finally:
+        heatmap.gtfs_dir, heatmap.regions_path, regions.CACHE_DIR = settings
+        heatmap.load_data.clear()
+        heatmap.process_data.clear()
+    return {'process_data_cold': cold_stats, 'process_data_cached_lookup': warm_stats}
+
+
+BENCHMARKS = {
+    'feed_loading': bench_feed_loading,
+    'queries': bench_queries,
+    'precompute': bench_precompute,
+    'heatmap': bench_heatmap,
+}
+
+
+def run_benchmarks(sizes=('small', 'medium'), benchmarks=tuple(BENCHMARKS), output_path=None, seed=0):
+    """
+    Generate a synthetic feed of every size and time the benchmarks on it. The results are
+    written as JSON to output_path (benchmarks/results/<timestamp>.json by default).
+    """
+    results = {
+        'started': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'cpus': os.cpu_count(),
+        'sizes': {},
+    }
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            gtfs_dir = os.path.join(work_dir, 'gtfs')
+            generate_stats, row_counts = timed(lambda: generate_feed(gtfs_dir, seed=seed, **FEED_SIZES[size]))
+            size_results = {'feed': {**FEED_SIZES[size], 'rows': row_counts}, 'generate_feed': generate_stats}
+            for name in benchmarks:
+                print(f"{size}: {name}")
+                size_results[name] = BENCHMARKS[name](gtfs_dir, work_dir)
+            results['sizes'][size] = size_results
+
+    if output_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output_path = os.path.join(RESULTS_DIR, f"{pd.Timestamp.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    return output_path
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.run [sizes, e.g. small,medium,large] [benchmarks, e.g. queries,heatmap]
+    sizes = sys.argv[1].split(',') if len(sys.argv) > 1 else ['small', 'medium']
+    benchmarks = sys.argv[2].split(',') if len(sys.argv) > 2 else list(BENCHMARKS)
+    output_path = run_benchmarks(sizes, benchmarks)
+    print(f"Benchmark results saved to {output_path}")
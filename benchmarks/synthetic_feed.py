@@ -0,0 +1,220 @@
+import os
+import sys
+import uuid
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# Feed window of the generated calendar, like the FlixBus feed in gtfs/
+FEED_START = pd.Timestamp('2024-06-03')
+FEED_END = pd.Timestamp('2024-12-02')
+
+# Area the cities are spread over, (min, max) latitude and longitude
+EUROPE_BOUNDS = ((36.0, 60.0), (-9.0, 30.0))
+
+BUS_SPEED = 75 / 3.6  # meters per second
+DWELL_TIME = 10 * 60
+
+# Routes run through stops picked among this many stops nearest to their first stop
+NEIGHBOUR_STOPS = 60
+
+STOP_KINDS = ['Bus Station', 'Central Station', 'Airport', 'city centre', 'North', 'South', 'FlixTrain']
+SYLLABLES = ['ka', 'ro', 'mi', 'ten', 'bur', 'la', 'sa', 'vo', 'nik', 'del', 'an', 'ber', 'go', 'lin', 'ze', 'ta']
+
+STOP_COLUMNS = ['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'stop_code', 'stop_desc', 'zone_id', 'stop_url',
+                'location_type', 'parent_station', 'wheelchair_boarding', 'stop_timezone', 'platform_code']
+
+# Sizes used by the benchmarks, 'medium' is about the size of the feed in gtfs/
+FEED_SIZES = {
+    'small': {'n_stops': 500, 'n_routes': 250, 'trips_per_route': 10},
+    'medium': {'n_stops': 2200, 'n_routes': 1100, 'trips_per_route': 30},
+    'large': {'n_stops': 8000, 'n_routes': 4400, 'trips_per_route': 30},
+}
+
+
+def _city_names(n_cities, rng):
+    names = []
+    seen = set()
+    while len(names) < n_cities:
+        name = ''.join(rng.choice(SYLLABLES, size=rng.integers(2, 4))).title()
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def _distances(lats_a, lons_a, lats_b, lons_b):
+    lats_a, lons_a, lats_b, lons_b = map(np.radians, (lats_a, lons_a, lats_b, lons_b))
+    a = np.sin((lats_b - lats_a) / 2) ** 2 + np.cos(lats_a) * np.cos(lats_b) * np.sin((lons_b - lons_a) / 2) ** 2
+    return 2 * 6_371_000 * np.arcsin(np.sqrt(a))
+
+
+def _gtfs_times(seconds):
+    seconds = np.asarray(seconds, dtype=np.int64)
+    return [f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in seconds.tolist()]
+
+
+def _gtfs_dates(dates):
+    return pd.DatetimeIndex(dates).strftime('%Y%m%d').astype(int)
+
+
+def generate_feed(output_dir, n_stops=2200, n_routes=1100, trips_per_route=30, stops_per_route=(3, 12),
+                  service_density=0.6, n_cities=None, seed=0):
+    """
+    Write a GTFS feed shaped like the one in gtfs/ to output_dir: stops grouped around
+    n_cities city centres (a third of the stops by default), bus routes through stops_per_route
+    (fewest, most) nearby stops, trips_per_route trips on each route spread over the day in both directions, and one
+    service per trip running on each weekday with probability service_density.
+
+    Also writes cleaned_filtered_stops.txt with the first stop of every third city, so the
+    precompute can run on it. The same seed always gives the same feed. Returns the number of
+    rows of every written table.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    n_cities = n_cities or max(1, n_stops // 3)
+
+    # Stops, the first n_cities of them one per city, the others around a random city
+    city_names = _city_names(n_cities, rng)
+    (lat_min, lat_max), (lon_min, lon_max) = EUROPE_BOUNDS
+    city_lats = rng.uniform(lat_min, lat_max, n_cities)
+    city_lons = rng.uniform(lon_min, lon_max, n_cities)
+    stop_cities = np.concatenate([np.arange(min(n_cities, n_stops)),
+                                  rng.integers(0, n_cities, max(0, n_stops - n_cities))])
+    stop_kinds = rng.integers(0, len(STOP_KINDS), n_stops)
+    # The first stop of a city is at its centre and named after it, the others a few kilometres around
+    spread = np.arange(n_stops) >= n_cities
+    stops_df = pd.DataFrame({
+        'stop_id': [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(n_stops)],
+        'stop_name': [f'{city_names[city]} ({STOP_KINDS[kind]})' if outer else city_names[city]
+                      for city, kind, outer in zip(stop_cities, stop_kinds, spread)],
+        'stop_lat': np.round(city_lats[stop_cities] + rng.normal(0, 0.03, n_stops) * spread, 6),
+        'stop_lon': np.round(city_lons[stop_cities] + rng.normal(0, 0.05, n_stops) * spread, 6),
+        'stop_code': [f'S{i:05d}' for i in range(n_stops)],
+        'stop_timezone': 'Europe/Berlin',
+    }).reindex(columns=STOP_COLUMNS)
+
+    # Routes from a random stop through some of its nearest stops, in order of distance
+    lats = stops_df['stop_lat'].to_numpy()
+    lons = stops_df['stop_lon'].to_numpy()
+    route_ids = [f'N{i:04d}' for i in range(n_routes)]
+    route_stops = []
+    for first in rng.integers(0, n_stops, n_routes):
+        size = min(rng.integers(stops_per_route[0], stops_per_route[1] + 1), n_stops)
+        distances = _distances(lats[first], lons[first], lats, lons)
+        nearest = np.argsort(distances)[1:NEIGHBOUR_STOPS + 1]
+        chosen = rng.choice(nearest, size=min(size - 1, len(nearest)), replace=False)
+        route_stops.append(np.concatenate([[first], chosen[np.argsort(distances[chosen])]]))
+    routes_df = pd.DataFrame({'agency_id': 'FLIXBUS-eu', 'route_id': route_ids,
+                              'route_short_name': [f'FlixBus {route_id}' for route_id in route_ids],
+                              'route_long_name': [f"{stops_df['stop_name'][stops[0]]} - {stops_df['stop_name'][stops[-1]]}"
+                                                  for stops in route_stops],
+                              'route_type': 3})
+
+    # Trips in both directions, every one with its own service like in the FlixBus feed
+    stop_ids = stops_df['stop_id'].to_numpy()
+    trip_parts, stop_time_parts = [], []
+    for route_id, stops in zip(route_ids, route_stops):
+        trips = np.arange(trips_per_route)
+        service_ids = np.array([f'{route_id}-{trip:03d}' for trip in trips], dtype=object)
+        trip_parts.append(pd.DataFrame({'route_id': route_id, 'trip_id': service_ids + '-00',
+                                        'service_id': service_ids, 'direction_id': trips % 2}))
+        starts = rng.integers(0, 24 * 3600, trips_per_route)
+        for direction, sequence in enumerate([stops, stops[::-1]]):
+            legs = _distances(lats[sequence[:-1]], lons[sequence[:-1]], lats[sequence[1:]], lons[sequence[1:]])
+            offsets = np.concatenate([[0], np.cumsum(legs / BUS_SPEED + DWELL_TIME)]).astype(np.int64)
+            trip_rows = trips[trips % 2 == direction]
+            stop_time_parts.append(pd.DataFrame({
+                'trip_id': np.repeat(service_ids[trip_rows] + '-00', len(sequence)),
+                'arrival_seconds': (starts[trip_rows, None] + offsets[None, :]).ravel(),
+                'stop_id': np.tile(stop_ids[sequence], len(trip_rows)),
+                'stop_sequence': np.tile(np.arange(1, len(sequence) + 1), len(trip_rows)),
+            }))
+    trips_df = pd.concat(trip_parts, ignore_index=True)
+    stop_times_df = pd.concat(stop_time_parts, ignore_index=True)
+    times = _gtfs_times(stop_times_df.pop('arrival_seconds'))
+    stop_times_df.insert(1, 'arrival_time', times)
+    stop_times_df.insert(2, 'departure_time', times)
+
+    # Weekday patterns over part of the feed window, some dates cancelled
+    n_services = len(trips_df)
+    window_days = (FEED_END - FEED_START).days
+    starts = FEED_START + pd.to_timedelta(rng.integers(0, window_days // 2, n_services), unit='D')
+    ends = starts + pd.to_timedelta(rng.integers(7, window_days // 2, n_services), unit='D')
+    weekdays = rng.random((n_services, 7)) < service_density
+    calendar_df = pd.DataFrame(weekdays.astype(int), columns=['monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                                                             'saturday', 'sunday'])
+    calendar_df.insert(0, 'service_id', trips_df['service_id'])
+    calendar_df['start_date'] = _gtfs_dates(starts)
+    calendar_df['end_date'] = _gtfs_dates(ends)
+    cancelled = rng.random(n_services) < 0.25
+    calendar_dates_df = pd.DataFrame({
+        'service_id': trips_df['service_id'][cancelled].to_numpy(),
+        'date': _gtfs_dates(starts[cancelled] + pd.to_timedelta(rng.integers(0, 7, cancelled.sum()), unit='D')),
+        'exception_type': 2,
+    })
+
+    # Longer minimum transfer times at some stops, and route pairs without transfers at others
+    timed = rng.choice(n_stops, size=max(1, n_stops // 20), replace=False)
+    blocked = rng.choice(n_routes, size=(max(1, n_routes // 20), 2))
+    transfers_df = pd.concat([
+        pd.DataFrame({'from_stop_id': stops_df['stop_id'].to_numpy()[timed],
+                      'to_stop_id': stops_df['stop_id'].to_numpy()[timed],
+                      'transfer_type': 2, 'min_transfer_time': 600}),
+        pd.DataFrame({'from_stop_id': [stops_df['stop_id'][route_stops[a][0]] for a, _ in blocked],
+                      'from_route_id': [route_ids[a] for a, _ in blocked],
+                      'to_stop_id': [stops_df['stop_id'][route_stops[a][0]] for a, _ in blocked],
+                      'to_route_id': [route_ids[b] for _, b in blocked],
+                      'transfer_type': 3}),
+    ]).reindex(columns=['from_stop_id', 'from_route_id', 'from_trip_id', 'to_stop_id', 'to_route_id', 'to_trip_id',
+                        'transfer_type', 'min_transfer_time'])
+    transfers_df['min_transfer_time'] = transfers_df['min_transfer_time'].astype('Int64')
+
+    tables = {
+        'agency': pd.DataFrame({'agency_id': ['FLIXBUS-eu'], 'agency_name': ['FlixBus-eu'],
+                                'agency_url': ['https://global.flixbus.com'], 'agency_timezone': ['UTC'],
+                                'agency_lang': ['en']}),
+        'feed_info': pd.DataFrame({'feed_publisher_name': ['Synthetic'], 'feed_publisher_url': ['http://example.com'],
+                                   'feed_lang': ['en'], 'feed_start_date': _gtfs_dates([FEED_START]),
+                                   'feed_end_date': _gtfs_dates([FEED_END])}),
+        'stops': stops_df,
+        'cleaned_filtered_stops': stops_df.iloc[:n_cities:3].sort_values('stop_name'),
+        'routes': routes_df,
+        'trips': trips_df,
+        'stop_times': stop_times_df,
+        'calendar': calendar_df,
+        'calendar_dates': calendar_dates_df,
+        'transfers': transfers_df,
+    }
+    for name, df in tables.items():
+        df.to_csv(os.path.join(output_dir, f'{name}.txt'), index=False)
+    return {name: len(df) for name, df in tables.items()}
+
+
+def generate_regions(path, stops_df, cells=8):
+    """Write a shapefile of cells x cells regions covering the stops, with the NUTS columns the heatmap reads."""
+    (lat_min, lat_max), (lon_min, lon_max) = EUROPE_BOUNDS
+    lat_min, lat_max = min(lat_min, stops_df['stop_lat'].min()), max(lat_max, stops_df['stop_lat'].max())
+    lon_min, lon_max = min(lon_min, stops_df['stop_lon'].min()), max(lon_max, stops_df['stop_lon'].max())
+    lat_edges = np.linspace(lat_min - 0.5, lat_max + 0.5, cells + 1)
+    lon_edges = np.linspace(lon_min - 0.5, lon_max + 0.5, cells + 1)
+    boxes = [shapely.box(lon_edges[j], lat_edges[i], lon_edges[j + 1], lat_edges[i + 1])
+             for i in range(cells) for j in range(cells)]
+    regions_gdf = gpd.GeoDataFrame({
+        'NUTS_ID': [f'XX{i:03d}' for i in range(len(boxes))],
+        'LEVL_CODE': 3,
+        'CNTR_CODE': 'XX',
+        'NAME_LATN': [f'Region {i}' for i in range(len(boxes))],
+    }, geometry=boxes, crs='EPSG:4326')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    regions_gdf.to_file(path)
+    return path
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.synthetic_feed <output dir> [size: small, medium or large]
+    size = sys.argv[2] if len(sys.argv) > 2 else 'medium'
+    row_counts = generate_feed(sys.argv[1], **FEED_SIZES[size])
+    print(f"Synthetic {size} feed saved to {sys.argv[1]}: {row_counts}")
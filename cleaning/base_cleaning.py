@@ -1,39 +1,30 @@
 import os
 
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import folium
 from folium.plugins import MarkerCluster
 
+from feed.cache import read_gtfs
+from feed.times import parse_gtfs_times, seconds_to_timedelta
+
 
 # Set base directory
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Construct file paths
-stops_path = os.path.join(base_dir, 'gtfs', 'stops.txt')
-stop_times_path = os.path.join(base_dir, 'gtfs', 'stop_times.txt')
-routes_path = os.path.join(base_dir, 'gtfs', 'routes.txt')
-trips_path = os.path.join(base_dir, 'gtfs', 'trips.txt')
-calendar_path = os.path.join(base_dir, 'gtfs', 'calendar.txt')
+gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
 
 # Load the data
-stops = pd.read_csv(stops_path)
-routes = pd.read_csv(routes_path)
-trips = pd.read_csv(trips_path)
-stop_times = pd.read_csv(stop_times_path)
-calendar = pd.read_csv(calendar_path)
-
-# Function to normalize times over 24 hours
-def normalize_time(t):
-    if pd.isna(t):
-        return t
-    h, m, s = map(int, t.split(':'))
-    return pd.Timedelta(hours=h, minutes=m, seconds=s)
-
-# Apply normalization to times
-stop_times['arrival_time'] = stop_times['arrival_time'].apply(normalize_time)
-stop_times['departure_time'] = stop_times['departure_time'].apply(normalize_time)
+stops = read_gtfs('stops', gtfs_dir)
+routes = read_gtfs('routes', gtfs_dir)
+trips = read_gtfs('trips', gtfs_dir)
+stop_times = read_gtfs('stop_times', gtfs_dir)
+calendar = read_gtfs('calendar', gtfs_dir)
+
+# Parse times, hours over 24 are kept so they stay ordered within a trip
+stop_times['arrival_time'] = seconds_to_timedelta(parse_gtfs_times(stop_times['arrival_time']))
+stop_times['departure_time'] = seconds_to_timedelta(parse_gtfs_times(stop_times['departure_time']))
 
 # Ensure trip IDs are correctly sorted by stop_sequence to aggregate segments
 stop_times = stop_times.sort_values(by=['trip_id', 'stop_sequence'])
@@ -5,26 +5,27 @@ import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
 
-def parse_time(time_str):
-    """Parse a time string in the format HH:MM:SS to a datetime object, handling hours > 23."""
-    hours, minutes, seconds = map(int, time_str.split(':'))
-    if hours >= 24:
-        days, hours = divmod(hours, 24)
-        return datetime.strptime(f'{hours:02}:{minutes:02}:{seconds:02}', '%H:%M:%S') + timedelta(days=days)
-    else:
-        return datetime.strptime(time_str, '%H:%M:%S')
+from feed.cache import read_gtfs
+from feed.service_cube import load_service_cube
+from feed.times import parse_gtfs_times, seconds_to_timedelta
+
+def parse_time(times):
+    """Parse a Series of HH:MM:SS strings to datetimes on 1900-01-01, handling hours > 23."""
+    return pd.Timestamp(1900, 1, 1) + seconds_to_timedelta(parse_gtfs_times(times))
 
 # Load the data
-stops_df = pd.read_csv('/home/anatol/Documents/2023_24_2/DS/gtfs_generic_eu/stops.txt')
-routes_df = pd.read_csv('/home/anatol/Documents/2023_24_2/DS/gtfs_generic_eu/routes.txt')
-trips_df = pd.read_csv('/home/anatol/Documents/2023_24_2/DS/gtfs_generic_eu/trips.txt')
-stop_times_df = pd.read_csv('/home/anatol/Documents/2023_24_2/DS/gtfs_generic_eu/stop_times.txt')
-calendar_df = pd.read_csv('/home/anatol/Documents/2023_24_2/DS/gtfs_generic_eu/calendar.txt')
-transfers_df = pd.read_csv('/home/anatol/Documents/2023_24_2/DS/gtfs_generic_eu/transfers.txt')
+gtfs_dir = '/home/anatol/Documents/2023_24_2/DS/gtfs_generic_eu'
+stops_df = read_gtfs('stops', gtfs_dir)
+routes_df = read_gtfs('routes', gtfs_dir)
+trips_df = read_gtfs('trips', gtfs_dir)
+stop_times_df = read_gtfs('stop_times', gtfs_dir)
+calendar_df = read_gtfs('calendar', gtfs_dir)
+transfers_df = read_gtfs('transfers', gtfs_dir)
+service_cube = load_service_cube(gtfs_dir)
 
 # Parse arrival and departure times correctly
-stop_times_df['arrival_time'] = stop_times_df['arrival_time'].apply(parse_time)
-stop_times_df['departure_time'] = stop_times_df['departure_time'].apply(parse_time)
+stop_times_df['arrival_time'] = parse_time(stop_times_df['arrival_time'])
+stop_times_df['departure_time'] = parse_time(stop_times_df['departure_time'])
 
 
 # Calculate trip durations and filter trips based on constraints
@@ -89,9 +90,8 @@ with tabs[0]:
 with tabs[1]:
     st.subheader('Service Heatmap')
     # Aggregate data for heatmap
-    stop_times_df['hour'] = stop_times_df['arrival_time'].dt.hour
-    stop_frequency = stop_times_df.groupby('stop_id').size().reset_index(name='count')
-    stop_data = stop_frequency.merge(stops_df, on='stop_id')
+    stop_data = stops_df.assign(count=service_cube.trip_counts(stops_df['stop_id']))
+    stop_data = stop_data[stop_data['count'] > 0]
 
     # Generate heatmap
     fig = px.density_mapbox(
@@ -113,8 +113,9 @@ with tabs[2]:
     if st.button('Show Frequency'):
         selected_stop_id = \
         stops_df[stops_df['stop_name'].str.contains(stop_name, case=False, na=False)]['stop_id'].values[0]
-        stop_frequency = stop_times_df[stop_times_df['stop_id'] == selected_stop_id].groupby(
-            stop_times_df['arrival_time'].dt.hour).size().reset_index(name='count')
+        # Departures of the stop by hour, from the precomputed service cube
+        hourly = service_cube.hourly(selected_stop_id)
+        stop_frequency = pd.DataFrame({'arrival_time': np.nonzero(hourly)[0], 'count': hourly[hourly > 0]})
 
         fig = px.bar(stop_frequency, x='arrival_time', y='count',
                      labels={'arrival_time': 'Hour of Day', 'count': 'Number of Buses'})
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+from feed.times import parse_gtfs_times
+
+# Bump when the on-disk layout changes, older caches are then rebuilt
+CACHE_VERSION = 1
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+GTFS_DIR = os.path.join(base_dir, '..', 'gtfs')
+
+# GTFS time columns, stored as int32 seconds since the start of the service day
+TIME_COLUMNS = {'arrival_time', 'departure_time', 'start_time', 'end_time'}
+
+# Marks a missing value in an int32 time column
+MISSING_TIME = -1
+
+
+def cache_dir_for(gtfs_dir):
+    return os.path.join(gtfs_dir, '.cache')
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _table_dirs(cache_dir, name):
+    prefix = f'{name}-v{CACHE_VERSION}-'
+    if not os.path.isdir(cache_dir):
+        return []
+    return [os.path.join(cache_dir, entry) for entry in os.listdir(cache_dir)
+            if entry.startswith(prefix) and '.tmp-' not in entry]
+
+
+def publish_dir(tmp_dir, final_dir, stale_prefix):
+    """
+    Move the finished tmp_dir to final_dir in one step, so concurrent readers never see a
+    half-written entry, then remove the entries next to final_dir whose name starts with
+    stale_prefix, the older versions of it. Directories still being written are left alone.
+    """
+    try:
+        os.replace(tmp_dir, final_dir)
+    except OSError:
+        # Another process published the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    parent_dir = os.path.dirname(final_dir)
+    for entry in os.listdir(parent_dir):
+        path = os.path.join(parent_dir, entry)
+        if entry.startswith(stale_prefix) and '.tmp-' not in entry and path != final_dir:
+            shutil.rmtree(path, ignore_errors=True)
+    return final_dir
+
+
+def _read_manifest(table_dir):
+    with open(os.path.join(table_dir, 'manifest.json')) as f:
+        return json.load(f)
+
+
+def compile_table(name, gtfs_dir=GTFS_DIR):
+    """
+    Convert gtfs_dir/<name>.txt into a directory of .npy columns under gtfs_dir/.cache.
+
+    Numeric columns are written as they are, time columns as int32 seconds and text columns
+    as integer category codes plus a fixed-width string array of categories, so every file
+    can be memory-mapped. The directory name carries the cache version and the source hash.
+    """
+    source_path = os.path.join(gtfs_dir, f'{name}.txt')
+    cache_dir = cache_dir_for(gtfs_dir)
+    source_hash = file_hash(source_path)
+    table_dir = os.path.join(cache_dir, f'{name}-v{CACHE_VERSION}-{source_hash[:16]}')
+
+    df = pd.read_csv(source_path, low_memory=False)
+    tmp_dir = f'{table_dir}.tmp-{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if column in TIME_COLUMNS:
+            seconds = parse_gtfs_times(values).fillna(MISSING_TIME).to_numpy(dtype=np.int32)
+            np.save(os.path.join(tmp_dir, f'{column}.npy'), seconds)
+            columns[column] = 'time'
+        elif values.dtype == object:
+            categorical = pd.Categorical(values.astype('string').to_numpy(dtype=object, na_value=None))
+            np.save(os.path.join(tmp_dir, f'{column}.npy'), categorical.codes)
+            np.save(os.path.join(tmp_dir, f'{column}.categories.npy'),
+                    categorical.categories.to_numpy(dtype=str))
+            columns[column] = 'text'
+        else:
+            np.save(os.path.join(tmp_dir, f'{column}.npy'), values.to_numpy())
+            columns[column] = 'numeric'
+
+    manifest = {
+        'version': CACHE_VERSION,
+        'source': {'path': os.path.abspath(source_path), 'sha1': source_hash, **_source_stat(source_path)},
+        'rows': len(df),
+        'columns': columns,
+    }
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return publish_dir(tmp_dir, table_dir, f'{name}-v{CACHE_VERSION}-')
+
+
+def _fresh_table_dir(name, gtfs_dir):
+    """Cached directory for the table if it still matches its source file, else None."""
+    source_path = os.path.join(gtfs_dir, f'{name}.txt')
+    cache_dir = cache_dir_for(gtfs_dir)
+    for table_dir in _table_dirs(cache_dir, name):
+        if not os.path.exists(os.path.join(table_dir, 'manifest.json')):
+            continue
+        if not os.path.exists(source_path):
+            # Use the cache when only the compiled copy of a large file is around
+            return table_dir
+
+        manifest = _read_manifest(table_dir)
+        source = manifest['source']
+        if _source_stat(source_path) == {'size': source['size'], 'mtime_ns': source['mtime_ns']}:
+            return table_dir
+        if file_hash(source_path) == source['sha1']:
+            # Same content with a new timestamp (e.g. after a checkout), remember the new stat
+            manifest['source'].update(_source_stat(source_path))
+            with open(os.path.join(table_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            return table_dir
+    return None
+
+
+def read_gtfs(name, gtfs_dir=GTFS_DIR, columns=None, categorical=False):
+    """
+    Load gtfs_dir/<name>.txt (e.g. 'stop_times') from the binary cache, compiling it first
+    when the cache is missing or the source changed.
+
+    Numeric and time columns are memory-mapped read-only and shared between processes. Time
+    columns come back as Int32 seconds. Text columns are pandas categoricals when categorical
+    is True, otherwise they are decoded to plain object columns like pd.read_csv returns.
+    """
+    table_dir = _fresh_table_dir(name, gtfs_dir) or compile_table(name, gtfs_dir)
+    manifest = _read_manifest(table_dir)
+
+    data = {}
+    for column, kind in manifest['columns'].items():
+        if columns is not None and column not in columns:
+            continue
+        values = np.load(os.path.join(table_dir, f'{column}.npy'), mmap_mode='r')
+        if kind == 'time':
+            data[column] = pd.arrays.IntegerArray(values, values == MISSING_TIME)
+        elif kind == 'text':
+            categories = np.load(os.path.join(table_dir, f'{column}.categories.npy')).astype(object)
+            if categorical:
+                data[column] = pd.Categorical.from_codes(values, categories=categories, validate=False)
+            else:
+                # Code -1 (missing) picks the trailing NaN
+                data[column] = np.append(categories, np.nan)[values]
+        else:
+            data[column] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def table_hash(name, gtfs_dir=GTFS_DIR):
+    """Content hash of gtfs_dir/<name>.txt as recorded by its cached table, compiling it first when needed."""
+    table_dir = _fresh_table_dir(name, gtfs_dir) or compile_table(name, gtfs_dir)
+    return _read_manifest(table_dir)['source']['sha1']
+
+
+def save_arrays(directory, arrays):
+    """Write a dict of numpy arrays as <name>.npy files, strings as fixed-width unicode so they can be mapped."""
+    os.makedirs(directory, exist_ok=True)
+    for name, values in arrays.items():
+        values = np.asarray(values)
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(os.path.join(directory, f'{name}.npy'), values)
+
+
+def load_arrays(directory, mmap_mode='r'):
+    """Read back every array written by save_arrays, memory-mapped read-only by default."""
+    return {entry[:-4]: np.load(os.path.join(directory, entry), mmap_mode=mmap_mode)
+            for entry in os.listdir(directory) if entry.endswith('.npy')}
+
+
+def compile_feed(gtfs_dir=GTFS_DIR, names=None):
+    """Compile every GTFS table in gtfs_dir (or the given names) whose cache is out of date."""
+    if names is None:
+        names = sorted(entry[:-4] for entry in os.listdir(gtfs_dir) if entry.endswith('.txt'))
+    for name in names:
+        if _fresh_table_dir(name, gtfs_dir) is None:
+            print(f"Compiling {name}.txt")
+            compile_table(name, gtfs_dir)
+
+
+if __name__ == '__main__':
+    compile_feed(*sys.argv[1:2])
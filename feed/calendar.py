@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def parse_gtfs_dates(dates):
+    return pd.to_datetime(pd.Series(dates).astype(str), format='%Y%m%d')
+
+
+class ServiceCalendar:
+    """
+    Active days of every service_id over the feed window, one bit per day.
+
+    Built from calendar.txt (weekday pattern between start_date and end_date) with the
+    calendar_dates.txt exceptions applied (1 = service added, 2 = service removed).
+    Row i of bits is the packed day mask of service_ids[i], day 0 being start_date.
+    """
+
+    def __init__(self, service_ids, start_date, n_days, bits):
+        self.service_ids = service_ids
+        self.start_date = start_date
+        self.n_days = n_days
+        self.bits = bits
+        self.service_index = {service_id: i for i, service_id in enumerate(service_ids)}
+
+    @classmethod
+    def from_feed(cls, calendar_df, calendar_dates_df, feed_info_df=None):
+        starts = parse_gtfs_dates(calendar_df['start_date']).to_numpy()
+        ends = parse_gtfs_dates(calendar_df['end_date']).to_numpy()
+        exception_dates = parse_gtfs_dates(calendar_dates_df['date']).to_numpy()
+
+        # Feed window from feed_info.txt, falling back to the range the calendar covers
+        if feed_info_df is not None and not feed_info_df.empty:
+            window_start = parse_gtfs_dates(feed_info_df['feed_start_date']).iloc[0]
+            window_end = parse_gtfs_dates(feed_info_df['feed_end_date']).iloc[0]
+        else:
+            all_dates = np.concatenate([starts, ends, exception_dates])
+            window_start, window_end = all_dates.min(), all_dates.max()
+        window_start = pd.Timestamp(window_start)
+        days = pd.date_range(window_start, pd.Timestamp(window_end)).to_numpy()
+
+        service_ids = pd.Index(calendar_df['service_id']).append(
+            pd.Index(calendar_dates_df['service_id'])).unique()
+        service_rows = service_ids.get_indexer(calendar_df['service_id'])
+
+        # Regular weekday pattern inside [start_date, end_date]
+        weekday_flags = calendar_df[WEEKDAYS].to_numpy(dtype=bool)
+        day_weekdays = pd.DatetimeIndex(days).weekday.to_numpy()
+        active = np.zeros((len(service_ids), len(days)), dtype=bool)
+        active[service_rows] = (weekday_flags[:, day_weekdays]
+                                & (days[None, :] >= starts[:, None])
+                                & (days[None, :] <= ends[:, None]))
+
+        # Exceptions inside the feed window
+        exception_days = ((exception_dates - days[0]) // np.timedelta64(1, 'D')).astype(np.int64)
+        inside = (exception_days >= 0) & (exception_days < len(days))
+        exception_rows = service_ids.get_indexer(calendar_dates_df['service_id'])[inside]
+        exception_types = calendar_dates_df['exception_type'].to_numpy()[inside]
+        active[exception_rows, exception_days[inside]] = exception_types == 1
+
+        return cls(np.asarray(service_ids, dtype=object), window_start, len(days), np.packbits(active, axis=1))
+
+    def day_index(self, date):
+        day = (pd.Timestamp(date).normalize() - self.start_date).days
+        if not 0 <= day < self.n_days:
+            raise ValueError(f"{pd.Timestamp(date).date()} is outside the feed window "
+                             f"{self.start_date.date()} - {(self.start_date + pd.Timedelta(days=self.n_days - 1)).date()}")
+        return day
+
+    def service_codes(self, service_ids):
+        """Row of every given service_id in bits, -1 for services the calendar doesn't know."""
+        return pd.Index(self.service_ids).get_indexer(service_ids)
+
+    def active_services(self, date):
+        """Boolean mask over service_ids of the services running on date."""
+        day = self.day_index(date)
+        return (self.bits[:, day // 8] >> (7 - day % 8)) & 1 == 1
+
+    def is_active(self, service_codes, date):
+        """Boolean mask over service_codes (from service_codes()) of the ones running on date."""
+        service_codes = np.asarray(service_codes)
+        active = np.append(self.active_services(date), False)
+        return active[service_codes]
+
+    def active_days(self):
+        """Number of days every service runs in the feed window."""
+        return np.unpackbits(self.bits, axis=1, count=self.n_days).sum(axis=1)
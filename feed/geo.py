@@ -0,0 +1,5 @@
+# Coordinates of the feed and the other sources
+WGS84_CRS = 'EPSG:4326'
+
+# Equal-area projection for Europe with axes in meters, used for every distance and buffer
+EUROPE_CRS = 'EPSG:3035'
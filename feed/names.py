@@ -0,0 +1,113 @@
+import bisect
+import re
+import unicodedata
+from collections import defaultdict
+
+import numpy as np
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_name(name):
+    """Lower-case, accent-folded form of a stop name with punctuation turned into spaces."""
+    folded = unicodedata.normalize('NFKD', str(name))
+    folded = ''.join(char for char in folded if not unicodedata.combining(char))
+    # Letters NFKD doesn't split into base + accent
+    folded = folded.replace('ß', 'ss').replace('ø', 'o').replace('Ø', 'O').replace('ł', 'l').replace('Ł', 'L')
+    return _NON_WORD.sub(' ', folded.casefold()).strip()
+
+
+def name_tokens(name):
+    return normalize_name(name).split()
+
+
+def _trigrams(token):
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class StopNameIndex:
+    """
+    Word index over stop names, built once per stop table.
+
+    lookup() resolves an origin: the stops whose name contains every word of the query as a
+    whole word, so "Ulm" finds "Ulm Hbf" but not "Ulmen". search() is for autocomplete: the last
+    query word may be a prefix, and names with similar trigrams are offered when nothing matches.
+    """
+
+    def __init__(self, stop_ids, stop_names):
+        self.stop_ids = np.asarray(stop_ids, dtype=object)
+        self.stop_names = np.asarray(stop_names, dtype=object)
+        self.normalized = [normalize_name(name) if isinstance(name, str) else '' for name in self.stop_names]
+        self.stop_rows = {stop_id: row for row, stop_id in enumerate(self.stop_ids)}
+
+        postings = defaultdict(set)
+        for row, name in enumerate(self.normalized):
+            for token in name.split():
+                postings[token].add(row)
+        self.tokens = sorted(postings)
+        self.postings = [postings[token] for token in self.tokens]
+
+        trigram_postings = defaultdict(set)
+        for position, token in enumerate(self.tokens):
+            for trigram in _trigrams(token):
+                trigram_postings[trigram].add(position)
+        self.trigram_postings = dict(trigram_postings)
+
+    def _rows_with_token(self, token):
+        position = bisect.bisect_left(self.tokens, token)
+        if position < len(self.tokens) and self.tokens[position] == token:
+            return self.postings[position]
+        return set()
+
+    def _rows_with_prefix(self, prefix):
+        start = bisect.bisect_left(self.tokens, prefix)
+        end = bisect.bisect_left(self.tokens, prefix + '\uffff')
+        return set().union(*self.postings[start:end])
+
+    def _rank(self, rows, query):
+        # Names starting with the query first, then shorter names, then alphabetically for stable results
+        return sorted(rows, key=lambda row: (not self.normalized[row].startswith(query), len(self.normalized[row]),
+                                             self.normalized[row], str(self.stop_ids[row])))
+
+    def lookup_rows(self, query):
+        tokens = name_tokens(query)
+        if not tokens:
+            return []
+        rows = set.intersection(*(self._rows_with_token(token) for token in tokens))
+        return sorted(rows)
+
+    def lookup(self, query):
+        """Stop ids whose name contains every word of query, in stop table order."""
+        return self.stop_ids[self.lookup_rows(query)].tolist()
+
+    def search(self, query, limit=10):
+        """Ranked stop ids for a partly typed name, falling back to trigram similarity when no word matches."""
+        tokens = name_tokens(query)
+        if not tokens:
+            return []
+        rows = self._rows_with_prefix(tokens[-1])
+        for token in tokens[:-1]:
+            rows &= self._rows_with_token(token)
+        if rows:
+            return self.stop_ids[self._rank(rows, ' '.join(tokens))[:limit]].tolist()
+
+        # Misspelt names: tokens sharing most trigrams with the query words
+        scores = defaultdict(float)
+        for token in tokens:
+            query_trigrams = _trigrams(token)
+            overlaps = defaultdict(int)
+            for trigram in query_trigrams:
+                for position in self.trigram_postings.get(trigram, ()):
+                    overlaps[position] += 1
+            for position, overlap in overlaps.items():
+                similarity = overlap / len(query_trigrams | _trigrams(self.tokens[position]))
+                for row in self.postings[position]:
+                    scores[row] = max(scores[row], similarity)
+        ranked = sorted((row for row, score in scores.items() if score >= 0.3),
+                        key=lambda row: (-scores[row], len(self.normalized[row]), self.normalized[row],
+                                         str(self.stop_ids[row])))
+        return self.stop_ids[ranked[:limit]].tolist()
+
+    def names(self, stop_ids):
+        return [self.stop_names[self.stop_rows[stop_id]] for stop_id in stop_ids]
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from feed.cache import GTFS_DIR, cache_dir_for, load_arrays, publish_dir, read_gtfs, save_arrays, table_hash
+from feed.calendar import ServiceCalendar
+
+# Bump when the arrays of the cube change, older cubes are then rebuilt
+CUBE_VERSION = 2
+
+# Tables the cube is derived from, it is rebuilt when one of them changes
+CUBE_TABLES = ['stops', 'stop_times', 'trips', 'calendar', 'calendar_dates', 'feed_info']
+
+HOURS = 24
+WEEKDAYS = 7
+
+
+class ServiceCube:
+    """
+    Departures of every stop by hour of day and weekday, built once per feed.
+
+    scheduled[stop, hour] counts the stop_times rows, every trip once whatever its calendar.
+    departures[stop, hour, weekday] counts the departures over the whole feed window, every
+    trip once for each day its service runs, and weekday_days the dates of every weekday in
+    the window. Rows follow stop_ids (the order of stops.txt), weekday 0 is Monday. Times
+    past midnight count for the hour and weekday they actually happen on.
+
+    The stop events grouped by stop and hour (event_cells), service and day offset are kept
+    with the service calendar they were counted with, so single dates are answered too.
+    """
+
+    def __init__(self, stop_ids, scheduled, departures, weekday_days, service_ids, calendar_bits, calendar_start,
+                 event_cells, event_services, event_day_offsets, event_counts):
+        self.stop_ids = stop_ids
+        self.scheduled = scheduled
+        self.departures = departures
+        self.weekday_days = weekday_days
+        self.service_calendar = ServiceCalendar(service_ids.astype(object), pd.Timestamp(calendar_start[0]),
+                                                int(weekday_days.sum()), calendar_bits)
+        self.event_cells = event_cells
+        self.event_services = event_services
+        self.event_day_offsets = event_day_offsets
+        self.event_counts = event_counts
+        self.stop_index = pd.Index(stop_ids)
+        self.scheduled_totals = np.append(scheduled.sum(axis=1), 0)
+
+    def stop_rows(self, stop_ids):
+        """Row of every given stop_id, -1 for stops the cube doesn't know."""
+        return self.stop_index.get_indexer(stop_ids)
+
+    def trip_counts(self, stop_ids):
+        """Number of stop_times rows of every given stop_id, like stop_times['stop_id'].value_counts()."""
+        return self.scheduled_totals[self.stop_rows(stop_ids)]
+
+    def hourly(self, stop_id):
+        """Stop_times rows of one stop by hour of departure."""
+        row = self.stop_rows([stop_id])[0]
+        return self.scheduled[row] if row >= 0 else np.zeros(HOURS, dtype=self.scheduled.dtype)
+
+    def departures_between(self, start_hour=0, end_hour=HOURS, weekdays=range(WEEKDAYS), average=False):
+        """
+        Departures of every stop between start_hour and end_hour on the given weekdays over the
+        feed window, or per day of those weekdays on average when average is True.
+        """
+        weekdays = list(weekdays)
+        counts = self.departures[:, start_hour:end_hour, weekdays].sum(axis=(1, 2))
+        if not average:
+            return counts
+        days = self.weekday_days[weekdays].sum()
+        return counts / days if days else np.zeros(len(counts))
+
+    def on_date(self, date):
+        """Departures of every stop by hour on date, with the trips of the days before running past midnight."""
+        service_calendar = self.service_calendar
+        service_days = service_calendar.day_index(date) - self.event_day_offsets.astype(np.int64)
+        inside = (service_days >= 0) & (service_days < service_calendar.n_days)
+        running = np.zeros(len(service_days), dtype=bool)
+        days = service_days[inside]
+        running[inside] = (service_calendar.bits[self.event_services[inside], days // 8] >> (7 - days % 8)) & 1 == 1
+        counts = np.bincount(self.event_cells[running], weights=self.event_counts[running],
+                             minlength=len(self.stop_ids) * HOURS)
+        return counts.reshape(len(self.stop_ids), HOURS).astype(np.int64)
+
+
+def _event_times(stop_times_df):
+    # Departure time of every stop event, the arrival time where a stop only has that
+    departures = stop_times_df['departure_time'].fillna(stop_times_df['arrival_time'])
+    return departures.to_numpy(dtype=np.int64, na_value=-1)
+
+
+def build_service_cube(gtfs_dir=GTFS_DIR):
+    """The arrays of ServiceCube for the feed in gtfs_dir, see its docstring."""
+    stop_ids = pd.unique(read_gtfs('stops', gtfs_dir)['stop_id'])
+    stop_times_df = read_gtfs('stop_times', gtfs_dir, columns=['trip_id', 'stop_id', 'arrival_time', 'departure_time'],
+                              categorical=True)
+    service_calendar = ServiceCalendar.from_feed(read_gtfs('calendar', gtfs_dir), read_gtfs('calendar_dates', gtfs_dir),
+                                                 read_gtfs('feed_info', gtfs_dir))
+
+    # Stop row, trip service and time of every stop event, events without a time or a known stop are left out
+    stop_categories = stop_times_df['stop_id'].cat
+    stop_rows = pd.Index(stop_ids).get_indexer(stop_categories.categories)
+    event_stops = np.append(stop_rows, -1)[stop_categories.codes]
+    trips_df = read_gtfs('trips', gtfs_dir)
+    trip_services = service_calendar.service_codes(
+        trips_df.set_index('trip_id')['service_id'].reindex(stop_times_df['trip_id'].cat.categories))
+    event_services = np.append(trip_services, -1)[stop_times_df['trip_id'].cat.codes]
+    event_times = _event_times(stop_times_df)
+    keep = (event_stops >= 0) & (event_times >= 0)
+    event_stops, event_services, event_times = event_stops[keep], event_services[keep], event_times[keep]
+
+    event_hours = event_times // 3600 % HOURS
+    event_day_offsets = event_times // (HOURS * 3600)
+    scheduled = np.bincount(event_stops * HOURS + event_hours, minlength=len(stop_ids) * HOURS)
+
+    # Days every service runs on each weekday, services the calendar doesn't know run on none
+    active = np.unpackbits(service_calendar.bits, axis=1, count=service_calendar.n_days).astype(np.int64)
+    day_weekdays = pd.date_range(service_calendar.start_date, periods=service_calendar.n_days).weekday.to_numpy()
+    service_weekday_days = np.vstack([active @ np.eye(WEEKDAYS, dtype=np.int64)[day_weekdays],
+                                      np.zeros((1, WEEKDAYS), dtype=np.int64)])
+
+    # An event of a trip starting on weekday w happens on weekday w + its day offset
+    base = (event_stops * HOURS + event_hours) * WEEKDAYS
+    departures = np.zeros(len(stop_ids) * HOURS * WEEKDAYS)
+    for service_weekday in range(WEEKDAYS):
+        weekdays = (service_weekday + event_day_offsets) % WEEKDAYS
+        departures += np.bincount(base + weekdays, weights=service_weekday_days[event_services, service_weekday],
+                                  minlength=len(departures))
+
+    # Stop events by stop and hour, service and day offset, those of services that never run are left out
+    events = pd.DataFrame({'cell': event_stops * HOURS + event_hours, 'service': event_services,
+                           'day_offset': event_day_offsets})
+    events = events[events['service'] >= 0].groupby(['cell', 'service', 'day_offset']).size().reset_index()
+
+    return {
+        'stop_ids': stop_ids,
+        'scheduled': scheduled.reshape(len(stop_ids), HOURS).astype(np.int32),
+        'departures': departures.round().reshape(len(stop_ids), HOURS, WEEKDAYS).astype(np.int32),
+        'weekday_days': np.bincount(day_weekdays, minlength=WEEKDAYS).astype(np.int32),
+        'service_ids': service_calendar.service_ids,
+        'calendar_bits': service_calendar.bits,
+        'calendar_start': np.array([service_calendar.start_date], dtype='datetime64[D]'),
+        'event_cells': events['cell'].to_numpy(dtype=np.int32),
+        'event_services': events['service'].to_numpy(dtype=np.int32),
+        'event_day_offsets': events['day_offset'].to_numpy(dtype=np.int16),
+        'event_counts': events[0].to_numpy(dtype=np.int32),
+    }
+
+
+def _cube_digest(gtfs_dir):
+    digest = hashlib.sha1()
+    for name in CUBE_TABLES:
+        digest.update(table_hash(name, gtfs_dir).encode())
+    return digest.hexdigest()
+
+
+def load_service_cube(gtfs_dir=GTFS_DIR):
+    """
+    ServiceCube of the feed in gtfs_dir, memory-mapped from gtfs_dir/.cache and only built
+    again when one of its source tables changed.
+    """
+    cache_dir = cache_dir_for(gtfs_dir)
+    name = f'service_cube-v{CUBE_VERSION}-'
+    cube_dir = os.path.join(cache_dir, name + _cube_digest(gtfs_dir)[:16])
+    if not os.path.isdir(cube_dir):
+        tmp_dir = f'{cube_dir}.tmp-{os.getpid()}'
+        save_arrays(tmp_dir, build_service_cube(gtfs_dir))
+        publish_dir(tmp_dir, cube_dir, 'service_cube-')
+    return ServiceCube(**load_arrays(cube_dir))
+
+
+if __name__ == '__main__':
+    # python -m feed.service_cube [gtfs_dir]
+    service_cube = load_service_cube(*sys.argv[1:2])
+    print(f"Service cube of {len(service_cube.stop_ids)} stops, {int(service_cube.scheduled.sum())} stop events")
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+
+def parse_gtfs_times(times):
+    """
+    Seconds since the start of the service day for a Series of GTFS 'HH:MM:SS' strings.
+
+    Hours may go past 24 for trips running over midnight, 'HH:MM' is read as 'HH:MM:00'.
+    Missing or malformed values become <NA> in the returned Int32 Series. A feed only has a few
+    thousand distinct time strings, so each one is split and parsed once and then broadcast back.
+    """
+    if pd.api.types.is_numeric_dtype(times):
+        # Already in seconds, e.g. when loaded from the feed cache
+        return times.astype('Int32')
+
+    codes, uniques = pd.factorize(times)
+    seconds = np.full(len(uniques), np.nan)
+
+    if len(uniques):
+        parts = pd.Series(uniques, dtype='string').str.strip().str.split(':', expand=True)
+        if parts.shape[1] >= 2:
+            numbers = parts.apply(pd.to_numeric, errors='coerce')
+            secs = numbers[2].where(parts[2].notna(), 0) if parts.shape[1] > 2 else 0
+            seconds = (numbers[0] * 3600 + numbers[1] * 60 + secs).to_numpy(dtype=float, na_value=np.nan)
+            if parts.shape[1] > 3:
+                # More than three fields is not a GTFS time
+                seconds[parts[3].notna().to_numpy()] = np.nan
+
+    # Missing values are factorized to -1, which picks the trailing NaN
+    values = np.append(seconds, np.nan)[codes]
+    return pd.Series(values, index=times.index, name=times.name).round().astype('Int32')
+
+
+def seconds_to_timedelta(seconds):
+    return pd.to_timedelta(seconds, unit='s')
@@ -1,129 +1,353 @@
+import hashlib
+import json
 import os
 import pandas as pd
 import numpy as np
 import streamlit as st
 import folium
-from streamlit_folium import folium_static
 from shapely.geometry import Polygon, Point
 import geopandas as gpd
 import matplotlib.pyplot as plt
 from branca.colormap import linear, LinearColormap, StepColormap
+from branca.element import MacroElement, Template
+
+from feed.cache import publish_dir, read_gtfs
+from feed.service_cube import load_service_cube
+from heatmap.regions import (GEOMETRY_LEVELS, REGIONS_PATH, level_for_zoom, load_regions, region_counts,
+                             region_geometries, stop_regions)
+from maps.folium_component import render_map, show_map
+from monitoring.timing import timed_stage
 
 # Set base directory
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Construct file paths
-stops_path = os.path.join(base_dir, '..', 'gtfs', 'stops.txt')
-stop_times_path = os.path.join(base_dir, '..', 'gtfs', 'stop_times.txt')
-regions_path = os.path.join(base_dir, 'NUTS_RG_01M_2021_4326.shp', 'NUTS_RG_01M_2021_4326.shp')
-
-
-@st.cache_data
-def load_data():
-    stops_df = pd.read_csv(stops_path)
-    stop_times_df = pd.read_csv(stop_times_path)
-    regions_gdf = gpd.read_file(regions_path)
-    return stops_df, stop_times_df, regions_gdf
-
+gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
+regions_path = REGIONS_PATH
 
-def process_data():
-    stops_df, stop_times_df, regions_gdf = load_data()
+# Initial and closest zoom of the map, the zoom decides which geometry level is drawn
+map_zoom = 6
+max_zoom = 18
+map_height = 800
 
-    # Calculate the number of trips servicing each stop
-    trip_frequencies = stop_times_df['stop_id'].value_counts().reset_index()
-    trip_frequencies.columns = ['stop_id', 'trip_count']
+# Level drawn right away, sent with the map. The finer ones are fetched by the browser when zoomed in,
+# from Streamlit's static folder next to main_interface.py (server.enableStaticServing in .streamlit/config.toml)
+embedded_level = list(GEOMETRY_LEVELS)[0]
+static_dir = os.path.join(base_dir, '..', 'static', 'heatmap')
+static_url = 'app/static/heatmap'
 
-    # Ensure the CRS is the same
-    regions_gdf = regions_gdf.to_crs(epsg=4326)
 
-    # Filter NUTS level 2 regions for Germany and level 3 regions for other countries
-    regions_germany = regions_gdf[(regions_gdf['LEVL_CODE'] == 2) & (regions_gdf['CNTR_CODE'] == 'DE')]
-    regions_others = regions_gdf[(regions_gdf['LEVL_CODE'] == 3) & (regions_gdf['CNTR_CODE'] != 'DE')]
+# Weekday names of the day filter, in the weekday order of the service cube (Monday first)
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 
-    # Combine the filtered regions
-    regions_gdf_combined = pd.concat([regions_germany, regions_others])
+# Colours of the map and their lower bounds, the old fixed bins of the trip counts (up to 5000, then the maximum)
+# scaled to the largest region of the selection, so every hour and day range uses all colours
+colors = ['#ffffcc', '#c2e699', '#78c679', '#31a354', '#006837', '#004529', '#003000', '#002000', '#001000',
+          '#000800', '#000400', '#000200']
+color_steps = np.array([0, 100, 500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000]) / 5500
 
-    stops_with_frequencies = pd.merge(stops_df, trip_frequencies, on='stop_id', how='left')
-    stops_with_frequencies['trip_count'] = stops_with_frequencies['trip_count'].fillna(0)
 
-    # Convert stops_with_frequencies to GeoDataFrame with the same CRS
-    stops_gdf = gpd.GeoDataFrame(
-        stops_with_frequencies,
-        geometry=gpd.points_from_xy(stops_with_frequencies.stop_lon, stops_with_frequencies.stop_lat),
-        crs="EPSG:4326"
-    )
-
-    # Perform spatial join to aggregate frequencies by region
-    regions_with_frequencies = gpd.sjoin(regions_gdf_combined, stops_gdf, how='left', predicate='contains')
-
-    # Ensure we use the correct column for the join key
-    regions_with_frequencies = regions_with_frequencies.reset_index()
-    region_freq = regions_with_frequencies.groupby('index')['trip_count'].sum().reset_index()
-    regions_gdf_combined = regions_gdf_combined.reset_index().merge(region_freq, left_on='index', right_on='index',
-                                                                    how='left')
-    regions_gdf_combined['trip_count'] = regions_gdf_combined['trip_count'].fillna(0)
+@st.cache_resource
+def load_data():
+    stops_df = read_gtfs('stops', gtfs_dir)
+    service_cube = load_service_cube(gtfs_dir)
+    regions_gdf = load_regions(regions_path)
+    # Region of every stop, read from the on-disk lookup unless stops.txt or the shapefile changed
+    stops_regions = stop_regions(stops_df, regions_gdf, os.path.join(gtfs_dir, 'stops.txt'), regions_path)
+    return stops_df, service_cube, regions_gdf, stops_regions
+
+
+@st.cache_resource
+def load_service_calendar():
+    # The calendar the service cube was counted with
+    _, service_cube, _, _ = load_data()
+    return service_cube.service_calendar
+
+
+@st.cache_resource
+def load_region_aggregate():
+    """
+    Departures over the feed window per region, hour and weekday. Every stop event counts once
+    for each day its trip's service runs, so a trip running on a few days weighs less than a
+    daily one, however many service_ids a service is split into.
+    """
+    stops_df, service_cube, regions_gdf, stops_regions = load_data()
+    cube_rows = service_cube.stop_rows(stops_df['stop_id'])
+    return region_counts(stops_regions, service_cube.departures[cube_rows], len(regions_gdf))
+
+
+@st.cache_resource(max_entries=32)
+def date_region_counts(travel_date):
+    """Departures per region and hour on travel_date."""
+    stops_df, service_cube, regions_gdf, stops_regions = load_data()
+    cube_rows = service_cube.stop_rows(stops_df['stop_id'])
+    return region_counts(stops_regions, service_cube.on_date(travel_date)[cube_rows], len(regions_gdf))
+
+
+def region_values(start_hour=0, end_hour=24, weekdays=None, travel_date=None):
+    """
+    Value of every region for departures between start_hour and end_hour, and its label:
+    the average departures per day on the given weekdays (all days when None), or the
+    departures on travel_date. Slices of the precomputed aggregates, nothing is recounted.
+    """
+    if travel_date is not None:
+        return date_region_counts(travel_date)[:, start_hour:end_hour].sum(axis=1), 'Departures'
+    region_departures = load_region_aggregate()
+    if weekdays is None:
+        weekdays = list(range(len(WEEKDAY_NAMES)))
+    _, service_cube, _, _ = load_data()
+    days = service_cube.weekday_days[weekdays].sum()
+    counts = region_departures[:, start_hour:end_hour, weekdays].sum(axis=(1, 2))
+    return (counts / days if days else counts), 'Departures per day'
+
+
+@st.cache_resource
+def process_data(geometry_level='medium'):
+    # Shared by every session, so each level is only prepared once per server
+    # Stages inside the cached functions are only timed on the runs computing them
+    with timed_stage('load_data') as stage:
+        stops_df, service_cube, regions_gdf, stops_regions = load_data()
+        stage['rows'] = len(stops_df)
+
+    # Regions with a departure on any day of the feed, the selection only decides their colours
+    region_departures = load_region_aggregate()
+    regions_gdf = regions_gdf.assign(row=np.arange(len(regions_gdf)), trip_count=region_departures.sum(axis=(1, 2)))
+
+    # Draw the simplified outlines of the level, regions too small for its grid keep a finer outline
+    regions_gdf = regions_gdf.set_geometry(region_geometries(regions_gdf, geometry_level, regions_path), crs=regions_gdf.crs)
 
     # Filter out regions with zero trips
-    regions_gdf_filtered = regions_gdf_combined[regions_gdf_combined['trip_count'] > 0]
+    regions_gdf_filtered = regions_gdf[(regions_gdf['trip_count'] > 0) & ~regions_gdf.geometry.is_empty]
 
     # Use NAME_LATN for region names
-    regions_gdf_filtered = regions_gdf_filtered.rename(columns={'NAME_LATN': 'Region', 'trip_count': 'Trips'})
+    regions_gdf_filtered = regions_gdf_filtered.rename(columns={'NAME_LATN': 'Region'})
 
-    # Convert GeoDataFrame to GeoJSON and add required properties
-    regions_geojson = regions_gdf_filtered.to_json()
+    # Convert GeoDataFrame to GeoJSON, the row property points into the region values
+    regions_geojson = regions_gdf_filtered[['row', 'Region', 'geometry']].to_json()
 
     # Calculate the center of the map based on stops
-    center_lat = stops_with_frequencies['stop_lat'].mean()
-    center_lon = stops_with_frequencies['stop_lon'].mean()
+    center_lat = stops_df['stop_lat'].mean()
+    center_lon = stops_df['stop_lon'].mean()
 
     return regions_geojson, center_lat, center_lon, regions_gdf_filtered
 
 
-def heatmap_main():
-    if 'heatmap_data' not in st.session_state:
-        st.session_state['heatmap_data'] = process_data()
+class RegionLayer(MacroElement):
+    """
+    The regions of every geometry level, coloured and labelled from the values the script of
+    recolour_heatmap() passes to <name>_update, which also fills the legend. The level of
+    zoom_levels[zoom] is shown after every zoom, so the browser swaps outlines without a rerun
+    of the page. levels holds the GeoJSON strings sent with the map, urls where the browser
+    fetches the other levels from the first time they are needed; until then, or when the
+    fetch fails, the current level stays drawn.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_values = {colors: [], values: [], label: '', legend: ''};
+        var {{ this.get_name() }}_data = {
+            {% for level, data in this.levels.items() %}"{{ level }}": {{ data }},
+            {% endfor %}
+        };
+        var {{ this.get_name() }}_urls = {{ this.urls }};
+        var {{ this.get_name() }}_zoom_levels = {{ this.zoom_levels }};
+        var {{ this.get_name() }}_layers = {};
+        var {{ this.get_name() }}_fetching = {};
+        var {{ this.get_name() }} = null;
+
+        function {{ this.get_name() }}_style(feature) {
+            var color = {{ this.get_name() }}_values.colors[feature.properties.row];
+            return {fillColor: color || '#ffffff', color: 'black', weight: color ? 0.5 : 0,
+                    fillOpacity: color ? 0.8 : 0};
+        }
+
+        function {{ this.get_name() }}_fetch(level) {
+            // Relative to the app the map's frame belongs to, which Streamlit passes as streamlitUrl
+            var app_url = new URLSearchParams(window.location.search).get('streamlitUrl') || window.location.href;
+            {{ this.get_name() }}_fetching[level] = true;
+            fetch(new URL({{ this.get_name() }}_urls[level], app_url))
+                .then(function(response) {
+                    if (!response.ok) {
+                        throw new Error(response.statusText);
+                    }
+                    return response.json();
+                })
+                .then(function(data) {
+                    {{ this.get_name() }}_data[level] = data;
+                    {{ this.get_name() }}_show();
+                })
+                .catch(function(error) {
+                    console.warn('Region outlines of level ' + level + ' not available: ' + error);
+                });
+        }
+
+        function {{ this.get_name() }}_layer(level) {
+            // Levels are turned into layers the first time they are shown, those not sent with the map are
+            // fetched first and null until they arrive
+            if (!(level in {{ this.get_name() }}_data)) {
+                if (!{{ this.get_name() }}_fetching[level]) {
+                    {{ this.get_name() }}_fetch(level);
+                }
+                return null;
+            }
+            if (!(level in {{ this.get_name() }}_layers)) {
+                {{ this.get_name() }}_layers[level] = L.geoJson({{ this.get_name() }}_data[level], {
+                    style: {{ this.get_name() }}_style,
+                    onEachFeature: function(feature, layer) {
+                        layer.bindTooltip(function() {
+                            var values = {{ this.get_name() }}_values;
+                            return '<b>Region:</b> ' + feature.properties.Region + '<br><b>' + values.label + ':</b> '
+                                + values.values[feature.properties.row];
+                        });
+                    }
+                });
+            }
+            return {{ this.get_name() }}_layers[level];
+        }
+
+        function {{ this.get_name() }}_show() {
+            var map = {{ this._parent.get_name() }};
+            var zoom_levels = {{ this.get_name() }}_zoom_levels;
+            var zoom = Math.min(Math.max(Math.round(map.getZoom()), 0), zoom_levels.length - 1);
+            var layer = {{ this.get_name() }}_layer(zoom_levels[zoom]);
+            if (!layer) {
+                if ({{ this.get_name() }}) {
+                    return;
+                }
+                layer = {{ this.get_name() }}_layer(Object.keys({{ this.get_name() }}_data)[0]);
+            }
+            if (layer === {{ this.get_name() }}) {
+                return;
+            }
+            if ({{ this.get_name() }}) {
+                map.removeLayer({{ this.get_name() }});
+            }
+            {{ this.get_name() }} = layer.addTo(map);
+        }
+
+        var {{ this.get_name() }}_legend = L.control({position: 'topright'});
+        {{ this.get_name() }}_legend.onAdd = function() {
+            var div = L.DomUtil.create('div');
+            div.style.padding = '4px';
+            div.style.background = 'rgba(255, 255, 255, 0.8)';
+            return div;
+        };
+        {{ this.get_name() }}_legend.addTo({{ this._parent.get_name() }});
+
+        function {{ this.get_name() }}_update(values) {
+            // New colours for the regions of every level built so far, the tooltips read the values when shown
+            {{ this.get_name() }}_values = values;
+            for (var level in {{ this.get_name() }}_layers) {
+                {{ this.get_name() }}_layers[level].setStyle({{ this.get_name() }}_style);
+            }
+            {{ this.get_name() }}_legend.getContainer().innerHTML = values.legend;
+        }
+
+        {{ this._parent.get_name() }}.on('zoomend', {{ this.get_name() }}_show);
+        {{ this.get_name() }}_show();
+        {% endmacro %}
+    """)
+
+    def __init__(self, levels, urls, zoom_levels):
+        super().__init__()
+        self._name = 'RegionLayer'
+        self.levels = levels
+        self.urls = json.dumps(urls)
+        self.zoom_levels = json.dumps(zoom_levels)
+
+
+def publish_levels(levels):
+    """
+    Write the GeoJSON string of every level to static_dir, in a directory named after their
+    content so browsers never keep outlines of older regions. Returns the URL of every level.
+    """
+    digest = hashlib.sha1()
+    for level, regions_geojson in levels.items():
+        digest.update(level.encode())
+        digest.update(regions_geojson.encode())
+    name = f'regions-{digest.hexdigest()[:16]}'
+    level_dir = os.path.join(static_dir, name)
+    if not os.path.isdir(level_dir):
+        tmp_dir = f'{level_dir}.tmp-{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        for level, regions_geojson in levels.items():
+            with open(os.path.join(tmp_dir, f'{level}.json'), 'w') as f:
+                f.write(regions_geojson)
+        publish_dir(tmp_dir, level_dir, 'regions-')
+    return {level: f'{static_url}/{name}/{level}.json' for level in levels}
+
+
+@st.cache_resource
+def render_heatmap():
+    # Map with the coarsest geometry level and without region values, rendered once for every session. Returns
+    # the rendered map and the name of its region layer, which the script of recolour_heatmap() calls
+    levels = {}
+    with timed_stage('process_data') as stage:
+        for geometry_level in GEOMETRY_LEVELS:
+            levels[geometry_level], center_lat, center_lon, regions_gdf_filtered = process_data(geometry_level)
+        stage['rows'] = len(regions_gdf_filtered)
+
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=map_zoom, max_zoom=max_zoom)
+    embedded = {embedded_level: levels.pop(embedded_level)}
+    region_layer = RegionLayer(embedded, publish_levels(levels), [level_for_zoom(zoom) for zoom in range(max_zoom + 1)])
+    m.add_child(region_layer)
+    rendered_map = render_map(m)
+    # Named after rendering, which gives the layer the stable name the browser knows it by
+    return rendered_map, region_layer.get_name()
+
+
+def recolour_heatmap(layer_name, values, label):
+    """Script colouring the regions of the layer by values, one per region row, and showing their legend."""
+    max_value = max(float(np.max(values)), 1e-9)
+    color_bins = list(color_steps * max_value) + [max_value]
+    colormap = StepColormap(colors, vmin=0, vmax=max_value, index=color_bins, caption=label)
+
+    # Same colours as colormap(value), for all regions at once, regions without service stay blank
+    region_colors = np.array(colors)[np.clip(np.searchsorted(color_bins, values, side='right') - 1, 0, len(colors) - 1)]
+    region_values = {
+        'colors': np.where(np.asarray(values) > 0, region_colors, None).tolist(),
+        'values': np.round(np.asarray(values, dtype=float), 1).tolist(),
+        'label': label,
+        'legend': colormap._repr_html_(),
+    }
+    return f'{layer_name}_update({json.dumps(region_values)});'
 
-    regions_geojson, center_lat, center_lon, regions_gdf_filtered = st.session_state['heatmap_data']
 
-    def add_regions_to_map(map_obj, geojson_data, colormap):
-        folium.GeoJson(
-            geojson_data,
-            style_function=lambda feature: {
-                'fillColor': colormap(feature['properties']['Trips']),
-                'color': 'black',  # Thin border color
-                'weight': 0.5,  # Thin border width
-                'fillOpacity': 0.8
-            },
-            tooltip=folium.GeoJsonTooltip(fields=['Region', 'Trips'], aliases=['Region:', 'Trips:'])
-        ).add_to(map_obj)
-
-    # Define a stepped colormap with distinct colors based on trip counts
-    min_trip_count = regions_gdf_filtered['Trips'].min()
-    max_trip_count = regions_gdf_filtered['Trips'].max()
-
-    color_bins = [min_trip_count, 100, 500, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000, max_trip_count]
-    colors = ['#ffffcc', '#c2e699', '#78c679', '#31a354', '#006837', '#004529', '#003000', '#002000', '#001000',
-              '#000800', '#000400', '#000200']
-
-    if len(colors) != len(color_bins) - 1:
-        raise ValueError("The number of colors must be equal to the number of bins - 1")
-
-    colormap = StepColormap(colors, vmin=min_trip_count, vmax=max_trip_count, index=color_bins,
-                            caption='Trip Frequencies')
+def heatmap_main():
+    with timed_stage('load_service_calendar'):
+        service_calendar = load_service_calendar()
+    feed_start = service_calendar.start_date.date()
+    feed_end = (service_calendar.start_date + pd.Timedelta(days=service_calendar.n_days - 1)).date()
+
+    # Restrict the heatmap to some weekdays or to the services running on one day, and to a range of hours
+    weekdays = None
+    travel_date = None
+    days = st.radio("Days:", ['All days', 'Weekdays', 'Specific date'], horizontal=True)
+    if days == 'Weekdays':
+        weekday_names = st.multiselect("Weekdays:", WEEKDAY_NAMES, default=WEEKDAY_NAMES[:5])
+        weekdays = [WEEKDAY_NAMES.index(name) for name in weekday_names]
+    elif days == 'Specific date':
+        travel_date = st.date_input("Travel date:", value=feed_start, min_value=feed_start, max_value=feed_end)
+    start_hour, end_hour = st.slider("Departure hours:", min_value=0, max_value=24, value=(0, 24))
 
     st.title('FlixBus Service Heatmap')
     st.write(
-        "This heatmap shows how well different areas are serviced by FlixBus, based on the number of routes and their frequencies.")
+        "This heatmap shows how well different areas are serviced by FlixBus, based on the number of departures per day "
+        "from their stops, counting every trip on the days it runs.")
 
     st.write('<style>div.block-container{padding-top:2rem;}</style>', unsafe_allow_html=True)
 
-    m = folium.Map(location=[center_lat, center_lon], zoom_start=6)
-
-    add_regions_to_map(m, regions_geojson, colormap)
-
-    colormap.add_to(m)
-
-    folium_static(m, width=1200, height=800)
+    # The map is only rendered and mounted once, moving the controls only sends the new colours of its regions
+    # and zooming swaps the outlines in the browser, coarser ones keep the whole network light to draw
+    with timed_stage('render_heatmap'):
+        rendered_map, layer_name = render_heatmap()
+    with timed_stage('region_values') as stage:
+        values, label = region_values(start_hour, end_hour, weekdays, travel_date)
+        stage['rows'] = len(values)
+    with timed_stage('recolour_heatmap'):
+        recolour_script = recolour_heatmap(layer_name, values, label)
+    with timed_stage('show_map'):
+        show_map(rendered_map, 'heatmap', overlay=recolour_script, width=1200, height=map_height, returned_objects=[])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+import hashlib
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from feed.cache import file_hash, load_arrays, publish_dir, save_arrays
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+REGIONS_PATH = os.path.join(base_dir, 'NUTS_RG_01M_2021_4326.shp', 'NUTS_RG_01M_2021_4326.shp')
+CACHE_DIR = os.path.join(base_dir, '.cache')
+
+# Files of a shapefile that decide the region geometries and their order
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj']
+
+# Grid size in degrees of every prepared geometry level, from the farthest zoom to the closest
+GEOMETRY_LEVELS = {'coarse': 0.05, 'medium': 0.01, 'fine': 0.002}
+
+
+def load_regions(regions_path=REGIONS_PATH):
+    """NUTS level 2 regions for Germany and level 3 regions for other countries, in EPSG:4326."""
+    regions_gdf = gpd.read_file(regions_path).to_crs(epsg=4326)
+    regions_germany = regions_gdf[(regions_gdf['LEVL_CODE'] == 2) & (regions_gdf['CNTR_CODE'] == 'DE')]
+    regions_others = regions_gdf[(regions_gdf['LEVL_CODE'] == 3) & (regions_gdf['CNTR_CODE'] != 'DE')]
+    return pd.concat([regions_germany, regions_others]).reset_index(drop=True)
+
+
+def assign_regions(stop_lons, stop_lats, regions_gdf):
+    """Row of regions_gdf containing every stop, -1 for stops outside all regions or without coordinates."""
+    stop_points = shapely.points(stop_lons, stop_lats)
+    tree = shapely.STRtree(regions_gdf.geometry.values)
+    stop_idx, region_idx = tree.query(stop_points, predicate='within')
+
+    stop_regions = np.full(len(stop_points), -1, dtype=np.int32)
+    # Regions of one level don't overlap, but on a shared border keep the first region like the old join did
+    stop_regions[stop_idx[::-1]] = region_idx[::-1]
+    return stop_regions
+
+
+def _sources_digest(paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.exists(path):
+            digest.update(file_hash(path).encode())
+    return digest.hexdigest()
+
+
+def _shapefile_paths(regions_path):
+    base, _ = os.path.splitext(regions_path)
+    return [base + ext for ext in SHAPEFILE_PARTS]
+
+
+def _publish(name, digest, arrays):
+    # Atomically publish heatmap/.cache/<name>-<digest> and drop the entries of older sources
+    cache_dir = os.path.join(CACHE_DIR, f'{name}-{digest[:16]}')
+    tmp_dir = f'{cache_dir}.tmp-{os.getpid()}'
+    save_arrays(tmp_dir, arrays)
+    publish_dir(tmp_dir, cache_dir, f'{name}-')
+
+
+def stop_regions(stops_df, regions_gdf, stops_path, regions_path=REGIONS_PATH):
+    """
+    assign_regions() for the rows of stops_df, cached under heatmap/.cache.
+
+    The cache key is the content of stops_path and of the shapefile, so the lookup is only
+    rebuilt when one of them changes.
+    """
+    digest = _sources_digest([stops_path] + _shapefile_paths(regions_path))
+    cache_dir = os.path.join(CACHE_DIR, f'stop_regions-{digest[:16]}')
+    if os.path.isdir(cache_dir):
+        return load_arrays(cache_dir, mmap_mode=None)['stop_regions']
+
+    regions = assign_regions(stops_df['stop_lon'].to_numpy(dtype=float), stops_df['stop_lat'].to_numpy(dtype=float),
+                             regions_gdf)
+    _publish('stop_regions', digest, {'stop_regions': regions, 'stop_ids': stops_df['stop_id'].to_numpy(dtype=object)})
+    return regions
+
+
+def level_for_zoom(zoom):
+    """Name of the geometry level to draw at a Leaflet zoom level."""
+    if zoom <= 5:
+        return 'coarse'
+    if zoom <= 8:
+        return 'medium'
+    return 'fine'
+
+
+def simplify_regions(geometries, grid_size):
+    """
+    Snap the region outlines to a grid of grid_size degrees, dropping the vertices that fall
+    into the same cell. Neighbouring regions share their border vertices, so both sides snap
+    to the same points and no seams open between them. The coordinates are rounded to the
+    grid as well, which keeps the GeoJSON numbers short.
+    """
+    snapped = shapely.set_precision(geometries, grid_size)
+    decimals = int(np.ceil(-np.log10(grid_size)))
+    return shapely.transform(snapped, lambda coords: np.round(coords, decimals))
+
+
+def region_geometries(regions_gdf, level, regions_path=REGIONS_PATH):
+    """
+    Geometries of regions_gdf at one of GEOMETRY_LEVELS. All levels are prepared together
+    the first time and cached under heatmap/.cache until the shapefile changes. A region
+    that vanishes at the level is drawn with its next finer outline, so none go missing.
+    """
+    digest = _sources_digest(_shapefile_paths(regions_path))
+    cache_dir = os.path.join(CACHE_DIR, f'region_geometry-{digest[:16]}')
+    if not os.path.isdir(cache_dir):
+        levels = {}
+        for name, grid_size in GEOMETRY_LEVELS.items():
+            decimals = int(np.ceil(-np.log10(grid_size)))
+            levels[name] = shapely.to_wkt(simplify_regions(regions_gdf.geometry.values, grid_size),
+                                          rounding_precision=decimals)
+        _publish('region_geometry', digest, levels)
+    geometries = shapely.from_wkt(np.load(os.path.join(cache_dir, f'{level}.npy')))
+
+    # Regions smaller than the grid of a level collapse, they keep the outline of a finer level or their own
+    level_names = list(GEOMETRY_LEVELS)
+    for finer_level in level_names[level_names.index(level) + 1:]:
+        empty = shapely.is_empty(geometries)
+        if not empty.any():
+            break
+        geometries[empty] = shapely.from_wkt(np.load(os.path.join(cache_dir, f'{finer_level}.npy'))[empty])
+    empty = shapely.is_empty(geometries)
+    geometries[empty] = np.asarray(regions_gdf.geometry.values)[empty]
+    return geometries
+
+
+def region_counts(stop_regions, stop_counts, n_regions):
+    """Sum of stop_counts (one row per stop, indexed like stop_regions) per region."""
+    inside = stop_regions >= 0
+    stop_counts = np.asarray(stop_counts)
+    counts = np.zeros((n_regions,) + stop_counts.shape[1:], dtype=np.result_type(stop_counts, np.int64))
+    np.add.at(counts, stop_regions[inside], stop_counts[inside])
+    return counts
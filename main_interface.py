@@ -9,12 +9,19 @@ st.set_page_config(
 
 from transfers.destinations_interface import destinations_interface_main
 from heatmap.heatmap import heatmap_main
+from monitoring.timing import page_run
+from monitoring.timing_panel import timing_panel
 
 # Create a sidebar for page selection
 page = st.sidebar.selectbox("Select a page", ["Destinations Interface", "Heatmap"])
+show_timings = st.sidebar.checkbox("Show page timings", value=False)
 
-# Call the respective function based on the selected page
-if page == "Destinations Interface":
-    destinations_interface_main()
-elif page == "Heatmap":
-    heatmap_main()
+# Call the respective function based on the selected page, timing its stages into logs/page_timings.jsonl
+with page_run(page) as run:
+    if page == "Destinations Interface":
+        destinations_interface_main()
+    elif page == "Heatmap":
+        heatmap_main()
+
+if show_timings:
+    timing_panel(run)
@@ -0,0 +1,98 @@
+import branca
+import folium
+import folium.elements
+from streamlit_folium import (_component_func, _get_feature_group_string, _get_map_string, _get_siblings,
+                              generate_js_hash, get_full_id)
+
+# The st_folium frontend of streamlit_folium (pinned in requirements.txt) runs the map script once, when the
+# component is mounted. Later reruns with the same key keep the map and only evaluate the overlay script,
+# and only when it changed. st_folium itself renders the whole map again on every call, so the map is
+# rendered here once and the component is called with the cached strings.
+
+
+def _bounds_dict(bounds):
+    southwest, northeast = bounds
+    return {'_southWest': {'lat': southwest[0], 'lng': southwest[1]},
+            '_northEast': {'lat': northeast[0], 'lng': northeast[1]}}
+
+
+def _elements(element):
+    yield element
+    for child in getattr(element, '_children', {}).values():
+        yield from _elements(child)
+
+
+def render_map(folium_map):
+    """
+    Everything st_folium sends to the browser for folium_map, except the overlay. The result only
+    holds strings and numbers, so it can be cached and shared by every session.
+    """
+    folium_map.render()
+    script = _get_map_string(folium_map)
+
+    css_links, js_links = [], []
+    for element in _elements(folium_map):
+        if isinstance(element, branca.colormap.ColorMap):
+            js_links[:0] = ['https://d3js.org/d3.v4.min.js', 'https://cdnjs.cloudflare.com/ajax/libs/d3/3.5.5/d3.min.js']
+        if isinstance(element, folium.elements.JSCSSMixin):
+            css_links.extend(href for _, href in element.default_css)
+            js_links.extend(src for _, src in element.default_js)
+
+    return {
+        'script': script,
+        'html': _get_siblings(folium_map),
+        'id': get_full_id(folium_map),
+        'css_links': css_links,
+        'js_links': js_links,
+        'bounds': _bounds_dict(folium_map.get_bounds()),
+        'zoom': folium_map.options.get('zoom'),
+        # Stays the same as long as the map does, so the browser keeps it across reruns
+        'hash': generate_js_hash(script),
+    }
+
+
+def feature_group_script(feature_group):
+    """Script drawing feature_group on a map of render_map(), as the overlay of show_map()."""
+    # Rendered against a throwaway map, whose name st_folium replaces by the one the browser knows
+    return _get_feature_group_string(feature_group, folium.Map(tiles=None))
+
+
+def show_map(rendered_map, key, overlay=None, width=500, height=700, returned_objects=None, center=None,
+             zoom=None):
+    """
+    Draw a map of render_map() like st_folium and return the same interaction data. overlay is a
+    script evaluated on the mounted map whenever it changes, e.g. from feature_group_script().
+    """
+    defaults = {
+        'last_clicked': None,
+        'last_object_clicked': None,
+        'last_object_clicked_tooltip': None,
+        'last_object_clicked_popup': None,
+        'all_drawings': None,
+        'last_active_drawing': None,
+        'bounds': rendered_map['bounds'],
+        'zoom': rendered_map['zoom'],
+        'last_circle_radius': None,
+        'last_circle_polygon': None,
+    }
+    if returned_objects is not None:
+        defaults = {name: value for name, value in defaults.items() if name in returned_objects}
+
+    return _component_func(
+        script=rendered_map['script'],
+        html=rendered_map['html'],
+        id=rendered_map['id'],
+        key=f"{key}-{rendered_map['hash']}",
+        height=height,
+        width=width,
+        returned_objects=returned_objects,
+        default=defaults,
+        zoom=zoom,
+        center=center,
+        feature_group=overlay,
+        return_on_hover=False,
+        layer_control=None,
+        pixelated=False,
+        css_links=rendered_map['css_links'],
+        js_links=rendered_map['js_links'],
+    )
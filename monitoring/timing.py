@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import pandas as pd
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+LOG_PATH = os.path.join(base_dir, '..', 'logs', 'page_timings.jsonl')
+
+# Page run the stages of the current script run are added to, Streamlit runs every session in its own thread
+_current_run = ContextVar('page_run', default=None)
+_log_lock = threading.Lock()
+
+
+def _memory_mb():
+    # Resident set size of the process, only available where /proc is
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _append(log_path, run):
+    line = json.dumps(run, default=str)
+    with _log_lock:
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        with open(log_path, 'a') as f:
+            f.write(line + '\n')
+
+
+@contextmanager
+def page_run(page, log_path=LOG_PATH):
+    """
+    Collect the stages timed inside the block as one run of page, appended to log_path as a
+    JSON line with the total seconds. Runs ended by st.rerun() or st.stop() are logged too,
+    with the exception name under 'interrupted'.
+    """
+    run = {'page': page, 'started': pd.Timestamp.now().isoformat(timespec='milliseconds'), 'stages': []}
+    token = _current_run.set(run)
+    start = time.perf_counter()
+    try:
+        yield run
+    except BaseException as error:
+        run['interrupted'] = type(error).__name__
+        raise
+    finally:
+        run['seconds'] = time.perf_counter() - start
+        _current_run.reset(token)
+        _append(log_path, run)
+
+
+@contextmanager
+def timed_stage(name):
+    """
+    Time a block of the current page run, with the change of the process memory. Set 'rows'
+    on the yielded dict to record the size of the result. Does nothing outside page_run().
+    """
+    stage = {'stage': name}
+    run = _current_run.get()
+    if run is None:
+        yield stage
+        return
+    memory = _memory_mb()
+    start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        stage['seconds'] = time.perf_counter() - start
+        if memory is not None:
+            stage['memory_mb'] = round(_memory_mb() - memory, 2)
+        run['stages'].append(stage)
+
+
+def recent_runs(page=None, log_path=LOG_PATH, limit=1000):
+    """The last limit logged runs, of one page when given."""
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as f:
+        runs = [json.loads(line) for line in deque(f, maxlen=limit) if line.strip()]
+    return [run for run in runs if page is None or run['page'] == page]
+
+
+def latency_summary(runs):
+    """Count, p50 and p95 seconds of the whole run ('page') and of every stage over runs."""
+    rows = [('page', run['seconds']) for run in runs]
+    rows += [(stage['stage'], stage['seconds']) for run in runs for stage in run['stages']]
+    if not rows:
+        return pd.DataFrame(columns=['count', 'p50', 'p95'])
+    seconds = pd.DataFrame(rows, columns=['stage', 'seconds']).groupby('stage', sort=False)['seconds']
+    return pd.DataFrame({'count': seconds.size(), 'p50': seconds.quantile(0.5), 'p95': seconds.quantile(0.95)})
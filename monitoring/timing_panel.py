@@ -0,0 +1,17 @@
+import pandas as pd
+import streamlit as st
+
+from monitoring.timing import latency_summary, recent_runs
+
+
+def timing_panel(run):
+    """Sidebar tables of the stages of this run and the latency of the page's recent runs."""
+    st.sidebar.subheader(f"Page timings: {run['seconds'] * 1000:.0f} ms")
+    stages = pd.DataFrame(run['stages'], columns=['stage', 'seconds', 'rows', 'memory_mb'])
+    stages['ms'] = (stages.pop('seconds') * 1000).round(1)
+    st.sidebar.dataframe(stages.set_index('stage')[['ms', 'rows', 'memory_mb']])
+
+    summary = latency_summary(recent_runs(run['page']))
+    st.sidebar.caption(f"Recent runs of this page, {int(summary['count'].get('page', 0))} logged")
+    st.sidebar.dataframe((summary[['p50', 'p95']] * 1000).round(1).rename(columns=lambda name: f'{name} ms')
+                         .join(summary['count']))
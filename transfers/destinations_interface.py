@@ -1,13 +1,22 @@
 def destinations_interface_main():
     import os
+    from datetime import time, timedelta
     import streamlit as st
     import pandas as pd
     import folium
-    from streamlit_folium import st_folium
     import folium.plugins as plugins
     import branca.colormap as cm
-    from matplotlib.colors import to_rgba
     import numpy as np
+    from feed.cache import read_gtfs
+    from feed.names import StopNameIndex
+    from feed.service_cube import load_service_cube
+    from maps.folium_component import feature_group_script, render_map, show_map
+    from monitoring.timing import timed_stage
+    from transfers.isochrones import ISOCHRONE_BANDS, isochrones
+    from transfers.precompute import build_router
+    from transfers.raptor import departing_at, departing_between
+    from transfers.route_store import load_route_store
+    from transfers.stop_clusters import cluster_ids, cluster_members, load_stop_clusters
 
     # Define time interval labels
     time_interval_labels = {
@@ -17,9 +26,14 @@ def destinations_interface_main():
         'midday': 'Midday (10:00 - 14:00)',
         'afternoon': 'Afternoon (14:00 - 18:00)',
         'late_afternoon': 'Late Afternoon (18:00 - 21:00)',
-        'night': 'Night (21:00 - 00:00)'
+        'night': 'Night (21:00 - 00:00)',
+        'leaving_at': 'Leaving at...',
+        'custom': 'Leaving between...'
     }
 
+    # Searched with the router instead of read from the precomputed route store
+    live_intervals = ['leaving_at', 'custom']
+
     # Ensure initial values are set in session state
     if 'city_name' not in st.session_state:
         st.session_state['city_name'] = "Budapest"
@@ -30,16 +44,6 @@ def destinations_interface_main():
     if 'time_interval' not in st.session_state:
         st.session_state['time_interval'] = 'morning'
 
-    def interpolate_color(color1, color2, fraction):
-        rgba1 = np.array(to_rgba(color1))
-        rgba2 = np.array(to_rgba(color2))
-        interpolated_rgba = rgba1 + (rgba2 - rgba1) * fraction
-        return '#{:02x}{:02x}{:02x}'.format(
-            int(interpolated_rgba[0] * 255),
-            int(interpolated_rgba[1] * 255),
-            int(interpolated_rgba[2] * 255)
-        )
-
     # st.set_page_config(layout="wide")
 
     # Capture scroll position using JavaScript and store it in session storage
@@ -69,10 +73,25 @@ def destinations_interface_main():
     base_dir = os.path.dirname(os.path.abspath(__file__))
 
     precomputed_data_path = os.path.join(base_dir, 'precomputed_routes_adjusted_test.csv')
+    route_store_path = os.path.join(base_dir, 'precomputed_routes.sqlite')
 
-    def get_color(travel_time_hours, min_hours, max_hours):
+    # Distinct marker colours, the map's style function gets one entry per colour instead of per stop
+    color_steps = 64
+
+    def get_colors(travel_time_hours, min_hours, max_hours):
+        # Same colours as cm.linear.YlOrRd_09.scale(min_hours, max_hours), interpolated for all values at once
         colormap = cm.linear.YlOrRd_09.scale(min_hours, max_hours)
-        return colormap(travel_time_hours)
+        values = np.asarray(travel_time_hours, dtype=float)
+        if max_hours > min_hours:
+            steps = np.round((values - min_hours) / (max_hours - min_hours) * (color_steps - 1))
+            values = min_hours + np.clip(steps, 0, color_steps - 1) / (color_steps - 1) * (max_hours - min_hours)
+        rgb = np.column_stack([np.interp(values, colormap.index, [color[channel] for color in colormap.colors])
+                               for channel in range(3)])
+        rgb = np.round(rgb * 255).astype(int)
+        return np.array(['#{:02x}{:02x}{:02x}'.format(*color) for color in rgb.tolist()])
+
+    def get_color(travel_time_hours, min_hours, max_hours):
+        return get_colors([travel_time_hours], min_hours, max_hours)[0]
 
 
     def get_legend_html(min_hours, max_hours, width=1200):
@@ -96,40 +115,55 @@ def destinations_interface_main():
         return legend_html
 
 
-    @st.cache_data
+    @st.cache_resource
     def load_precomputed_data():
-        data = pd.read_csv(precomputed_data_path)
-        # Convert travel_time to numeric (in hours), errors='coerce' will convert non-numeric values to NaN
-        data['travel_time_hours'] = pd.to_timedelta(data['travel_time']).dt.total_seconds() / 3600
-        return data
+        # Indexed route store of the precomputed CSV, built again whenever the CSV changes
+        return load_route_store(precomputed_data_path, route_store_path)
 
 
-    precomputed_routes = load_precomputed_data()
+    with timed_stage('load_precomputed_data'):
+        precomputed_routes = load_precomputed_data()
 
     # Set base directory
     base_dir = os.path.dirname(os.path.abspath(__file__))
 
     # Construct file paths
-    stops_path = os.path.join(base_dir, '..', 'gtfs', 'stops.txt')
-    stop_times_path = os.path.join(base_dir, '..', 'gtfs', 'stop_times.txt')
+    gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
 
-    # Load GTFS data
-    @st.cache_data
+    # Load GTFS data from the memory-mapped feed cache, shared by all sessions without copying
+    @st.cache_resource
     def load_gtfs_data():
-        stops_df = pd.read_csv(stops_path)
-        stop_times_df = pd.read_csv(stop_times_path)
-        return stops_df, stop_times_df
+        stops_df = read_gtfs('stops', gtfs_dir)
+        service_cube = load_service_cube(gtfs_dir)
+        return stops_df, service_cube
+
+
+    with timed_stage('load_gtfs_data') as stage:
+        stops_df, service_cube = load_gtfs_data()
+        stage['rows'] = len(stops_df)
+
+
+    @st.cache_resource
+    def load_stop_name_index():
+        return StopNameIndex(stops_df['stop_id'], stops_df['stop_name'])
+
+
+    with timed_stage('load_stop_name_index'):
+        stop_name_index = load_stop_name_index()
 
 
-    stops_df, stop_times_df = load_gtfs_data()
+    @st.cache_resource
+    def load_stop_clusters_data():
+        return load_stop_clusters(gtfs_dir)
 
-    # Calculate the number of trips servicing each stop
-    trip_frequencies = stop_times_df['stop_id'].value_counts().reset_index()
-    trip_frequencies.columns = ['stop_id', 'trip_count']
 
-    # Merge the frequencies with the stops data
-    stops_with_frequencies = pd.merge(stops_df, trip_frequencies, on='stop_id', how='left')
-    stops_with_frequencies['trip_count'] = stops_with_frequencies['trip_count'].fillna(0)
+    with timed_stage('load_stop_clusters'):
+        stop_clusters = load_stop_clusters_data()
+
+    with timed_stage('trip_frequencies') as stage:
+        # Number of trips servicing each stop, read from the precomputed service cube
+        stops_with_frequencies = stops_df.assign(trip_count=service_cube.trip_counts(stops_df['stop_id']))
+        stage['rows'] = len(stops_with_frequencies)
 
     # Streamlit interface
     st.title("Trip and Transfer Visualization")
@@ -140,6 +174,11 @@ def destinations_interface_main():
 
         with col_filter1:
             city_name = st.text_input("Enter a starting city name:", st.session_state['city_name'])
+            # Offer the closest stop names while the typed name matches no stop
+            if city_name and not stop_name_index.lookup_rows(city_name):
+                suggestions = list(dict.fromkeys(stop_name_index.names(stop_name_index.search(city_name, limit=5))))
+                if suggestions:
+                    st.caption("Did you mean: " + ", ".join(suggestions))
         with col_filter2:
             max_travel_hours = st.number_input("Enter the max travel hours:", min_value=1, max_value=8,
                                                value=st.session_state['max_travel_hours'])
@@ -154,40 +193,69 @@ def destinations_interface_main():
             time_interval = list(time_interval_labels.keys())[
                 list(time_interval_labels.values()).index(time_interval_label)]
 
-    # Filter precomputed data based on inputs
-    def get_reachable_stops(city_name, max_travel_hours, max_changes, time_interval):
-        # Filter for the specified starting city
-        city_stops = stops_df[stops_df['stop_name'].str.contains(city_name, case=False, na=False)]
-        city_stop_ids = city_stops['stop_id'].tolist()
-
-        # Find trips that contain the specified city stops
-        city_trip_ids = stop_times_df[stop_times_df['stop_id'].isin(city_stop_ids)]['trip_id'].unique()
-
-        # Apply time interval filter if not "All Day"
-        if time_interval != 'all_day':
-            precomputed_filtered = precomputed_routes[
-                (precomputed_routes['origin_city'].str.contains(city_name, case=False, na=False)) &
-                (precomputed_routes['travel_time_hours'] <= max_travel_hours) &
-                (precomputed_routes['transfer_count'] <= max_changes) &
-                (precomputed_routes['departure_time_interval'] == time_interval)
-                ]
+            # A departure time, or a (start, end) window of departure times
+            departure = None
+            if time_interval == 'leaving_at':
+                departure = st.time_input("Departure time:", value=time(8, 0), step=timedelta(minutes=15))
+            elif time_interval == 'custom':
+                departure = st.slider("Departure window:", min_value=time(0, 0), max_value=time(23, 45),
+                                      value=(time(7, 0), time(9, 0)), step=timedelta(minutes=15), format='HH:mm')
+
+    # Router for the departures the route store doesn't cover, shared by all sessions
+    @st.cache_resource
+    def load_router():
+        return build_router(gtfs_dir)
+
+
+    def to_timedelta(clock_time):
+        return pd.Timedelta(hours=clock_time.hour, minutes=clock_time.minute)
+
+
+    @st.cache_resource(max_entries=32)
+    def get_live_routes(city_name, max_travel_hours, max_changes, departure):
+        # Same columns as the route store lookup, from a profile query over the departure window
+        time_limit = pd.Timedelta(hours=max_travel_hours)
+        origin_stop_ids = cluster_members(stop_name_index.lookup(city_name), stop_clusters)
+        if isinstance(departure, tuple):
+            start, end = to_timedelta(departure[0]), to_timedelta(departure[1])
+            label = f"Leaving {departure[0]:%H:%M} - {departure[1]:%H:%M}"
+        else:
+            # Journeys leaving later than the time limit can't arrive within it
+            start = to_timedelta(departure)
+            end = start + time_limit
+            label = f"Leaving at {departure:%H:%M}"
+        window = (int(start.total_seconds()), int(end.total_seconds()))
+        profiles = load_router().reachable_profiles(origin_stop_ids, max_changes, window, time_limit)
+        if isinstance(departure, tuple):
+            routes = departing_between(profiles, start, end)
         else:
-            precomputed_filtered = precomputed_routes[
-                (precomputed_routes['origin_city'].str.contains(city_name, case=False, na=False)) &
-                (precomputed_routes['travel_time_hours'] <= max_travel_hours) &
-                (precomputed_routes['transfer_count'] <= max_changes)
-                ]
+            # The waiting time at the origin counts as travel time
+            routes = departing_at(profiles, start)
+            routes = routes[routes['travel_time'] <= time_limit]
+
+        stop_info = stops_df.drop_duplicates(subset=['stop_id'])[['stop_id', 'stop_name', 'stop_lat', 'stop_lon']]
+        routes = routes[~routes['stop_id'].isin(origin_stop_ids)].merge(stop_info, on='stop_id')
+        routes = routes.dropna(subset=['stop_lat', 'stop_lon']).reset_index(drop=True)
+        return routes.assign(origin_city=city_name, departure_time_interval=label,
+                             travel_time_hours=routes['travel_time'].dt.total_seconds() / 3600)
 
-        # Ensure `arrival_time` and `travel_time` are parsed as `Timedelta` objects
-        precomputed_filtered['arrival_time'] = pd.to_timedelta(precomputed_filtered['arrival_time'], errors='coerce')
-        precomputed_filtered['travel_time'] = pd.to_timedelta(precomputed_filtered['travel_time'], errors='coerce')
+    # Filter precomputed data based on inputs
+    def get_reachable_stops(city_name, max_travel_hours, max_changes, time_interval, departure=None):
+        if time_interval in live_intervals:
+            precomputed_filtered = get_live_routes(city_name, max_travel_hours, max_changes, departure).copy()
+        else:
+            # Only the partitions of the matching origin cities (and interval, if not "All Day") are read
+            precomputed_filtered = precomputed_routes.lookup(city_name, max_travel_hours, max_changes, time_interval)
 
-        # Calculate departure time
-        precomputed_filtered['departure_time'] = precomputed_filtered['arrival_time'] - precomputed_filtered[
-            'travel_time']
+            # Calculate departure time
+            precomputed_filtered['departure_time'] = precomputed_filtered['arrival_time'] - precomputed_filtered[
+                'travel_time']
 
-        # Extract city names from stop names
-        precomputed_filtered.loc[:, 'city'] = precomputed_filtered['stop_name'].str.split().str[0]
+        # City of every stop from the stop to city mapping, or the first word of the stop name without it
+        if stop_clusters is not None:
+            precomputed_filtered.loc[:, 'city'] = cluster_ids(precomputed_filtered['stop_id'], stop_clusters)
+        else:
+            precomputed_filtered.loc[:, 'city'] = precomputed_filtered['stop_name'].str.split().str[0]
 
         # Sort by city and travel_time_hours, and then drop duplicates
         precomputed_filtered = precomputed_filtered.sort_values(by=['city', 'travel_time_hours']).drop_duplicates(
@@ -200,13 +268,17 @@ def destinations_interface_main():
 
     # Button to trigger fetching of data
     if st.button("Find Trips"):
-        reachable_stops_info, has_data = get_reachable_stops(city_name, max_travel_hours, max_changes, time_interval)
+        with timed_stage('get_reachable_stops') as stage:
+            reachable_stops_info, has_data = get_reachable_stops(city_name, max_travel_hours, max_changes,
+                                                                 time_interval, departure)
+            stage['rows'] = len(reachable_stops_info)
         st.session_state['reachable_stops_info'] = reachable_stops_info
         st.session_state['selected_trip'] = None
         st.session_state['city_name'] = city_name
         st.session_state['max_travel_hours'] = max_travel_hours
         st.session_state['max_changes'] = max_changes
         st.session_state['time_interval'] = time_interval
+        st.session_state['departure'] = departure
         st.session_state['has_data'] = has_data
         st.rerun()
     else:
@@ -231,25 +303,36 @@ def destinations_interface_main():
     col1, col2, col3 = st.columns([2, 1, 1])
 
 
-    def visualize_reachable_destinations(reachable_stops_info, start_coords=None, selected_trip=None):
-        if reachable_stops_info.empty:
-            st.warning("No stops found for the specified city.")
-            return None
-
-        stop_name_to_id = dict(zip(reachable_stops_info['stop_name'], reachable_stops_info['stop_id']))
-        query_params = st.query_params
-        if selected_trip is not None:
-            end_coords = [selected_trip['stop_lat'], selected_trip['stop_lon']]
-            center = [(start_coords[0] + end_coords[0]) / 2, (start_coords[1] + end_coords[1]) / 2]
-        elif 'map_center_lat' in query_params and 'map_center_lon' in query_params:
-            center = [float(query_params['map_center_lat']), float(query_params['map_center_lon'])]
-        else:
-            center = start_coords
-
-        map_city = folium.Map(location=center, zoom_start=6, tiles='CartoDB positron')
+    # Isochrones of the last queries, the bands stop at the max travel hours of the query
+    @st.cache_resource(max_entries=16)
+    def load_isochrones(city_name, max_travel_hours, max_changes, time_interval, start_coords,
+                        _reachable_stops_info):
+        bands = sorted({band for band in ISOCHRONE_BANDS if band < max_travel_hours} | {max_travel_hours})
+        return isochrones(_reachable_stops_info, bands, start_coords=start_coords)
+
+    # Rendered base maps of the last queries, reused across reruns and sessions so selecting a stop neither
+    # rebuilds nor renders the destinations again
+    @st.cache_resource(max_entries=16)
+    def build_destinations_map(city_name, max_travel_hours, max_changes, time_interval, start_coords,
+                               show_isochrones, _reachable_stops_info):
+        reachable_stops_info = _reachable_stops_info
+        map_city = folium.Map(location=start_coords, zoom_start=6, tiles='CartoDB positron')
         min_hours = reachable_stops_info['travel_time_hours'].min()
         max_hours = reachable_stops_info['travel_time_hours'].max()
 
+        if show_isochrones:
+            # Travel time bands under the markers, the largest band is drawn first
+            bands = load_isochrones(city_name, max_travel_hours, max_changes, time_interval, start_coords,
+                                    reachable_stops_info)
+            bands = bands.assign(color=get_colors(bands['band_hours'], min_hours, max_hours))
+            folium.GeoJson(
+                bands.to_json(),
+                name='isochrones',
+                style_function=lambda feature: {'fillColor': feature['properties']['color'], 'color': 'grey',
+                                                'weight': 0.5, 'fillOpacity': 0.25},
+                tooltip=folium.GeoJsonTooltip(fields=['band_hours'], aliases=['Within hours:']),
+            ).add_to(map_city)
+
         # Add a distinct marker for the starting city
         folium.Marker(
             location=start_coords,
@@ -257,58 +340,77 @@ def destinations_interface_main():
             tooltip='Start City'
         ).add_to(map_city)
 
-        # Add markers for directly reachable stops
-        for _, row in reachable_stops_info.iterrows():
-            stop_coords = [row['stop_lat'], row['stop_lon']]
-            color = get_color(row['travel_time_hours'], min_hours, max_hours)
-            if selected_trip is not None and row['stop_id'] == selected_trip['stop_id']:
-                # Draw a gradient line between start and selected destination
-                num_segments = 20
-                for i in range(num_segments):
-                    fraction = i / num_segments
-                    segment_color = interpolate_color(get_color(min_hours, min_hours, max_hours), color, fraction)
-                    intermediate_point = [
-                        start_coords[0] + fraction * (stop_coords[0] - start_coords[0]),
-                        start_coords[1] + fraction * (stop_coords[1] - start_coords[1])
-                    ]
-                    next_fraction = (i + 1) / num_segments
-                    next_point = [
-                        start_coords[0] + next_fraction * (stop_coords[0] - start_coords[0]),
-                        start_coords[1] + next_fraction * (stop_coords[1] - start_coords[1])
-                    ]
-                    folium.PolyLine(
-                        locations=[intermediate_point, next_point],
-                        color=segment_color,
-                        weight=3,
-                        opacity=0.8
-                    ).add_to(map_city)
-
-                # Highlight the selected destination
-                folium.CircleMarker(
-                    location=stop_coords,
-                    radius=10,  # Increased radius size for selected trip
-                    color='darkgreen',  # Dark green highlight color for selected trip
-                    weight=3,  # Outline thickness for selected trip
-                    fill=True,
-                    fill_color=color,
-                    fill_opacity=1,  # Full opacity for selected trip
-                    tooltip=row['stop_name']  # Set tooltip to stop_name
-                ).add_to(map_city)
-            else:
-                folium.CircleMarker(
-                    location=stop_coords,
-                    radius=5,  # Reduced radius size
-                    color='black',  # Outline color
-                    weight=1,  # Outline thickness
-                    fill=True,
-                    fill_color=color,
-                    fill_opacity=0.6,
-                    tooltip=row['stop_name']  # Set tooltip to stop_name
-                ).add_to(map_city)
+        # All destinations as one GeoJSON layer, coloured in one pass and styled by the browser
+        colors = get_colors(reachable_stops_info['travel_time_hours'].to_numpy(), min_hours, max_hours)
+        destinations = {
+            'type': 'FeatureCollection',
+            'features': [
+                {
+                    'type': 'Feature',
+                    'id': stop_id,
+                    'geometry': {'type': 'Point', 'coordinates': [stop_lon, stop_lat]},
+                    'properties': {'stop_id': stop_id, 'stop_name': stop_name, 'color': color},
+                }
+                for stop_id, stop_name, stop_lat, stop_lon, color in zip(
+                    reachable_stops_info['stop_id'], reachable_stops_info['stop_name'],
+                    reachable_stops_info['stop_lat'], reachable_stops_info['stop_lon'], colors)
+            ],
+        }
+
+        folium.GeoJson(
+            destinations,
+            name='destinations',
+            marker=folium.CircleMarker(fill=True),
+            style_function=lambda feature: {'radius': 5, 'color': 'black', 'weight': 1,
+                                            'fillColor': feature['properties']['color'], 'fillOpacity': 0.6},
+            tooltip=folium.GeoJsonTooltip(fields=['stop_name'], labels=False),
+        ).add_to(map_city)
 
         plugins.Fullscreen().add_to(map_city)
 
-        return map_city, stop_name_to_id
+        return render_map(map_city)
+
+    def build_selection_overlay(reachable_stops_info, start_coords, selected_trip):
+        # Only this layer changes when a destination is selected
+        overlay = folium.FeatureGroup(name='selection')
+        min_hours = reachable_stops_info['travel_time_hours'].min()
+        max_hours = reachable_stops_info['travel_time_hours'].max()
+        stop_coords = [selected_trip['stop_lat'], selected_trip['stop_lon']]
+        color = get_color(selected_trip['travel_time_hours'], min_hours, max_hours)
+
+        # Draw a gradient line between start and selected destination
+        fractions = np.linspace(0, 1, 21)
+        folium.ColorLine(
+            positions=[[start_coords[0] + fraction * (stop_coords[0] - start_coords[0]),
+                        start_coords[1] + fraction * (stop_coords[1] - start_coords[1])] for fraction in fractions],
+            colors=fractions[:-1].tolist(),
+            colormap=[get_color(min_hours, min_hours, max_hours), color],
+            nb_steps=20,
+            weight=3,
+            opacity=0.8,
+        ).add_to(overlay)
+
+        # Highlight the selected destination
+        folium.CircleMarker(
+            location=stop_coords,
+            radius=10,  # Increased radius size for selected trip
+            color='darkgreen',  # Dark green highlight color for selected trip
+            weight=3,  # Outline thickness for selected trip
+            fill=True,
+            fill_color=color,
+            fill_opacity=1,  # Full opacity for selected trip
+            tooltip=selected_trip['stop_name']  # Set tooltip to stop_name
+        ).add_to(overlay)
+        return overlay
+
+    def get_map_center(start_coords, selected_trip):
+        query_params = st.query_params
+        if selected_trip is not None:
+            end_coords = [selected_trip['stop_lat'], selected_trip['stop_lon']]
+            return [(start_coords[0] + end_coords[0]) / 2, (start_coords[1] + end_coords[1]) / 2]
+        if 'map_center_lat' in query_params and 'map_center_lon' in query_params:
+            return [float(query_params['map_center_lat']), float(query_params['map_center_lon'])]
+        return start_coords
 
 
     with col1:
@@ -321,35 +423,52 @@ def destinations_interface_main():
             # Display legend
             st.markdown(legend_html, unsafe_allow_html=True)
 
+            # Areas reachable within each travel time band, drawn under the stops
+            show_isochrones = st.checkbox("Show travel time isochrones", value=False)
+
             # Determine the start coordinates from the city name
-            start_coords = stops_df[stops_df['stop_name'].str.contains(city_name, case=False, na=False)]
-            if not start_coords.empty:
-                start_coords = [start_coords.iloc[0]['stop_lat'], start_coords.iloc[0]['stop_lon']]
+            start_rows = stop_name_index.lookup_rows(city_name)
+            if start_rows:
+                start_coords = stops_df.iloc[start_rows[0]][['stop_lat', 'stop_lon']].tolist()
+            else:
+                start_coords = reachable_stops_info[['stop_lat', 'stop_lon']].mean().tolist()
 
             selected_trip = st.session_state.get('selected_trip', None)
-            map_city, stop_name_to_id = visualize_reachable_destinations(reachable_stops_info, start_coords=start_coords,
-                                                        selected_trip=selected_trip)
-            if map_city:
-                st_data = st_folium(map_city, width=695, height=500, returned_objects=["last_object_clicked", "last_object_clicked_tooltip"])
-
-                # Capture click event from the map
-                if st_data and "last_object_clicked_tooltip" in st_data:
-                    clicked_stop_name = st_data["last_object_clicked_tooltip"]
-                    clicked_stop_id = stop_name_to_id.get(clicked_stop_name, None)
-                    if clicked_stop_id and (st.session_state.get('selected_trip_id') != clicked_stop_id):
-                        if clicked_stop_id in reachable_stops_info['stop_id'].values:
-                            selected_trip = reachable_stops_info[reachable_stops_info['stop_id'] == clicked_stop_id].iloc[0]
-                            st.session_state['selected_trip'] = selected_trip
-                            st.session_state['selected_trip_id'] = clicked_stop_id
-                            # Set the scroll position in the session state
-                            st.session_state['scroll_position'] = st.session_state.get('scroll_position', 0)
-                            st.query_params.update({
-                                'map_center_lat': selected_trip['stop_lat'],
-                                'map_center_lon': selected_trip['stop_lon'],
-                                'scroll_position': st.session_state['scroll_position'],
-                                'selected_trip_id': clicked_stop_id  # Add selected_trip_id to query params
-                            })
-                            st.rerun()
+            with timed_stage('build_destinations_map') as stage:
+                rendered_map = build_destinations_map(st.session_state['city_name'], st.session_state['max_travel_hours'],
+                                                  st.session_state['max_changes'],
+                                                  (st.session_state['time_interval'], st.session_state.get('departure')),
+                                                  tuple(start_coords), show_isochrones, reachable_stops_info)
+                overlay = None
+                if selected_trip is not None:
+                    overlay = feature_group_script(build_selection_overlay(reachable_stops_info, start_coords,
+                                                                           selected_trip))
+                stage['rows'] = len(reachable_stops_info)
+
+            # The base map's script doesn't change between reruns, so the browser keeps it and only
+            # swaps the selection overlay and the center
+            with timed_stage('st_folium'):
+                st_data = show_map(rendered_map, 'destinations_map', overlay=overlay, width=695, height=500,
+                                   returned_objects=["last_active_drawing"],
+                                   center=get_map_center(start_coords, selected_trip))
+
+            # Capture click event from the map, the clicked feature carries its stop_id
+            clicked_feature = (st_data or {}).get("last_active_drawing") or {}
+            clicked_stop_id = clicked_feature.get('properties', {}).get('stop_id')
+            if clicked_stop_id and (st.session_state.get('selected_trip_id') != clicked_stop_id):
+                if clicked_stop_id in reachable_stops_info['stop_id'].values:
+                    selected_trip = reachable_stops_info[reachable_stops_info['stop_id'] == clicked_stop_id].iloc[0]
+                    st.session_state['selected_trip'] = selected_trip
+                    st.session_state['selected_trip_id'] = clicked_stop_id
+                    # Set the scroll position in the session state
+                    st.session_state['scroll_position'] = st.session_state.get('scroll_position', 0)
+                    st.query_params.update({
+                        'map_center_lat': selected_trip['stop_lat'],
+                        'map_center_lon': selected_trip['stop_lon'],
+                        'scroll_position': st.session_state['scroll_position'],
+                        'selected_trip_id': clicked_stop_id  # Add selected_trip_id to query params
+                    })
+                    st.rerun()
 
     with col2:
         if not reachable_stops_info.empty:
@@ -386,9 +505,11 @@ def destinations_interface_main():
                     st.rerun()  # Force rerun to update map immediately
 
 
-                for idx, row in filtered_trip_list.iterrows():
-                    if st.button(row['stop_name'], key=f"{row['stop_name']}_{idx}"):
-                        display_trip_details(idx)
+                with timed_stage('trip_list') as stage:
+                    stage['rows'] = len(filtered_trip_list)
+                    for idx, row in filtered_trip_list.iterrows():
+                        if st.button(row['stop_name'], key=f"{row['stop_name']}_{idx}"):
+                            display_trip_details(idx)
 
     with col3:
         # Display details box
@@ -0,0 +1,54 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from feed.geo import EUROPE_CRS, WGS84_CRS
+
+# Upper bounds of the isochrone bands in hours of travel
+ISOCHRONE_BANDS = [1, 2, 4, 8]
+
+# Area around a reached stop drawn as reached, in meters
+STOP_RADIUS = 15_000
+
+
+def isochrones(reachable_stops_info, bands=ISOCHRONE_BANDS, radius=STOP_RADIUS, start_coords=None):
+    """
+    Nested isochrone polygons from a reachability result with stop_lat, stop_lon and
+    travel_time_hours columns (the precomputed lookup or find_reachable_destinations).
+
+    Band b is the union of circles of radius meters around every stop reached in at most b
+    hours, plus the start when start_coords = (lat, lon) is given, so every band contains the
+    smaller ones. Returns a GeoDataFrame in EPSG:4326 with band_hours and geometry, one row per
+    non-empty band, largest first so smaller bands are drawn on top.
+    """
+    lats = reachable_stops_info['stop_lat'].to_numpy(dtype=float)
+    lons = reachable_stops_info['stop_lon'].to_numpy(dtype=float)
+    hours = reachable_stops_info['travel_time_hours'].to_numpy(dtype=float)
+    if start_coords is not None:
+        lats = np.append(lats, start_coords[0])
+        lons = np.append(lons, start_coords[1])
+        hours = np.append(hours, 0)
+
+    points = gpd.GeoSeries(gpd.points_from_xy(lons, lats), crs=WGS84_CRS).to_crs(EUROPE_CRS)
+    # Stops closer than a fraction of the radius draw practically the same circle, keep one per grid cell
+    coords = np.round(shapely.get_coordinates(points.values) / (radius / 4))
+    _, first = np.unique(np.column_stack([coords, np.searchsorted(sorted(bands), hours)]), axis=0,
+                         return_index=True)
+    circles = shapely.buffer(points.values[first], radius, quad_segs=3)
+    hours = hours[first]
+
+    # Union the stops of every ring between two bands once, then grow each band from the one below it
+    ring_index = np.searchsorted(sorted(bands), hours)
+    band_geometries = []
+    reached = shapely.Polygon()
+    for ring in range(len(bands)):
+        ring_circles = circles[ring_index == ring]
+        if len(ring_circles):
+            reached = shapely.union(reached, shapely.union_all(ring_circles))
+        band_geometries.append(reached)
+
+    result = gpd.GeoDataFrame({'band_hours': sorted(bands)}, geometry=band_geometries, crs=EUROPE_CRS)
+    result = result[~result.geometry.is_empty].to_crs(epsg=4326)
+    # About 100 m precision is plenty for bands kilometres wide and keeps the GeoJSON small
+    result.geometry = shapely.set_precision(shapely.simplify(result.geometry.values, 0.002), 0.001)
+    return result.iloc[::-1].reset_index(drop=True)
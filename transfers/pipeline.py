@@ -0,0 +1,198 @@
+import json
+import os
+import sys
+import time
+from functools import partial
+
+import pandas as pd
+
+from feed.cache import cache_dir_for, file_hash
+from transfers.precompute import precompute_routes
+from transfers.remove_multiple_stops_from_cities import remove_multiple_stops
+from transfers.remove_small_cities import population_data_path, remove_small_cities
+from transfers.route_store import ROUTE_STORE_PATH, ROUTES_CSV_PATH, build_route_store
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
+
+# Feed tables the router is built from
+ROUTER_TABLES = ['stop_times', 'trips', 'transfers', 'calendar', 'calendar_dates', 'feed_info']
+
+
+def _build_route_store(routes_csv_path, route_store_path):
+    build_route_store(pd.read_csv(routes_csv_path), route_store_path, source_path=routes_csv_path)
+
+
+def pipeline_stages(gtfs_dir=gtfs_dir, population_path=population_data_path, routes_csv_path=ROUTES_CSV_PATH,
+                    route_store_path=ROUTE_STORE_PATH, time_limit=pd.Timedelta(hours=8), max_transfers=3,
+                    travel_date=None):
+    """
+    The steps from the raw feed to the files the interface reads. A stage is a dict of its
+    name, input and output files, the parameters its outputs depend on, and the function
+    writing the outputs.
+
+    Stages run as a whole. In particular the precompute stage routes from every city after any
+    change of the router tables: one changed trip can shorten the journeys of every origin
+    through its transfers, so there are no per-origin results that are known to still hold.
+    """
+    def gtfs_path(name):
+        return os.path.join(gtfs_dir, f'{name}.txt')
+
+    return [
+        {'name': 'stop_clusters',
+         'inputs': [gtfs_path('stops'), gtfs_path('stop_times')],
+         'outputs': [gtfs_path('stop_clusters'), gtfs_path('cleaned_stops')],
+         'params': {},
+         'run': partial(remove_multiple_stops, gtfs_dir)},
+        {'name': 'large_cities',
+         'inputs': [gtfs_path('cleaned_stops'), population_path],
+         'outputs': [gtfs_path('cleaned_filtered_stops')],
+         'params': {},
+         'run': partial(remove_small_cities, gtfs_dir, population_path)},
+        {'name': 'precompute',
+         'inputs': [gtfs_path(name) for name in ROUTER_TABLES] + [gtfs_path('cleaned_filtered_stops'),
+                                                                 gtfs_path('stop_clusters')],
+         'outputs': [routes_csv_path],
+         'params': {'time_limit': str(time_limit), 'max_transfers': max_transfers,
+                    'travel_date': None if travel_date is None else str(travel_date.date())},
+         'run': partial(precompute_routes, time_limit, max_transfers, travel_date, gtfs_dir, routes_csv_path)},
+        {'name': 'route_store',
+         'inputs': [routes_csv_path],
+         'outputs': [route_store_path],
+         'params': {},
+         'run': partial(_build_route_store, routes_csv_path, route_store_path)},
+    ]
+
+
+def _in_dependency_order(stages):
+    # A stage runs after every stage writing one of its inputs
+    producers = {os.path.abspath(path): stage['name'] for stage in stages for path in stage['outputs']}
+    ordered, done = [], set()
+    pending = list(stages)
+    while pending:
+        ready = [stage for stage in pending
+                 if all(producers.get(os.path.abspath(path), stage['name']) in done | {stage['name']}
+                        for path in stage['inputs'])]
+        if not ready:
+            raise ValueError(f"Cyclic stages: {[stage['name'] for stage in pending]}")
+        for stage in ready:
+            ordered.append(stage)
+            done.add(stage['name'])
+            pending.remove(stage)
+    return ordered
+
+
+class PipelineState:
+    """
+    Content hashes of the files the pipeline read and wrote, kept in gtfs/.cache/pipeline.json.
+
+    A file is only hashed again when its size or modification time changed since it was last seen.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.files = state['files']
+            self.stages = state['stages']
+
+    def file_hash(self, path):
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        seen = self.files.get(key)
+        if seen is None or seen['size'] != stat.st_size or seen['mtime_ns'] != stat.st_mtime_ns:
+            seen = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash(path)}
+            self.files[key] = seen
+        return seen['hash']
+
+    def hashes(self, paths):
+        return {os.path.abspath(path): self.file_hash(path) for path in paths}
+
+    def is_current(self, stage, input_hashes):
+        recorded = self.stages.get(stage['name'])
+        if recorded is None or recorded['inputs'] != input_hashes or recorded['params'] != stage['params']:
+            return False
+        # Outputs edited or removed by hand are rebuilt as well
+        if not all(os.path.exists(path) for path in stage['outputs']):
+            return False
+        return recorded['outputs'] == self.hashes(stage['outputs'])
+
+    def record(self, stage, input_hashes):
+        self.stages[stage['name']] = {'inputs': input_hashes, 'outputs': self.hashes(stage['outputs']),
+                                      'params': stage['params']}
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self.files, 'stages': self.stages}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def _changed_inputs(state, stage, changed):
+    # Existing inputs rewritten in this run or different from the last run of the stage
+    recorded = state.stages.get(stage['name'], {}).get('inputs', {})
+    stale = []
+    for path in stage['inputs']:
+        key = os.path.abspath(path)
+        if not os.path.exists(path):
+            continue
+        if key in changed or (key in recorded and recorded[key] != state.file_hash(path)):
+            stale.append(path)
+    return stale
+
+
+def run_pipeline(stages=None, state_path=None, force=False):
+    """
+    Run the stages in dependency order, skipping every stage whose inputs and parameters are the
+    same as on its last run and whose outputs are untouched. A stage with a missing input keeps
+    its existing outputs, so e.g. the filtered stops of an earlier run are used without the
+    GeoNames dump. It is warned about when inputs of such a stage changed since its outputs
+    were written, as those outputs are then stale. Returns the names of the stages that ran.
+    """
+    stages = pipeline_stages() if stages is None else stages
+    state = PipelineState(state_path or os.path.join(cache_dir_for(gtfs_dir), 'pipeline.json'))
+
+    ran = []
+    # Outputs rewritten with a new content in this run
+    changed = set()
+    for stage in _in_dependency_order(stages):
+        missing = [path for path in stage['inputs'] if not os.path.exists(path)]
+        if missing:
+            if not all(os.path.exists(path) for path in stage['outputs']):
+                raise FileNotFoundError(f"{stage['name']} needs {', '.join(missing)}")
+            stale_inputs = _changed_inputs(state, stage, changed)
+            if stale_inputs:
+                print(f"{stage['name']}: WARNING {', '.join(stale_inputs)} changed but {', '.join(missing)} "
+                      f"is missing, {', '.join(stage['outputs'])} may be stale")
+            else:
+                print(f"{stage['name']}: missing {', '.join(missing)}, keeping the existing outputs")
+            continue
+
+        input_hashes = state.hashes(stage['inputs'])
+        if not force and state.is_current(stage, input_hashes):
+            print(f"{stage['name']}: up to date")
+            continue
+
+        print(f"{stage['name']}: running")
+        start = time.perf_counter()
+        previous_outputs = state.stages.get(stage['name'], {}).get('outputs', {})
+        stage['run']()
+        state.record(stage, input_hashes)
+        changed.update(path for path, digest in state.stages[stage['name']]['outputs'].items()
+                       if previous_outputs.get(path) != digest)
+        ran.append(stage['name'])
+        print(f"{stage['name']}: done in {time.perf_counter() - start:.1f} s")
+    return ran
+
+
+if __name__ == '__main__':
+    # python -m transfers.pipeline [--force] [travel date, e.g. 2024-07-15]
+    args = [arg for arg in sys.argv[1:] if arg != '--force']
+    travel_date = pd.Timestamp(args[0]) if args else None
+    run_pipeline(pipeline_stages(travel_date=travel_date), force='--force' in sys.argv[1:])
@@ -0,0 +1,150 @@
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from feed.cache import read_gtfs
+from feed.calendar import ServiceCalendar
+from feed.names import StopNameIndex
+from transfers.raptor import INFINITY, Raptor
+from transfers.route_sink import RouteSink, compact_routes
+from transfers.stop_clusters import cluster_members, load_stop_clusters
+from transfers.timetable import Timetable
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
+
+# Define time intervals (seconds since the start of the service day)
+time_intervals = {
+    'early_morning': (0, 6 * 3600),
+    'morning': (6 * 3600, 10 * 3600),
+    'midday': (10 * 3600, 14 * 3600),
+    'afternoon': (14 * 3600, 18 * 3600),
+    'late_afternoon': (18 * 3600, 21 * 3600),
+    'night': (21 * 3600, 24 * 3600),
+}
+
+# Set in every worker by _init_worker
+_router = None
+_origin_stops = None
+_time_limit = None
+_max_transfers = None
+
+
+def build_router(gtfs_dir=gtfs_dir, travel_date=None):
+    """Router over the feed in gtfs_dir, only with the trips running on travel_date when one is given."""
+    timetable = Timetable.from_stop_times(read_gtfs('stop_times', gtfs_dir, categorical=True))
+    trips_df = read_gtfs('trips', gtfs_dir)
+    raptor = Raptor.from_timetable(timetable, trips_df, read_gtfs('transfers', gtfs_dir))
+    if travel_date is None:
+        return raptor
+
+    service_calendar = ServiceCalendar.from_feed(read_gtfs('calendar', gtfs_dir), read_gtfs('calendar_dates', gtfs_dir),
+                                                 read_gtfs('feed_info', gtfs_dir))
+    trip_services = service_calendar.service_codes(
+        trips_df.set_index('trip_id')['service_id'].reindex(timetable.trip_ids))
+    return raptor.restricted_to(service_calendar.is_active(trip_services, travel_date))
+
+
+def _init_worker(router_dir, origin_stops, time_limit, max_transfers):
+    # Attach to the published router, the arrays stay in the shared page cache instead of being copied
+    global _router, _origin_stops, _time_limit, _max_transfers
+    _router = Raptor.load(router_dir)
+    _origin_stops = origin_stops
+    _time_limit = time_limit
+    _max_transfers = max_transfers
+
+
+def _process_origin(origin):
+    # One profile query per departure interval, returned as plain arrays to keep the result pickle small.
+    # Every non-dominated (travel time, transfers) journey to a stop is kept, so a filter on fewer
+    # changes still finds the fastest journey using at most that many.
+    stop_idx, travel_time, transfer_count, arrival_time, interval_idx = [], [], [], [], []
+    for interval, window in enumerate(time_intervals.values()):
+        stops, departures, arrivals, transfers = _router.profile(_origin_stops[origin], window, _max_transfers,
+                                                                  time_limit=_time_limit)
+        stops, transfers, travel, arrivals = _fastest_journeys(stops, transfers, arrivals - departures, arrivals,
+                                                               _router.timetable.n_stops, _max_transfers)
+        stop_idx.append(stops)
+        travel_time.append(travel)
+        transfer_count.append(transfers)
+        arrival_time.append(arrivals)
+        interval_idx.append(np.full(len(stops), interval))
+    return origin, [np.concatenate(values) for values in
+                    (stop_idx, travel_time, transfer_count, arrival_time, interval_idx)]
+
+
+def _fastest_journeys(stops, transfers, travel, arrivals, n_stops, max_transfers):
+    # Shortest journey of every (transfers, stop), ties to the earliest arrival
+    order = np.lexsort((arrivals, travel, stops, transfers))
+    stops, transfers, travel, arrivals = stops[order], transfers[order], travel[order], arrivals[order]
+    first = np.ones(len(stops), dtype=bool)
+    first[1:] = (stops[1:] != stops[:-1]) | (transfers[1:] != transfers[:-1])
+    best_travel = np.full((max_transfers + 1, n_stops), INFINITY, dtype=np.int64)
+    best_arrival = np.full((max_transfers + 1, n_stops), INFINITY, dtype=np.int64)
+    best_travel[transfers[first], stops[first]] = travel[first]
+    best_arrival[transfers[first], stops[first]] = arrivals[first]
+
+    # Only keep the ones faster than every journey with fewer transfers
+    fewer_transfers_best = np.minimum.accumulate(np.vstack([np.full(n_stops, INFINITY), best_travel[:-1]]))
+    transfers, stops = np.nonzero(best_travel < fewer_transfers_best)
+    return stops, transfers, best_travel[transfers, stops], best_arrival[transfers, stops]
+
+
+def precompute_routes(time_limit, max_transfers, travel_date=None, gtfs_dir=gtfs_dir, output_path=None,
+                      processes=None):
+    """
+    Reachable stops from every city of cleaned_filtered_stops in every departure interval, written
+    to output_path (gtfs_dir/precomputed_routes.csv by default). Routes to stops without
+    coordinates are left out.
+
+    The router is built once and published as memory-mapped files in a temporary directory.
+    Workers attach to it when they start and are only sent the index of the origin city.
+    Their results are streamed to chunk files next to output_path and compacted at the end.
+    """
+    stops_df = read_gtfs('cleaned_filtered_stops', gtfs_dir)  # Use pre-filtered stops
+    raptor = build_router(gtfs_dir, travel_date)
+    timetable = raptor.timetable
+    limit = None if time_limit is None else int(time_limit.total_seconds())
+
+    cities = stops_df['stop_name'].unique()
+    # Every stop whose name contains all words of the city name, resolved through the name index,
+    # and the other stops of their cities when the stop to city mapping exists
+    stop_name_index = StopNameIndex(stops_df['stop_id'], stops_df['stop_name'])
+    stop_clusters = load_stop_clusters(gtfs_dir)
+    origin_stops = [timetable.stop_indices(cluster_members(stop_name_index.lookup(city), stop_clusters))
+                    for city in cities]
+
+    # Stop info indexed like the timetable stops, stops missing from the filtered list get no coordinates
+    stop_info = stops_df.drop_duplicates(subset=['stop_id']).set_index('stop_id')[['stop_name', 'stop_lat', 'stop_lon']]
+    stop_info = stop_info.reindex(timetable.stop_ids).reset_index(names='stop_id')
+
+    output_path = output_path or os.path.join(gtfs_dir, 'precomputed_routes.csv')
+    sink_dir = f'{output_path}.chunks'
+    shutil.rmtree(sink_dir, ignore_errors=True)
+    sink = RouteSink(sink_dir, cities, list(time_intervals), stop_info)
+
+    with tempfile.TemporaryDirectory() as router_dir:
+        raptor.save(router_dir)
+        initargs = (router_dir, origin_stops, limit, max_transfers)
+        with Pool(processes=processes or cpu_count(), initializer=_init_worker, initargs=initargs) as pool:
+            results = pool.imap_unordered(_process_origin, range(len(cities)), chunksize=4)
+            for origin, columns in tqdm(results, total=len(cities), desc="Processing all cities"):
+                sink.write(origin, columns)
+    sink.close()
+
+    compact_routes(sink_dir, output_path)
+    return output_path
+
+
+if __name__ == '__main__':
+    # python -m transfers.precompute [travel date, e.g. 2024-07-15]
+    travel_date = pd.Timestamp(sys.argv[1]) if len(sys.argv) > 1 else None
+    output_path = precompute_routes(pd.Timedelta(hours=8), 3, travel_date)
+    print(f"Precomputed routes saved to {output_path}")
@@ -0,0 +1,267 @@
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import urlopen
+
+import pandas as pd
+
+from feed.cache import read_gtfs
+from feed.calendar import ServiceCalendar
+from feed.names import StopNameIndex, normalize_name
+from transfers.precompute import build_router, time_intervals
+from transfers.raptor import departing_between
+from transfers.route_store import ROUTE_STORE_PATH, RouteStore
+from transfers.stop_clusters import cluster_ids, cluster_members, load_stop_clusters
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
+
+DEFAULT_PORT = 8765
+
+# Routers of this many travel dates are kept besides the one for the whole feed period
+ROUTERS_PER_DATE = 4
+
+RESULT_COLUMNS = ['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'travel_minutes', 'transfer_count',
+                  'departure_time', 'arrival_time']
+
+
+class QueryError(ValueError):
+    """A query the service can't answer, sent back as a 4xx response."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_window(window):
+    """(start, end) seconds of a departure window: a name of time_intervals, 'all_day' or 'HH:MM-HH:MM'."""
+    if window == 'all_day':
+        return 0, 24 * 3600
+    if window in time_intervals:
+        return time_intervals[window]
+    try:
+        start, end = (pd.Timedelta(f'{part.strip()}:00') for part in window.split('-'))
+    except ValueError:
+        raise QueryError(f"Unknown departure window {window!r}")
+    return int(start.total_seconds()), int(end.total_seconds())
+
+
+class QueryService:
+    """
+    Reachability queries over one feed, loaded once and shared by every request.
+
+    Queries run on a pool of worker threads. Identical queries arriving while one is being
+    computed wait for that computation instead of starting their own, and the last
+    cache_size results are kept, least recently used dropped first.
+    """
+
+    def __init__(self, gtfs_dir=gtfs_dir, route_store_path=ROUTE_STORE_PATH, workers=4, cache_size=256):
+        self.gtfs_dir = gtfs_dir
+        self.stops_df = read_gtfs('stops', gtfs_dir)
+        self.stop_name_index = StopNameIndex(self.stops_df['stop_id'], self.stops_df['stop_name'])
+        self.stop_clusters = load_stop_clusters(gtfs_dir)
+        self.stop_info = self.stops_df.drop_duplicates(subset=['stop_id']).set_index('stop_id')[
+            ['stop_name', 'stop_lat', 'stop_lon']]
+        # The timetable is loaded once, routers of a travel date only keep the trips running on it
+        self.router = build_router(gtfs_dir)
+        self.service_calendar = ServiceCalendar.from_feed(read_gtfs('calendar', gtfs_dir),
+                                                          read_gtfs('calendar_dates', gtfs_dir),
+                                                          read_gtfs('feed_info', gtfs_dir))
+        self.trip_services = self.service_calendar.service_codes(
+            read_gtfs('trips', gtfs_dir).set_index('trip_id')['service_id'].reindex(self.router.timetable.trip_ids))
+        self.date_routers = OrderedDict()
+        self.date_locks = {}
+        self.route_store = RouteStore(route_store_path) if os.path.exists(route_store_path) else None
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.router_lock = threading.Lock()
+        self.in_flight = {}
+        self.results = OrderedDict()
+        self.stats = {'queries': 0, 'cache_hits': 0, 'coalesced': 0, 'computed': 0}
+
+    def _router(self, travel_date):
+        if travel_date is None:
+            return self.router
+        with self.router_lock:
+            if travel_date in self.date_routers:
+                self.date_routers.move_to_end(travel_date)
+                return self.date_routers[travel_date]
+            date_lock = self.date_locks.setdefault(travel_date, threading.Lock())
+
+        # One restriction per date, queries for the same date wait for it and those for other dates don't
+        with date_lock:
+            with self.router_lock:
+                router = self.date_routers.get(travel_date)
+            if router is None:
+                active = self.service_calendar.is_active(self.trip_services, pd.Timestamp(travel_date))
+                router = self.router.restricted_to(active)
+                with self.router_lock:
+                    self.date_routers[travel_date] = router
+                    self.date_locks.pop(travel_date, None)
+                    if len(self.date_routers) > ROUTERS_PER_DATE:
+                        self.date_routers.popitem(last=False)
+        return router
+
+    def submit(self, kind, **params):
+        """Future of a query, shared with an identical one in flight or answered from the result cache."""
+        key = (kind, tuple(sorted(params.items())))
+        with self.lock:
+            self.stats['queries'] += 1
+            if key in self.results:
+                self.stats['cache_hits'] += 1
+                self.results.move_to_end(key)
+                future = Future()
+                future.set_result(self.results[key])
+                return future
+            if key in self.in_flight:
+                self.stats['coalesced'] += 1
+                return self.in_flight[key]
+            future = self.pool.submit(getattr(self, f'_{kind}'), **params)
+            self.in_flight[key] = future
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key, future):
+        with self.lock:
+            self.in_flight.pop(key, None)
+            if future.exception() is None:
+                self.stats['computed'] += 1
+                self.results[key] = future.result()
+                if len(self.results) > self.cache_size:
+                    self.results.popitem(last=False)
+
+    def reachable(self, origin, max_hours, max_changes, window='all_day', travel_date=None, by_city=False):
+        """
+        Fastest journey to every stop reachable from the stops of origin (a city or stop name)
+        within max_hours and max_changes, leaving in window, as a list of dicts.
+        """
+        return self.submit('reachable', origin=normalize_name(origin), max_hours=float(max_hours),
+                           max_changes=int(max_changes), window=window, travel_date=travel_date,
+                           by_city=bool(by_city)).result()
+
+    def precomputed(self, origin, max_hours, max_changes, window='all_day'):
+        """Routes of the precomputed route store, like the destinations page reads them."""
+        return self.submit('precomputed', origin=normalize_name(origin), max_hours=float(max_hours),
+                           max_changes=int(max_changes), window=window).result()
+
+    def suggest(self, query, limit=10):
+        """Stop names for a partly typed origin."""
+        stop_ids = self.stop_name_index.search(query, limit)
+        return list(dict.fromkeys(self.stop_name_index.names(stop_ids)))
+
+    def _origin_stop_ids(self, origin):
+        stop_ids = self.stop_name_index.lookup(origin)
+        if not stop_ids:
+            raise QueryError(f"No stop matches {origin!r}", status=404)
+        return cluster_members(stop_ids, self.stop_clusters)
+
+    def _reachable(self, origin, max_hours, max_changes, window, travel_date, by_city):
+        origin_stop_ids = self._origin_stop_ids(origin)
+        start, end = parse_window(window)
+        time_limit = pd.Timedelta(hours=max_hours)
+        profiles = self._router(travel_date).reachable_profiles(origin_stop_ids, max_changes, (start, end), time_limit)
+        reachable = departing_between(profiles, pd.Timedelta(seconds=start), pd.Timedelta(seconds=end))
+        reachable = reachable[~reachable['stop_id'].isin(origin_stop_ids)]
+        reachable = reachable.join(self.stop_info, on='stop_id').dropna(subset=['stop_lat', 'stop_lon'])
+        if by_city:
+            reachable = reachable.assign(city=cluster_ids(reachable['stop_id'], self.stop_clusters))
+            reachable = reachable.drop_duplicates(subset=['city'])
+        return _records(reachable.assign(travel_minutes=reachable['travel_time'].dt.total_seconds() / 60))
+
+    def _precomputed(self, origin, max_hours, max_changes, window):
+        if self.route_store is None:
+            raise QueryError("No precomputed route store", status=404)
+        routes = self.route_store.lookup(origin, max_hours, max_changes, window)
+        return _records(routes.assign(travel_minutes=routes['travel_time_hours'] * 60,
+                                      departure_time=routes['arrival_time'] - routes['travel_time']))
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def _records(routes_df):
+    # JSON-ready rows, times as seconds since the start of the service day
+    routes_df = routes_df.reindex(columns=RESULT_COLUMNS)
+    for column in ('departure_time', 'arrival_time'):
+        routes_df[column] = pd.to_timedelta(routes_df[column]).dt.total_seconds().astype('Int64')
+    routes_df['travel_minutes'] = routes_df['travel_minutes'].round(1)
+    return json.loads(routes_df.to_json(orient='records'))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET /reachable, /precomputed and /suggest with query parameters, and /stats. Answers are
+    JSON, errors are {"error": message} with a 4xx status.
+    """
+
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/reachable':
+                body = self.service.reachable(params['origin'], params.get('max_hours', 8),
+                                              params.get('max_changes', 3), params.get('window', 'all_day'),
+                                              params.get('date'), params.get('by_city') == '1')
+            elif url.path == '/precomputed':
+                body = self.service.precomputed(params['origin'], params.get('max_hours', 8),
+                                                params.get('max_changes', 3), params.get('window', 'all_day'))
+            elif url.path == '/suggest':
+                body = self.service.suggest(params['q'], int(params.get('limit', 10)))
+            elif url.path == '/stats':
+                body = dict(self.service.stats, cached_results=len(self.service.results))
+            else:
+                raise QueryError(f"Unknown path {url.path}", status=404)
+        except QueryError as error:
+            self._send(error.status, {'error': str(error)})
+        except KeyError as error:
+            self._send(400, {'error': f"Missing parameter {error.args[0]}"})
+        except ValueError as error:
+            self._send(400, {'error': str(error)})
+        else:
+            self._send(200, body)
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Quiet by default, the interface's own timings cover the latency
+        pass
+
+
+def make_server(service, host='127.0.0.1', port=DEFAULT_PORT):
+    """HTTP server answering with service, one thread per connection. Call serve_forever() to start it."""
+    handler = type('BoundQueryHandler', (QueryHandler,), {'service': service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def fetch(base_url, path, **params):
+    """Client side: the JSON answer of the service at base_url, e.g. fetch(url, 'reachable', origin='Berlin')."""
+    params = {name: value for name, value in params.items() if value is not None}
+    with urlopen(f"{base_url.rstrip('/')}/{path}?{urlencode(params)}") as response:
+        return json.load(response)
+
+
+if __name__ == '__main__':
+    # python -m transfers.query_service [port]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    server = make_server(QueryService(), port=port)
+    print(f"Serving reachability queries on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
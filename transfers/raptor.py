@@ -0,0 +1,494 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from feed.cache import load_arrays, save_arrays
+from transfers.timetable import Timetable
+
+# Minimum time needed to change buses at the same stop, used when transfers.txt doesn't give one
+MIN_TRANSFER_TIME = 10 * 60
+
+INFINITY = np.iinfo(np.int32).max
+
+
+def _stop_patterns(pattern_stops, n_stops):
+    # Stop -> [(pattern, position of the stop in the pattern)]
+    stop_patterns = [[] for _ in range(n_stops)]
+    for pattern, stops in enumerate(pattern_stops):
+        for position, stop in enumerate(stops.tolist()):
+            stop_patterns[stop].append((pattern, position))
+    return stop_patterns
+
+
+class Raptor:
+    """
+    Round-based earliest-arrival routing (RAPTOR) on top of a compiled Timetable.
+
+    Trips with the same route and stop sequence are grouped into patterns, split further so that
+    trips of a pattern never overtake each other. Round k scans every pattern touching a stop
+    improved in round k - 1, so a query with max_transfers = n does n + 1 linear scans.
+    """
+
+    def __init__(self, timetable, pattern_trips, pattern_stops, pattern_departures, pattern_arrivals,
+                 pattern_routes, stop_patterns, transfer_times, forbidden_transfers):
+        self.timetable = timetable
+        self.pattern_trips = pattern_trips
+        self.pattern_stops = pattern_stops
+        self.pattern_departures = pattern_departures
+        self.pattern_arrivals = pattern_arrivals
+        self.pattern_routes = pattern_routes
+        self.stop_patterns = stop_patterns
+        self.transfer_times = transfer_times
+        self.forbidden_transfers = forbidden_transfers
+
+    @classmethod
+    def from_timetable(cls, timetable, trips_df=None, transfers_df=None, min_transfer_time=MIN_TRANSFER_TIME):
+        # Route of every trip, only needed to honour route-to-route rules in transfers.txt
+        if trips_df is not None:
+            route_of_trip = trips_df.set_index('trip_id')['route_id'].astype(str).reindex(timetable.trip_ids).to_numpy()
+        else:
+            route_of_trip = np.full(timetable.n_trips, None, dtype=object)
+
+        groups = {}
+        for trip in range(timetable.n_trips):
+            start, end = timetable.trip_bounds(trip)
+            key = (route_of_trip[trip], timetable.st_stop[start:end].tobytes())
+            groups.setdefault(key, []).append(trip)
+
+        pattern_trips = []
+        pattern_stops = []
+        pattern_departures = []
+        pattern_arrivals = []
+        pattern_routes = []
+        for (route_id, _), trips in groups.items():
+            start, end = timetable.trip_bounds(trips[0])
+            stops = timetable.st_stop[start:end]
+            rows = np.array([timetable.trip_offsets[trip] for trip in trips])[:, None] + np.arange(end - start)
+            departures = timetable.st_departure[rows]
+            arrivals = timetable.st_arrival[rows]
+
+            # Split into FIFO patterns: a trip joins the first pattern whose last trip it never overtakes
+            order = np.argsort(departures[:, 0], kind='stable')
+            fifo_groups = []
+            for row in order:
+                for fifo in fifo_groups:
+                    last = fifo[-1]
+                    if (departures[last] <= departures[row]).all() and (arrivals[last] <= arrivals[row]).all():
+                        fifo.append(row)
+                        break
+                else:
+                    fifo_groups.append([row])
+
+            for fifo in fifo_groups:
+                pattern_trips.append(np.array(trips)[fifo])
+                pattern_stops.append(stops)
+                pattern_departures.append(departures[fifo])
+                pattern_arrivals.append(arrivals[fifo])
+                pattern_routes.append(route_id)
+
+        stop_patterns = _stop_patterns(pattern_stops, timetable.n_stops)
+
+        transfer_times = np.full(timetable.n_stops, min_transfer_time, dtype=np.int32)
+        forbidden_transfers = set()
+        if transfers_df is not None:
+            same_stop = transfers_df[transfers_df['from_stop_id'] == transfers_df['to_stop_id']]
+            same_stop = same_stop[same_stop['from_stop_id'].isin(timetable.stop_index)]
+
+            # transfer_type 2: explicit minimum transfer time at this stop
+            timed = same_stop[(same_stop['transfer_type'] == 2) & same_stop['min_transfer_time'].notna()]
+            for stop_id, seconds in zip(timed['from_stop_id'], timed['min_transfer_time']):
+                transfer_times[timetable.stop_index[stop_id]] = int(seconds)
+
+            # transfer_type 3: no transfer possible between the two routes at this stop
+            impossible = same_stop[same_stop['transfer_type'] == 3]
+            for stop_id, from_route, to_route in zip(impossible['from_stop_id'], impossible['from_route_id'],
+                                                     impossible['to_route_id']):
+                forbidden_transfers.add((timetable.stop_index[stop_id], str(from_route), str(to_route)))
+
+        return cls(timetable, pattern_trips, pattern_stops, pattern_departures, pattern_arrivals, pattern_routes,
+                   stop_patterns, transfer_times, forbidden_transfers)
+
+    def restricted_to(self, active_trips):
+        """
+        Copy of the router that only uses the trips where the boolean mask active_trips
+        (indexed like timetable.trip_ids) is set, e.g. the trips running on one service day.
+        """
+        pattern_trips = []
+        pattern_stops = []
+        pattern_departures = []
+        pattern_arrivals = []
+        pattern_routes = []
+        for pattern, trips in enumerate(self.pattern_trips):
+            keep = active_trips[trips]
+            if not keep.any():
+                continue
+            # A subset of a FIFO pattern is still FIFO
+            pattern_trips.append(trips[keep])
+            pattern_stops.append(self.pattern_stops[pattern])
+            pattern_departures.append(self.pattern_departures[pattern][keep])
+            pattern_arrivals.append(self.pattern_arrivals[pattern][keep])
+            pattern_routes.append(self.pattern_routes[pattern])
+
+        return Raptor(self.timetable, pattern_trips, pattern_stops, pattern_departures, pattern_arrivals,
+                      pattern_routes, _stop_patterns(pattern_stops, self.timetable.n_stops), self.transfer_times,
+                      self.forbidden_transfers)
+
+    def save(self, directory):
+        """Write the router as flat arrays (patterns concatenated, CSR offsets) next to its timetable."""
+        self.timetable.save(os.path.join(directory, 'timetable'))
+
+        lengths = np.array([len(stops) for stops in self.pattern_stops], dtype=np.int64)
+        trip_counts = np.array([len(trips) for trips in self.pattern_trips], dtype=np.int64)
+        route_codes, route_ids = pd.factorize(pd.Series(self.pattern_routes, dtype=object), use_na_sentinel=False)
+        forbidden = sorted(self.forbidden_transfers, key=str)
+
+        save_arrays(directory, {
+            'pattern_stop_offsets': np.concatenate([[0], np.cumsum(lengths)]),
+            'pattern_trip_offsets': np.concatenate([[0], np.cumsum(trip_counts)]),
+            'pattern_time_offsets': np.concatenate([[0], np.cumsum(lengths * trip_counts)]),
+            'pattern_stops': np.concatenate(self.pattern_stops).astype(np.int32),
+            'pattern_trips': np.concatenate(self.pattern_trips).astype(np.int32),
+            'pattern_departures': np.concatenate([times.ravel() for times in self.pattern_departures]),
+            'pattern_arrivals': np.concatenate([times.ravel() for times in self.pattern_arrivals]),
+            'pattern_route_codes': route_codes,
+            'route_ids': np.array(['' if route_id is None else route_id for route_id in route_ids]),
+            'transfer_times': self.transfer_times,
+            'forbidden_stops': np.array([stop for stop, _, _ in forbidden], dtype=np.int32),
+            'forbidden_from_routes': np.array([from_route for _, from_route, _ in forbidden], dtype=str),
+            'forbidden_to_routes': np.array([to_route for _, _, to_route in forbidden], dtype=str),
+        })
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Router written by save(). The per-pattern arrays are views into memory-mapped files,
+        so every process attaching to the same directory shares one copy of the timetable.
+        """
+        timetable = Timetable.load(os.path.join(directory, 'timetable'), mmap_mode)
+        arrays = load_arrays(directory, mmap_mode)
+
+        stop_offsets = arrays['pattern_stop_offsets']
+        trip_offsets = arrays['pattern_trip_offsets']
+        time_offsets = arrays['pattern_time_offsets']
+        route_ids = [route_id or None for route_id in arrays['route_ids'].tolist()]
+
+        pattern_trips = []
+        pattern_stops = []
+        pattern_departures = []
+        pattern_arrivals = []
+        pattern_routes = []
+        for pattern in range(len(stop_offsets) - 1):
+            n_stops = stop_offsets[pattern + 1] - stop_offsets[pattern]
+            n_trips = trip_offsets[pattern + 1] - trip_offsets[pattern]
+            times = slice(time_offsets[pattern], time_offsets[pattern + 1])
+            pattern_trips.append(arrays['pattern_trips'][trip_offsets[pattern]:trip_offsets[pattern + 1]])
+            pattern_stops.append(arrays['pattern_stops'][stop_offsets[pattern]:stop_offsets[pattern + 1]])
+            pattern_departures.append(arrays['pattern_departures'][times].reshape(n_trips, n_stops))
+            pattern_arrivals.append(arrays['pattern_arrivals'][times].reshape(n_trips, n_stops))
+            pattern_routes.append(route_ids[arrays['pattern_route_codes'][pattern]])
+
+        forbidden_transfers = set(zip(arrays['forbidden_stops'].tolist(), arrays['forbidden_from_routes'].tolist(),
+                                      arrays['forbidden_to_routes'].tolist()))
+        return cls(timetable, pattern_trips, pattern_stops, pattern_departures, pattern_arrivals, pattern_routes,
+                   _stop_patterns(pattern_stops, timetable.n_stops), arrays['transfer_times'], forbidden_transfers)
+
+    def arrival_bags(self, origin_stops, departure_window, max_transfers, time_limit=None):
+        """
+        Pareto bags of (arrival, transfers) labels for every stop when leaving one of origin_stops
+        (timetable stop indices) with a first departure inside departure_window = (start, end) seconds.
+
+        Returns two int32 arrays of shape (max_transfers + 1, n_stops): arrival[k, s] is the arrival
+        at stop s with exactly k transfers and departure[k, s] the first departure of that journey.
+        Both are INFINITY unless the label beats every label with fewer transfers, so each column
+        only holds non-dominated labels. Labels that can't beat the current best arrival at a stop
+        are pruned while scanning.
+        """
+        window_start, window_end = departure_window
+        n_stops = self.timetable.n_stops
+        arrival_bound = INFINITY if time_limit is None else window_end + time_limit
+
+        bag_arrival = np.full((max_transfers + 1, n_stops), INFINITY, dtype=np.int32)
+        bag_departure = np.full((max_transfers + 1, n_stops), INFINITY, dtype=np.int32)
+        best_arrival = [INFINITY] * n_stops
+
+        # Labels of the previous round: arrival time, first departure and the route we arrived with
+        previous_arrival = [INFINITY] * n_stops
+        previous_departure = [INFINITY] * n_stops
+        previous_route = [None] * n_stops
+        for stop in origin_stops:
+            previous_arrival[stop] = window_start
+            best_arrival[stop] = window_start
+        marked = set(origin_stops)
+
+        for round_number in range(max_transfers + 1):
+            # Collect patterns serving a marked stop with the earliest position to start scanning from
+            queue = {}
+            for stop in marked:
+                for pattern, position in self.stop_patterns[stop]:
+                    if position < queue.get(pattern, INFINITY):
+                        queue[pattern] = position
+
+            current_arrival = list(previous_arrival)
+            current_departure = list(previous_departure)
+            current_route = list(previous_route)
+            marked = set()
+
+            for pattern, first_position in queue.items():
+                stops = self.pattern_stops[pattern]
+                departures = self.pattern_departures[pattern]
+                arrivals = self.pattern_arrivals[pattern]
+                route = self.pattern_routes[pattern]
+                trip = -1
+                journey_departure = INFINITY
+
+                for position in range(first_position, len(stops)):
+                    stop = stops[position]
+
+                    if trip >= 0:
+                        arrival = int(arrivals[trip, position])
+                        if arrival < best_arrival[stop] and arrival <= arrival_bound:
+                            best_arrival[stop] = arrival
+                            current_arrival[stop] = arrival
+                            current_departure[stop] = journey_departure
+                            current_route[stop] = route
+                            marked.add(stop)
+
+                    # Could we board this pattern earlier at this stop?
+                    ready = previous_arrival[stop]
+                    if ready == INFINITY:
+                        continue
+                    if round_number > 0:
+                        # Origin stops are only boarded from in the first round
+                        if previous_departure[stop] == INFINITY:
+                            continue
+                        if (stop, previous_route[stop], route) in self.forbidden_transfers:
+                            continue
+                        ready += int(self.transfer_times[stop])
+                    if trip >= 0 and ready > departures[trip, position]:
+                        continue
+
+                    column = departures[:, position] if trip < 0 else departures[:trip, position]
+                    candidate = int(column.searchsorted(ready))
+                    if candidate >= len(column):
+                        continue
+                    if round_number == 0:
+                        if column[candidate] > window_end:
+                            continue
+                        journey_departure = int(column[candidate])
+                    else:
+                        journey_departure = previous_departure[stop]
+                    trip = candidate
+
+            # Every stop improved in this round gets a label with round_number transfers
+            improved = list(marked)
+            bag_arrival[round_number, improved] = [current_arrival[stop] for stop in improved]
+            bag_departure[round_number, improved] = [current_departure[stop] for stop in improved]
+
+            previous_arrival = current_arrival
+            previous_departure = current_departure
+            previous_route = current_route
+            if not marked:
+                break
+
+        bag_arrival[:, list(origin_stops)] = INFINITY
+        bag_departure[:, list(origin_stops)] = INFINITY
+        return bag_arrival, bag_departure
+
+    def earliest_arrivals(self, origin_stops, departure_window, max_transfers, time_limit=None):
+        """
+        Earliest arrival at every stop when leaving one of origin_stops (timetable stop indices)
+        with a first departure inside departure_window = (start, end) seconds.
+
+        Returns three arrays indexed by stop: arrival time, departure time from the origin of the
+        journey reaching that arrival, and the number of transfers used (-1 where unreachable).
+        """
+        bag_arrival, bag_departure = self.arrival_bags(origin_stops, departure_window, max_transfers, time_limit)
+
+        # The label with the most transfers in a bag is the one with the earliest arrival
+        reached = bag_arrival < INFINITY
+        transfers = np.where(reached.any(axis=0), max_transfers - np.argmax(reached[::-1], axis=0), -1)
+        stops = np.arange(bag_arrival.shape[1])
+        last = np.maximum(transfers, 0)
+        return (bag_arrival[last, stops].astype(np.int64), bag_departure[last, stops].astype(np.int64),
+                transfers.astype(np.int32))
+
+    def reachable_stops(self, origin_stop_ids, max_transfers, departure_window=(0, 24 * 3600), time_limit=None):
+        """
+        Reachable stops as a DataFrame with the columns of all_reachable_stops
+        (stop_id, travel_time, transfer_count) plus departure_time and arrival_time.
+        time_limit is a pd.Timedelta or None.
+        """
+        limit = None if time_limit is None else int(time_limit.total_seconds())
+        origin_stops = self.timetable.stop_indices(origin_stop_ids)
+        arrival, departure, transfers = self.earliest_arrivals(origin_stops, departure_window, max_transfers,
+                                                               time_limit=limit)
+
+        reached = transfers >= 0
+        travel_time = arrival - departure
+        if limit is not None:
+            reached &= travel_time <= limit
+        return pd.DataFrame({
+            'stop_id': self.timetable.stop_ids[reached],
+            'travel_time': pd.to_timedelta(travel_time[reached], unit='s'),
+            'transfer_count': transfers[reached],
+            'departure_time': pd.to_timedelta(departure[reached], unit='s'),
+            'arrival_time': pd.to_timedelta(arrival[reached], unit='s'),
+        })
+
+    def profile(self, origin_stops, departure_window, max_transfers, time_limit=None):
+        """
+        Pareto set of (departure, arrival, transfers) journeys to every stop when leaving one of
+        origin_stops with a first departure inside departure_window = (start, end) seconds.
+
+        Runs the rounds once per distinct departure from the origins, latest first, keeping the
+        labels of later departures as bounds (rRAPTOR), so each run only explores what leaving
+        earlier improves. Returns four arrays with one entry per Pareto journey: stop, departure,
+        arrival and transfers, sorted by stop and departure.
+        """
+        window_start, window_end = departure_window
+        n_stops = self.timetable.n_stops
+        origin_set = set(origin_stops)
+
+        # Every first departure from the origins inside the window
+        departure_times = set()
+        for stop in origin_set:
+            for pattern, position in self.stop_patterns[stop]:
+                column = self.pattern_departures[pattern][:, position]
+                departure_times.update(column[(column >= window_start) & (column <= window_end)].tolist())
+
+        # Labels per round, index k + 1 holding round k: arrival, first departure and the route arrived with.
+        # Index 0 holds the origins; their departure stays INFINITY so they are only boarded from in round 0.
+        labels_arrival = [[INFINITY] * n_stops for _ in range(max_transfers + 2)]
+        labels_departure = [[INFINITY] * n_stops for _ in range(max_transfers + 2)]
+        labels_route = [[None] * n_stops for _ in range(max_transfers + 2)]
+        journeys = []
+
+        for departure_time in sorted(departure_times, reverse=True):
+            for stop in origin_set:
+                labels_arrival[0][stop] = departure_time
+            marked = set(origin_set)
+
+            for round_number in range(max_transfers + 1):
+                previous_arrival = labels_arrival[round_number]
+                previous_departure = labels_departure[round_number]
+                previous_route = labels_route[round_number]
+                current_arrival = labels_arrival[round_number + 1]
+                current_departure = labels_departure[round_number + 1]
+                current_route = labels_route[round_number + 1]
+
+                queue = {}
+                for stop in marked:
+                    # Reaching a stop with fewer trips also bounds this round
+                    if round_number > 0 and previous_arrival[stop] < current_arrival[stop]:
+                        current_arrival[stop] = previous_arrival[stop]
+                        current_departure[stop] = previous_departure[stop]
+                        current_route[stop] = previous_route[stop]
+                    for pattern, position in self.stop_patterns[stop]:
+                        if position < queue.get(pattern, INFINITY):
+                            queue[pattern] = position
+                marked = set()
+
+                for pattern, first_position in queue.items():
+                    stops = self.pattern_stops[pattern]
+                    departures = self.pattern_departures[pattern]
+                    arrivals = self.pattern_arrivals[pattern]
+                    route = self.pattern_routes[pattern]
+                    trip = -1
+                    journey_departure = INFINITY
+
+                    for position in range(first_position, len(stops)):
+                        stop = stops[position]
+
+                        if trip >= 0:
+                            arrival = int(arrivals[trip, position])
+                            if (arrival < current_arrival[stop] and stop not in origin_set
+                                    and (time_limit is None or arrival - journey_departure <= time_limit)):
+                                current_arrival[stop] = arrival
+                                current_departure[stop] = journey_departure
+                                current_route[stop] = route
+                                journeys.append((stop, journey_departure, arrival, round_number))
+                                marked.add(stop)
+
+                        ready = previous_arrival[stop]
+                        if ready == INFINITY:
+                            continue
+                        if round_number > 0:
+                            if previous_departure[stop] == INFINITY:
+                                continue
+                            if (stop, previous_route[stop], route) in self.forbidden_transfers:
+                                continue
+                            ready += int(self.transfer_times[stop])
+                        if trip >= 0 and ready > departures[trip, position]:
+                            continue
+
+                        column = departures[:, position] if trip < 0 else departures[:trip, position]
+                        candidate = int(column.searchsorted(ready))
+                        if candidate >= len(column):
+                            continue
+                        if round_number == 0:
+                            if column[candidate] > window_end:
+                                continue
+                            journey_departure = int(column[candidate])
+                        else:
+                            journey_departure = previous_departure[stop]
+                        trip = candidate
+
+                if not marked:
+                    break
+
+        return _pareto_journeys(journeys, max_transfers)
+
+    def reachable_profiles(self, origin_stop_ids, max_transfers, departure_window=(0, 24 * 3600), time_limit=None):
+        """
+        profile() as a DataFrame with one row per Pareto journey: stop_id, departure_time,
+        arrival_time, travel_time and transfer_count, the times as Timedeltas.
+        """
+        limit = None if time_limit is None else int(time_limit.total_seconds())
+        origin_stops = self.timetable.stop_indices(origin_stop_ids)
+        stop, departure, arrival, transfers = self.profile(origin_stops, departure_window, max_transfers,
+                                                           time_limit=limit)
+        return pd.DataFrame({
+            'stop_id': self.timetable.stop_ids[stop],
+            'departure_time': pd.to_timedelta(departure, unit='s'),
+            'arrival_time': pd.to_timedelta(arrival, unit='s'),
+            'travel_time': pd.to_timedelta(arrival - departure, unit='s'),
+            'transfer_count': transfers,
+        })
+
+
+def _pareto_journeys(journeys, max_transfers):
+    # A journey is kept unless another one to the same stop leaves no earlier, arrives no later
+    # and uses no more transfers
+    journeys = sorted(journeys, key=lambda journey: (journey[0], -journey[1], journey[3], journey[2]))
+    kept = []
+    current_stop = None
+    for stop, departure, arrival, transfers in journeys:
+        if stop != current_stop:
+            current_stop = stop
+            best_arrival = [INFINITY] * (max_transfers + 1)
+        if arrival < min(best_arrival[:transfers + 1]):
+            best_arrival[transfers] = arrival
+            kept.append((stop, departure, arrival, transfers))
+
+    kept = np.array(kept, dtype=np.int64).reshape(-1, 4)
+    order = np.lexsort((kept[:, 1], kept[:, 0]))
+    return (kept[order, 0], kept[order, 1], kept[order, 2], kept[order, 3].astype(np.int32))
+
+
+def departing_at(profiles, departure_time):
+    """
+    Fastest way to every stop in a reachable_profiles() frame when at the origin at departure_time
+    (a Timedelta): the earliest arrival among journeys leaving then or later, with the waiting
+    time at the origin counted in travel_time. Ties go to fewer transfers.
+    """
+    profiles = profiles[profiles['departure_time'] >= departure_time]
+    profiles = profiles.sort_values(['arrival_time', 'transfer_count']).drop_duplicates(subset=['stop_id'])
+    return profiles.assign(travel_time=profiles['arrival_time'] - departure_time).reset_index(drop=True)
+
+
+def departing_between(profiles, start, end):
+    """Shortest journey to every stop in a reachable_profiles() frame leaving between start and end (Timedeltas)."""
+    profiles = profiles[(profiles['departure_time'] >= start) & (profiles['departure_time'] <= end)]
+    profiles = profiles.sort_values(['travel_time', 'transfer_count']).drop_duplicates(subset=['stop_id'])
+    return profiles.reset_index(drop=True)
@@ -1,88 +1,45 @@
-import pandas as pd
 import os
-import re
+
+import pandas as pd
+
+from feed.cache import read_gtfs
+from feed.service_cube import load_service_cube
+from transfers.stop_clusters import cluster_stops
 
 # Set base directory
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Construct file paths
-stops_path = os.path.join(base_dir, '..', 'gtfs', 'stops.txt')
-stop_times_path = os.path.join(base_dir, '..', 'gtfs', 'stop_times.txt')
-
-# Load GTFS data
-stops_df = pd.read_csv(stops_path)
-stop_times_df = pd.read_csv(stop_times_path)
-stops_df = stops_df.sort_values(by=['stop_name'])
-
-# Calculate the number of trips servicing each stop
-trip_frequencies = stop_times_df['stop_id'].value_counts().reset_index()
-trip_frequencies.columns = ['stop_id', 'trip_count']
-
-# Merge trip frequencies with stops data
-stops_with_frequencies = pd.merge(stops_df, trip_frequencies, on='stop_id', how='left')
-stops_with_frequencies['trip_count'] = stops_with_frequencies['trip_count'].fillna(0)
-
-
-# Define the function to extract city names
-def extract_city_name(stop_name):
-    match = re.match(r'^[^\(,]*', stop_name)
-    city_name = match.group(0).strip() if match else stop_name
-
-    non_city_words = [
-        'Bus Station', 'Airport', 'Service Area', 'FlixBus stop', 'Central Station',
-        'Station', 'Eastbound', 'Westbound', 'East', 'West', 'North', 'South',
-        'Business', 'Park', 'Plaza', 'Square', 'Circle', 'Center', 'Centre',
-        'Stop', 'St.', 'Street', 'Rd.', 'Road', 'Ave.', 'Avenue', 'Dr.', 'Drive'
-    ]
-
-    for word in non_city_words:
-        city_name = re.sub(rf'\b{word}\b', '', city_name, flags=re.IGNORECASE).strip()
-
-    city_name_parts = city_name.split()
-    significant_parts = []
-    for part in city_name_parts:
-        if part and part.istitle():
-            significant_parts.append(part)
-        else:
-            break
-
-    city_name = ' '.join(significant_parts) if significant_parts else city_name_parts[0]
-
-    return city_name
+gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
 
 
-# Apply the function to extract city names
-stops_with_frequencies['city_name'] = stops_with_frequencies['stop_name'].apply(extract_city_name)
+def remove_multiple_stops(gtfs_dir=gtfs_dir):
+    """Write stop_clusters.txt and cleaned_stops.txt (the primary stop of every city) to gtfs_dir."""
+    # Load GTFS data
+    stops_df = read_gtfs('stops', gtfs_dir)
+    service_cube = load_service_cube(gtfs_dir)
 
+    # Number of trips servicing each stop, from the precomputed service cube
+    trip_counts = pd.Series(service_cube.trip_counts(service_cube.stop_ids), index=service_cube.stop_ids)
 
-# Function to find the primary stop in each city
-def find_primary_stops(stops_df):
-    primary_stops = []
-    i = 0
-    while i < len(stops_df):
-        current_city = stops_df.iloc[i]['city_name']
-        max_trip_count = stops_df.iloc[i]['trip_count']
-        primary_stop = stops_df.iloc[i]
-        j = i + 1
-        while j < len(stops_df) and stops_df.iloc[j]['city_name'].startswith(current_city):
-            if stops_df.iloc[j]['trip_count'] > max_trip_count:
-                max_trip_count = stops_df.iloc[j]['trip_count']
-                primary_stop = stops_df.iloc[j]
-            j += 1
-        primary_stops.append(primary_stop)
-        i = j
-    return pd.DataFrame(primary_stops)
+    # Group the stops into cities by location and name, the busiest stop of every city is its primary stop
+    stop_clusters_df = cluster_stops(stops_df, trip_counts)
 
+    # Save the stop to city mapping, routing uses it to start from or arrive at any stop of a city
+    stop_clusters_path = os.path.join(gtfs_dir, 'stop_clusters.txt')
+    stop_clusters_df.to_csv(stop_clusters_path, index=False)
 
-# Find the primary stops
-primary_stops_df = find_primary_stops(stops_with_frequencies)
+    # Keep only the primary stops, with the original columns, sorted by name
+    primary_stop_ids = stop_clusters_df.loc[stop_clusters_df['is_primary'], 'stop_id']
+    cleaned_primary_stops_df = stops_df[stops_df['stop_id'].isin(primary_stop_ids)].sort_values(by=['stop_name'])
 
-# Include only the original columns
-original_columns = stops_df.columns
-cleaned_primary_stops_df = primary_stops_df[original_columns]
+    # Save the cleaned data to a new file
+    cleaned_stops_path = os.path.join(gtfs_dir, 'cleaned_stops.txt')
+    cleaned_primary_stops_df.to_csv(cleaned_stops_path, index=False)
+    return stop_clusters_path, cleaned_stops_path
 
-# Save the cleaned data to a new file
-cleaned_stops_path = os.path.join(base_dir, '..', 'gtfs',  'cleaned_stops.txt')
-cleaned_primary_stops_df.to_csv(cleaned_stops_path, index=False)
 
-print(f"Cleaned stops data saved to {cleaned_stops_path}")
+if __name__ == '__main__':
+    stop_clusters_path, cleaned_stops_path = remove_multiple_stops()
+    print(f"Stop to city mapping saved to {stop_clusters_path}")
+    print(f"Cleaned stops data saved to {cleaned_stops_path}")
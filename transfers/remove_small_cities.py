@@ -1,103 +1,114 @@
-import pandas as pd
 import os
-import re
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from feed.cache import read_gtfs
+from feed.geo import EUROPE_CRS, WGS84_CRS
+from feed.names import normalize_name
+from transfers.stop_clusters import extract_city_name
 
 # Set base directory
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Construct file paths
-stops_path = os.path.join(base_dir, '..', 'gtfs', 'cleaned_stops.txt')
-population_data_path = '../gtfs/geonames-all-cities-with-a-population-1000.csv'
-
-# Load cleaned primary stops data
-stops_df = pd.read_csv(stops_path)
-
-# Load the population dataset with semicolon delimiter and specify dtypes
-population_dtypes = {
-    'Geoname ID': 'int64',
-    'Name': 'str',
-    'ASCII Name': 'str',
-    'Alternate Names': 'str',
-    'Feature Class': 'str',
-    'Feature Code': 'str',
-    'Country Code': 'str',
-    'Country name EN': 'str',
-    'Country Code 2': 'str',
-    'Admin1 Code': 'str',
-    'Admin2 Code': 'str',
-    'Admin3 Code': 'str',
-    'Admin4 Code': 'str',
-    'Population': 'int64',
-    'Elevation': 'str',
-    'DIgital Elevation Model': 'str',
-    'Timezone': 'str',
-    'Modification date': 'str',
-    'LABEL EN': 'str',
-    'Coordinates': 'str'
-}
-
-population_df = pd.read_csv(population_data_path, delimiter=';', dtype=population_dtypes, low_memory=False)
-
-# Filter cities with population >= 100,000
-large_cities_df = population_df[population_df['Population'] >= 50000]
-
-# Define the function to extract city names
-def extract_city_name(stop_name):
-    match = re.match(r'^[^\(,]*', stop_name)
-    city_name = match.group(0).strip() if match else stop_name
-
-    non_city_words = [
-        'Bus Station', 'Airport', 'Service Area', 'FlixBus stop', 'Central Station',
-        'Station', 'Eastbound', 'Westbound', 'East', 'West', 'North', 'South',
-        'Business', 'Park', 'Plaza', 'Square', 'Circle', 'Center', 'Centre',
-        'Stop', 'St.', 'Street', 'Rd.', 'Road', 'Ave.', 'Avenue', 'Dr.', 'Drive'
-    ]
-
-    for word in non_city_words:
-        city_name = re.sub(rf'\b{word}\b', '', city_name, flags=re.IGNORECASE).strip()
-
-    city_name_parts = city_name.split()
-    significant_parts = []
-    for part in city_name_parts:
-        if part and part.istitle():
-            significant_parts.append(part)
-        else:
-            break
-
-    city_name = ' '.join(significant_parts) if significant_parts else city_name_parts[0]
-
-    return city_name
-
-# Define the function to find the best matching city name
-def find_matching_city_name(city_name, large_city_names):
-    if city_name in large_city_names:
-        return city_name
-    else:
-        city_name_parts = city_name.split()
-        for i in range(len(city_name_parts), 0, -1):
-            potential_city_name = ' '.join(city_name_parts[:i])
-            if potential_city_name in large_city_names:
-                return potential_city_name
-    return None
-
-# Apply the function to extract city names
-stops_df['city_name'] = stops_df['stop_name'].apply(extract_city_name)
-
-# Get the list of large city names
-large_city_names = large_cities_df['Name'].str.strip().unique()
-
-# Apply the function to find matching city names
-stops_df['matched_city_name'] = stops_df['city_name'].apply(lambda x: find_matching_city_name(x, large_city_names))
-
-# Filter stops to include only those in large cities
-filtered_stops_df = stops_df[stops_df['matched_city_name'].notna()]
-
-# Include only the original columns
-original_columns = stops_df.columns.drop(['city_name', 'matched_city_name'])
-cleaned_filtered_stops_df = filtered_stops_df[original_columns]
-
-# Save the filtered data to a new file
-cleaned_stops_path = os.path.join(base_dir, '..', 'gtfs', 'cleaned_filtered_stops.txt')
-cleaned_filtered_stops_df.to_csv(cleaned_stops_path, index=False)
-
-print(f"Filtered stops data saved to {cleaned_stops_path}")
+gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
+population_data_path = os.path.join(gtfs_dir, 'geonames-all-cities-with-a-population-1000.csv')
+
+# Smallest population of a city whose stops are kept
+MIN_POPULATION = 50000
+
+# A stop belongs to a large city named like it within this distance, in meters
+NAMED_CITY_RADIUS = 20_000
+
+# or else to the nearest large city within this distance, in meters
+NEAREST_CITY_RADIUS = 10_000
+
+EARTH_RADIUS = 6_371_000
+
+
+def haversine(lats_a, lons_a, lats_b, lons_b):
+    """Great-circle distance in meters between arrays of points given in degrees."""
+    lats_a, lons_a, lats_b, lons_b = map(np.radians, (lats_a, lons_a, lats_b, lons_b))
+    a = (np.sin((lats_b - lats_a) / 2) ** 2
+         + np.cos(lats_a) * np.cos(lats_b) * np.sin((lons_b - lons_a) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def _to_europe(lons, lats):
+    return gpd.GeoSeries(gpd.points_from_xy(lons, lats), crs=WGS84_CRS).to_crs(EUROPE_CRS).values
+
+
+def load_large_cities(path=population_data_path, min_population=MIN_POPULATION):
+    """Name, accent-folded name and coordinates of the GeoNames cities with at least min_population people."""
+    population_df = pd.read_csv(path, delimiter=';', usecols=['Name', 'ASCII Name', 'Population', 'Coordinates'],
+                                dtype={'Name': 'str', 'ASCII Name': 'str', 'Population': 'int64',
+                                       'Coordinates': 'str'})
+    large_cities_df = population_df[population_df['Population'] >= min_population].dropna(subset=['Coordinates'])
+    coordinates = large_cities_df['Coordinates'].str.split(',', n=1, expand=True).astype('float64')
+    return pd.DataFrame({
+        'name': large_cities_df['Name'].str.strip().to_numpy(),
+        'key': large_cities_df['Name'].fillna(large_cities_df['ASCII Name']).map(normalize_name).to_numpy(),
+        'lat': coordinates[0].to_numpy(),
+        'lon': coordinates[1].to_numpy(),
+    })
+
+
+def match_large_cities(stops_df, cities_df):
+    """
+    Row of cities_df every stop belongs to, -1 for stops outside all large cities.
+
+    The candidates of a stop are found through an STRtree over the projected city points. A
+    city named like the stop (the city part of the stop name, or its first words) within
+    NAMED_CITY_RADIUS wins, otherwise the nearest city within NEAREST_CITY_RADIUS by
+    haversine distance.
+    """
+    stop_lats = stops_df['stop_lat'].to_numpy(dtype=float)
+    stop_lons = stops_df['stop_lon'].to_numpy(dtype=float)
+    tree = shapely.STRtree(_to_europe(cities_df['lon'], cities_df['lat']))
+    # Stops without coordinates are empty points and match nothing
+    stop_idx, city_idx = tree.query(_to_europe(stop_lons, stop_lats), predicate='dwithin', distance=NAMED_CITY_RADIUS)
+
+    candidates = pd.DataFrame({
+        'stop': stop_idx,
+        'city': city_idx,
+        'distance': haversine(stop_lats[stop_idx], stop_lons[stop_idx],
+                              cities_df['lat'].to_numpy()[city_idx], cities_df['lon'].to_numpy()[city_idx]),
+    })
+    stop_keys = stops_df['stop_name'].fillna('').map(extract_city_name).map(normalize_name).to_numpy(dtype=object)
+    city_keys = cities_df['key'].to_numpy(dtype=object)
+    candidates['named'] = [stop_key == city_key or stop_key.startswith(city_key + ' ')
+                           for stop_key, city_key in zip(stop_keys[stop_idx], city_keys[city_idx])]
+    candidates = candidates[candidates['named'] | (candidates['distance'] <= NEAREST_CITY_RADIUS)]
+
+    # Named cities first, then the closest one
+    best = candidates.sort_values(['stop', 'named', 'distance'], ascending=[True, False, True])
+    best = best.drop_duplicates(subset=['stop'])
+    matches = np.full(len(stops_df), -1)
+    matches[best['stop'].to_numpy()] = best['city'].to_numpy()
+    return matches
+
+
+def remove_small_cities(gtfs_dir=gtfs_dir, population_path=population_data_path):
+    """Write cleaned_filtered_stops.txt, the stops of cleaned_stops.txt in large cities, to gtfs_dir."""
+    # Load cleaned primary stops data
+    stops_df = read_gtfs('cleaned_stops', gtfs_dir)
+
+    # Large cities of the GeoNames dump
+    large_cities_df = load_large_cities(population_path)
+
+    # Filter stops to include only those in large cities
+    matches = match_large_cities(stops_df, large_cities_df)
+    cleaned_filtered_stops_df = stops_df[matches >= 0]
+
+    # Save the filtered data to a new file
+    cleaned_stops_path = os.path.join(gtfs_dir, 'cleaned_filtered_stops.txt')
+    cleaned_filtered_stops_df.to_csv(cleaned_stops_path, index=False)
+    return cleaned_stops_path
+
+
+if __name__ == '__main__':
+    cleaned_stops_path = remove_small_cities()
+    print(f"Filtered stops data saved to {cleaned_stops_path}")
@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from feed.cache import load_arrays, save_arrays
+
+# Columns of one precompute result, in the order the workers return them
+ROUTE_COLUMNS = {
+    'stop_idx': np.int32,
+    'travel_time': np.int32,
+    'transfer_count': np.int8,
+    'arrival_time': np.int32,
+    'interval_idx': np.int8,
+}
+
+# Rows buffered before a chunk is written
+BATCH_ROWS = 500_000
+
+OUTPUT_COLUMNS = ['origin_city', 'stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'travel_time',
+                  'transfer_count', 'departure_time_interval', 'arrival_time']
+
+
+class RouteSink:
+    """
+    Streams precompute results into numbered chunk directories of .npy columns.
+
+    Rows to stops without coordinates are dropped on write, so the buffer never holds more
+    than batch_rows rows. The origin cities, interval names and the stop table (indexed like
+    the timetable stops) are written once next to the chunks. compact_routes() turns the
+    directory into the csv the interface reads.
+    """
+
+    def __init__(self, directory, cities, interval_names, stops_df, batch_rows=BATCH_ROWS):
+        self.directory = directory
+        self.batch_rows = batch_rows
+        self.n_chunks = 0
+        self.n_rows = 0
+        self.buffer = []
+        self.buffered_rows = 0
+
+        self.has_coordinates = stops_df[['stop_lat', 'stop_lon']].notna().all(axis=1).to_numpy()
+        os.makedirs(directory, exist_ok=True)
+        save_arrays(os.path.join(directory, 'index'), {
+            'cities': np.asarray(cities, dtype=object),
+            'interval_names': np.asarray(interval_names, dtype=object),
+            'stop_ids': stops_df['stop_id'].to_numpy(dtype=object),
+            'stop_names': stops_df['stop_name'].fillna('').to_numpy(dtype=object),
+            'stop_lats': stops_df['stop_lat'].to_numpy(dtype=np.float64),
+            'stop_lons': stops_df['stop_lon'].to_numpy(dtype=np.float64),
+        })
+
+    def write(self, origin, columns):
+        """Add the routes of one origin, columns being the arrays of ROUTE_COLUMNS."""
+        keep = self.has_coordinates[columns[0]]
+        batch = {name: np.asarray(values)[keep].astype(dtype, copy=False)
+                 for (name, dtype), values in zip(ROUTE_COLUMNS.items(), columns)}
+        batch['origin_idx'] = np.full(keep.sum(), origin, dtype=np.int32)
+        self.buffer.append(batch)
+        self.buffered_rows += len(batch['origin_idx'])
+        if self.buffered_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = {name: np.concatenate([batch[name] for batch in self.buffer]) for name in self.buffer[0]}
+        chunk_dir = os.path.join(self.directory, f'chunk-{self.n_chunks:05d}')
+        # Publish the chunk atomically, a crashed run never leaves a half-written chunk behind
+        save_arrays(f'{chunk_dir}.tmp', chunk)
+        os.replace(f'{chunk_dir}.tmp', chunk_dir)
+        self.n_chunks += 1
+        self.n_rows += self.buffered_rows
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump({'chunks': self.n_chunks, 'rows': self.n_rows}, f, indent=2)
+
+
+def read_route_chunks(directory):
+    """Yield every chunk of a closed sink directory as a DataFrame with the precomputed_routes.csv columns."""
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    index = load_arrays(os.path.join(directory, 'index'), mmap_mode=None)
+    cities = index['cities'].astype(object)
+    interval_names = index['interval_names'].astype(object)
+    stop_ids = index['stop_ids'].astype(object)
+    stop_names = index['stop_names'].astype(object)
+
+    for chunk in range(manifest['chunks']):
+        columns = load_arrays(os.path.join(directory, f'chunk-{chunk:05d}'))
+        stop_idx = columns['stop_idx']
+        yield pd.DataFrame({
+            'origin_city': cities[columns['origin_idx']],
+            'stop_id': stop_ids[stop_idx],
+            'stop_name': stop_names[stop_idx],
+            'stop_lat': index['stop_lats'][stop_idx],
+            'stop_lon': index['stop_lons'][stop_idx],
+            'travel_time': pd.to_timedelta(columns['travel_time'], unit='s'),
+            'transfer_count': columns['transfer_count'].astype(int),
+            'departure_time_interval': interval_names[columns['interval_idx']],
+            'arrival_time': pd.to_timedelta(columns['arrival_time'], unit='s'),
+        }, columns=OUTPUT_COLUMNS)
+
+
+def compact_routes(directory, output_path, remove_chunks=True):
+    """Write the chunks of a sink directory to one csv, a chunk at a time, and drop the chunks after."""
+    tmp_path = f'{output_path}.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        # Header even when no route was found
+        pd.DataFrame(columns=OUTPUT_COLUMNS).to_csv(f, index=False)
+        for routes_df in read_route_chunks(directory):
+            routes_df.to_csv(f, index=False, header=False)
+    os.replace(tmp_path, output_path)
+    if remove_chunks:
+        shutil.rmtree(directory, ignore_errors=True)
+    return output_path
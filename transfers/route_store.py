@@ -0,0 +1,226 @@
+import os
+import sqlite3
+import sys
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from feed.cache import file_hash
+from feed.names import StopNameIndex
+from transfers.precompute import time_intervals
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+ROUTE_STORE_PATH = os.path.join(base_dir, 'precomputed_routes.sqlite')
+ROUTES_CSV_PATH = os.path.join(base_dir, 'precomputed_routes_adjusted_test.csv')
+
+# Departure intervals of the precompute, their position is the interval id in the store
+TIME_INTERVALS = list(time_intervals)
+
+# Packed column types of one (origin, interval) partition
+PARTITION_COLUMNS = {
+    'stop_idx': np.uint16,
+    'travel_minutes': np.uint16,
+    'transfer_count': np.uint8,
+    'arrival_minutes': np.uint16,
+}
+
+
+def _to_minutes(values):
+    # Rounded up, so a filter on whole minutes never lets a slightly longer route through
+    return np.ceil(pd.to_timedelta(values, errors='coerce').dt.total_seconds() / 60)
+
+
+def pareto_routes(routes_df, keys):
+    """
+    Keep, per group of keys, only the rows no other row beats on both travel_minutes and
+    transfer_count. Dominated rows can never be the fastest answer to a filter on max hours
+    and max changes, so dropping them doesn't change any lookup.
+    """
+    routes_df = routes_df.sort_values(keys + ['transfer_count', 'travel_minutes'])
+    routes_df = routes_df.drop_duplicates(subset=keys + ['transfer_count'], keep='first')
+    group = routes_df.groupby(keys, sort=False)['travel_minutes']
+    best_so_far = group.cummin()
+    previous_best = best_so_far.groupby([routes_df[key] for key in keys], sort=False).shift()
+    return routes_df[previous_best.isna() | (routes_df['travel_minutes'] < previous_best)]
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _check_packed_range(packed):
+    # Values past the range of a packed type would silently wrap around
+    for column, dtype in PARTITION_COLUMNS.items():
+        if len(packed) and packed[column].max() > np.iinfo(dtype).max:
+            raise ValueError(f"{column} reaches {int(packed[column].max())}, "
+                             f"more than the {np.dtype(dtype).name} of the route store can hold")
+
+
+def build_route_store(routes_df, db_path=ROUTE_STORE_PATH, source_path=None):
+    """
+    Write precomputed routes (the columns of precomputed_routes.csv) into an SQLite file with
+    one row per (origin city, departure interval). Each row holds the destinations of that
+    partition as packed arrays: uint16 stop index, uint16 travel minutes, uint8 transfers and
+    uint16 arrival minutes. Rows without coordinates are dropped. When source_path is given,
+    the hash and stat of that CSV are recorded so load_route_store can tell a stale store.
+    """
+    routes_df = routes_df.dropna(subset=['stop_lat', 'stop_lon', 'travel_time'])
+
+    origins = pd.Index(routes_df['origin_city'].unique())
+    stops = routes_df.drop_duplicates(subset=['stop_id'])[['stop_id', 'stop_name', 'stop_lat', 'stop_lon']]
+    stops = stops.reset_index(drop=True)
+
+    packed = pd.DataFrame({
+        'origin_id': origins.get_indexer(routes_df['origin_city']),
+        'interval_id': pd.Index(TIME_INTERVALS).get_indexer(routes_df['departure_time_interval']),
+        'stop_idx': pd.Index(stops['stop_id']).get_indexer(routes_df['stop_id']),
+        'travel_minutes': _to_minutes(routes_df['travel_time']),
+        'transfer_count': routes_df['transfer_count'].to_numpy(),
+        'arrival_minutes': _to_minutes(routes_df['arrival_time']).fillna(0),
+    })
+    packed = packed.dropna(subset=['travel_minutes'])
+    packed = pareto_routes(packed, ['origin_id', 'interval_id', 'stop_idx'])
+    packed = packed.sort_values(['origin_id', 'interval_id', 'travel_minutes'])
+    _check_packed_range(packed)
+
+    tmp_path = f'{db_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with closing(sqlite3.connect(tmp_path)) as connection:
+        connection.executescript("""
+            CREATE TABLE origins (origin_id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+            CREATE TABLE stops (stop_idx INTEGER PRIMARY KEY, stop_id TEXT NOT NULL, stop_name TEXT,
+                                stop_lat REAL, stop_lon REAL);
+            CREATE TABLE routes (origin_id INTEGER NOT NULL, interval_id INTEGER NOT NULL, n_rows INTEGER NOT NULL,
+                                 stop_idx BLOB, travel_minutes BLOB, transfer_count BLOB, arrival_minutes BLOB,
+                                 PRIMARY KEY (origin_id, interval_id)) WITHOUT ROWID;
+            CREATE TABLE source (path TEXT, sha1 TEXT, size INTEGER, mtime_ns INTEGER);
+        """)
+        if source_path is not None:
+            source = _source_stat(source_path)
+            connection.execute('INSERT INTO source VALUES (?, ?, ?, ?)',
+                               (os.path.abspath(source_path), file_hash(source_path), source['size'],
+                                source['mtime_ns']))
+        connection.executemany('INSERT INTO origins VALUES (?, ?)', enumerate(origins))
+        connection.executemany('INSERT INTO stops VALUES (?, ?, ?, ?, ?)',
+                               stops.itertuples(index=True, name=None))
+
+        partitions = []
+        for (origin_id, interval_id), partition in packed.groupby(['origin_id', 'interval_id'], sort=False):
+            blobs = [partition[column].to_numpy(dtype=dtype).tobytes() for column, dtype in PARTITION_COLUMNS.items()]
+            partitions.append((int(origin_id), int(interval_id), len(partition), *blobs))
+        connection.executemany('INSERT INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)', partitions)
+        connection.commit()
+    os.replace(tmp_path, db_path)
+    return db_path
+
+
+def _fresh_route_store(csv_path, db_path):
+    """Whether the store at db_path was built from the current content of csv_path."""
+    if not os.path.exists(db_path):
+        return False
+    if not os.path.exists(csv_path):
+        # Use the store when only the compact copy of the routes is around
+        return True
+
+    try:
+        with closing(sqlite3.connect(db_path)) as connection:
+            source = connection.execute('SELECT sha1, size, mtime_ns FROM source').fetchone()
+            if source is None:
+                return False
+            sha1, size, mtime_ns = source
+            if _source_stat(csv_path) == {'size': size, 'mtime_ns': mtime_ns}:
+                return True
+            if file_hash(csv_path) != sha1:
+                return False
+            # Same content with a new timestamp (e.g. after a checkout), remember the new stat
+            stat = _source_stat(csv_path)
+            connection.execute('UPDATE source SET size = ?, mtime_ns = ?', (stat['size'], stat['mtime_ns']))
+            connection.commit()
+            return True
+    except sqlite3.Error:
+        # Written before the store recorded its source
+        return False
+
+
+def load_route_store(csv_path=ROUTES_CSV_PATH, db_path=ROUTE_STORE_PATH):
+    """RouteStore of the routes in csv_path, built again when the CSV changed since the store was written."""
+    if not _fresh_route_store(csv_path, db_path):
+        build_route_store(pd.read_csv(csv_path), db_path, source_path=csv_path)
+    return RouteStore(db_path)
+
+
+class RouteStore:
+    """Read-only lookups of precomputed routes by origin city from a file written by build_route_store."""
+
+    def __init__(self, db_path=ROUTE_STORE_PATH):
+        self.uri = f'file:{db_path}?mode=ro'
+        with closing(self._connect()) as connection:
+            self.origins = pd.read_sql('SELECT name FROM origins ORDER BY origin_id', connection)['name']
+            self.stops = pd.read_sql('SELECT * FROM stops ORDER BY stop_idx', connection)
+        self.origin_index = StopNameIndex(np.arange(len(self.origins)), self.origins)
+
+    def _connect(self):
+        # One connection per query keeps the store usable from several Streamlit threads
+        return sqlite3.connect(self.uri, uri=True)
+
+    def origin_ids(self, city_name):
+        """Origins whose name contains every word of city_name, ignoring case and accents."""
+        return np.asarray(self.origin_index.lookup_rows(city_name), dtype=np.int64)
+
+    def lookup(self, city_name, max_travel_hours, max_changes, time_interval='all_day'):
+        """
+        Routes from every origin matching city_name within the limits, with the columns of
+        precomputed_routes.csv plus travel_time_hours. time_interval is one of TIME_INTERVALS
+        or 'all_day'.
+        """
+        origin_ids = self.origin_ids(city_name)
+        if time_interval == 'all_day':
+            interval_ids = list(range(len(TIME_INTERVALS)))
+        else:
+            interval_ids = [TIME_INTERVALS.index(time_interval)]
+
+        query = (f"SELECT origin_id, interval_id, n_rows, stop_idx, travel_minutes, transfer_count, arrival_minutes "
+                 f"FROM routes WHERE origin_id IN ({','.join('?' * len(origin_ids))}) "
+                 f"AND interval_id IN ({','.join('?' * len(interval_ids))})")
+        with closing(self._connect()) as connection:
+            rows = connection.execute(query, [int(i) for i in origin_ids] + interval_ids).fetchall()
+
+        partitions = []
+        for origin_id, interval_id, n_rows, *blobs in rows:
+            columns = {column: np.frombuffer(blob, dtype=dtype)
+                       for (column, dtype), blob in zip(PARTITION_COLUMNS.items(), blobs)}
+            columns['origin_id'] = np.full(n_rows, origin_id)
+            columns['interval_id'] = np.full(n_rows, interval_id)
+            partitions.append(pd.DataFrame(columns))
+        if partitions:
+            routes = pd.concat(partitions, ignore_index=True)
+        else:
+            routes = pd.DataFrame({column: pd.Series(dtype=dtype)
+                                   for column, dtype in {**PARTITION_COLUMNS, 'origin_id': int, 'interval_id': int}.items()})
+
+        routes = routes[(routes['travel_minutes'] <= max_travel_hours * 60) & (routes['transfer_count'] <= max_changes)]
+        stops = self.stops.iloc[routes['stop_idx']].reset_index(drop=True)
+        return pd.DataFrame({
+            'origin_city': self.origins.iloc[routes['origin_id']].to_numpy(),
+            'stop_id': stops['stop_id'],
+            'stop_name': stops['stop_name'],
+            'stop_lat': stops['stop_lat'],
+            'stop_lon': stops['stop_lon'],
+            'travel_time': pd.to_timedelta(routes['travel_minutes'].to_numpy(), unit='min'),
+            'transfer_count': routes['transfer_count'].to_numpy(dtype=int),
+            'departure_time_interval': np.array(TIME_INTERVALS)[routes['interval_id'].to_numpy(dtype=int)],
+            'arrival_time': pd.to_timedelta(routes['arrival_minutes'].to_numpy(), unit='min'),
+            'travel_time_hours': routes['travel_minutes'].to_numpy() / 60,
+        })
+
+
+if __name__ == '__main__':
+    # python -m transfers.route_store [precomputed routes csv] [output sqlite]
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else ROUTES_CSV_PATH
+    db_path = sys.argv[2] if len(sys.argv) > 2 else ROUTE_STORE_PATH
+    build_route_store(pd.read_csv(csv_path), db_path, source_path=csv_path)
+    print(f"Route store saved to {db_path}")
@@ -0,0 +1,148 @@
+import os
+import re
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from feed.cache import read_gtfs
+from feed.geo import EUROPE_CRS, WGS84_CRS
+from feed.names import normalize_name
+
+# Stops of one city further apart than this are never put together, in meters
+CITY_RADIUS = 20_000
+
+# Stops this close are the same place whatever they are called, in meters
+SAME_PLACE_RADIUS = 500
+
+# Words of a stop name that describe the stop rather than the city
+NON_CITY_WORDS = [
+    'Bus Station', 'Airport', 'Service Area', 'FlixBus stop', 'Central Station',
+    'Station', 'Eastbound', 'Westbound', 'East', 'West', 'North', 'South',
+    'Business', 'Park', 'Plaza', 'Square', 'Circle', 'Center', 'Centre',
+    'Stop', 'St.', 'Street', 'Rd.', 'Road', 'Ave.', 'Avenue', 'Dr.', 'Drive'
+]
+
+
+def extract_city_name(stop_name):
+    match = re.match(r'^[^\(,]*', stop_name)
+    city_name = match.group(0).strip() if match else stop_name
+
+    for word in NON_CITY_WORDS:
+        city_name = re.sub(rf'\b{word}\b', '', city_name, flags=re.IGNORECASE).strip()
+
+    city_name_parts = city_name.split()
+    significant_parts = []
+    for part in city_name_parts:
+        if part and part.istitle():
+            significant_parts.append(part)
+        else:
+            break
+
+    if significant_parts:
+        return ' '.join(significant_parts)
+    return city_name_parts[0] if city_name_parts else stop_name
+
+
+def _neighbour_pairs(x, y, radius):
+    # Grid hash with cells of radius meters: two stops closer than radius are in the same or in neighbouring cells
+    grid = pd.DataFrame({'cell_x': np.floor(x / radius).astype(np.int64),
+                         'cell_y': np.floor(y / radius).astype(np.int64),
+                         'stop': np.arange(len(x))})
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            shifted = grid.assign(cell_x=grid['cell_x'] + dx, cell_y=grid['cell_y'] + dy)
+            joined = shifted.merge(grid, on=['cell_x', 'cell_y'], suffixes=('_a', '_b'))
+            pairs.append(joined.loc[joined['stop_a'] < joined['stop_b'], ['stop_a', 'stop_b']].to_numpy())
+    pairs = np.concatenate(pairs)
+    distances = np.hypot(x[pairs[:, 0]] - x[pairs[:, 1]], y[pairs[:, 0]] - y[pairs[:, 1]])
+    return pairs[distances <= radius], distances[distances <= radius]
+
+
+def _same_city_name(names_a, names_b):
+    # One city name is the other or starts with it as whole words, e.g. "basel" and "basel bad",
+    # but "bad hersfeld" and "bad oeynhausen" are different towns
+    return np.array([a == b or b.startswith(a + ' ') or a.startswith(b + ' ') for a, b in zip(names_a, names_b)],
+                    dtype=bool)
+
+
+def _connected_components(n, pairs):
+    # Label every node with the smallest node of its component, by propagating the minimum over
+    # the edges and jumping to the label's label until nothing changes
+    labels = np.arange(n)
+    while True:
+        lowest = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, pairs[:, 0], lowest)
+        np.minimum.at(new_labels, pairs[:, 1], lowest)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def cluster_stops(stops_df, trip_counts):
+    """
+    Group the stops into cities by place and name.
+
+    Two stops are linked when they are at most CITY_RADIUS apart and one city name (from
+    extract_city_name, accent-folded) is the other or a longer form of it, or when they are at
+    most SAME_PLACE_RADIUS apart. A cluster is a connected group of linked stops, like DBSCAN
+    with a minimum of one point. The primary stop of a cluster is the one with the most trips
+    in trip_counts (a Series indexed by stop_id) and gives the cluster its id.
+
+    Returns the stop to cluster mapping: stop_id, cluster_id, cluster_name, trip_count, is_primary.
+    """
+    stops_df = stops_df.sort_values('stop_name', kind='stable').reset_index(drop=True)
+    city_names = stops_df['stop_name'].fillna('').map(extract_city_name)
+    keys = city_names.map(normalize_name).to_numpy(dtype=object)
+
+    located = stops_df[['stop_lat', 'stop_lon']].notna().all(axis=1).to_numpy()
+    rows = np.flatnonzero(located)
+    points = gpd.GeoSeries(gpd.points_from_xy(stops_df.loc[located, 'stop_lon'], stops_df.loc[located, 'stop_lat']),
+                           crs=WGS84_CRS).to_crs(EUROPE_CRS)
+    pairs, distances = _neighbour_pairs(points.x.to_numpy(), points.y.to_numpy(), CITY_RADIUS)
+    pairs = rows[pairs]
+    linked = (distances <= SAME_PLACE_RADIUS) | _same_city_name(keys[pairs[:, 0]], keys[pairs[:, 1]])
+    labels = _connected_components(len(stops_df), pairs[linked])
+
+    clusters = pd.DataFrame({
+        'stop_id': stops_df['stop_id'],
+        'label': labels,
+        'trip_count': stops_df['stop_id'].map(trip_counts).fillna(0).astype(int),
+    })
+    # First stop by name wins a tie, like the old name-sorted scan
+    primary = clusters.groupby('label')['trip_count'].idxmax()
+    clusters['cluster_id'] = clusters['label'].map(clusters.loc[primary, 'stop_id'].set_axis(primary.index))
+    # The shortest city name of a cluster is the one the others extend, e.g. "Vienna" for "Vienna Erdberg"
+    names = pd.DataFrame({'label': labels, 'city_name': city_names, 'length': city_names.str.len()})
+    names = names.sort_values(['length', 'city_name'], kind='stable').drop_duplicates('label').set_index('label')
+    clusters['cluster_name'] = clusters['label'].map(names['city_name'])
+    clusters['is_primary'] = clusters.index.isin(primary)
+    return clusters[['stop_id', 'cluster_id', 'cluster_name', 'trip_count', 'is_primary']]
+
+
+def load_stop_clusters(gtfs_dir):
+    """The stop to cluster mapping written by remove_multiple_stops_from_cities.py, None before it was run."""
+    if not os.path.exists(os.path.join(gtfs_dir, 'stop_clusters.txt')):
+        return None
+    return read_gtfs('stop_clusters', gtfs_dir)
+
+
+def cluster_members(stop_ids, stop_clusters):
+    """stop_ids and every other stop of their clusters, for routing from or to a whole city."""
+    stop_ids = list(stop_ids)
+    if stop_clusters is None:
+        return stop_ids
+    cluster_ids = stop_clusters.loc[stop_clusters['stop_id'].isin(stop_ids), 'cluster_id']
+    members = stop_clusters.loc[stop_clusters['cluster_id'].isin(cluster_ids), 'stop_id']
+    return list(dict.fromkeys(stop_ids + members.tolist()))
+
+
+def cluster_ids(stop_ids, stop_clusters):
+    """Cluster of every stop, the stop id itself for stops without one."""
+    stop_ids = pd.Series(np.asarray(stop_ids, dtype=object))
+    if stop_clusters is not None:
+        stop_ids = stop_ids.map(stop_clusters.set_index('stop_id')['cluster_id']).fillna(stop_ids)
+    return stop_ids.to_numpy(dtype=object)
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+from feed.cache import load_arrays, save_arrays
+from feed.times import parse_gtfs_times
+
+
+class Timetable:
+    """
+    Array-backed timetable compiled once from stop_times.
+
+    Stops and trips are mapped to integer indices. The stop times of trip t are the rows
+    trip_offsets[t]:trip_offsets[t + 1] of st_stop / st_arrival / st_departure, ordered by
+    stop_sequence, with times as int32 seconds since the start of the service day.
+    The visits of stop s are stop_trip / stop_pos[stop_offsets[s]:stop_offsets[s + 1]],
+    i.e. the trip index and the position of the stop inside that trip.
+    """
+
+    def __init__(self, stop_ids, trip_ids, trip_offsets, st_stop, st_arrival, st_departure,
+                 stop_offsets, stop_trip, stop_pos):
+        self.stop_ids = stop_ids
+        self.trip_ids = trip_ids
+        self.trip_offsets = trip_offsets
+        self.st_stop = st_stop
+        self.st_arrival = st_arrival
+        self.st_departure = st_departure
+        self.stop_offsets = stop_offsets
+        self.stop_trip = stop_trip
+        self.stop_pos = stop_pos
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+        self.trip_index = {trip_id: i for i, trip_id in enumerate(trip_ids)}
+
+    @classmethod
+    def from_stop_times(cls, stop_times_df):
+        stop_times_df = stop_times_df[['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time']]
+
+        trip_codes, trip_ids = pd.factorize(stop_times_df['trip_id'])
+        stop_codes, stop_ids = pd.factorize(stop_times_df['stop_id'])
+
+        # Rows grouped by trip, in stop_sequence order
+        order = np.lexsort((stop_times_df['stop_sequence'].to_numpy(), trip_codes))
+        st_trip = trip_codes[order].astype(np.int32)
+        st_stop = stop_codes[order].astype(np.int32)
+
+        arrival = parse_gtfs_times(stop_times_df['arrival_time']).iloc[order].reset_index(drop=True)
+        departure = parse_gtfs_times(stop_times_df['departure_time']).iloc[order].reset_index(drop=True)
+        # Non-timepoint stops may leave one or both times empty, take them from the neighbours
+        arrival = arrival.fillna(departure)
+        departure = departure.fillna(arrival)
+        arrival = arrival.groupby(st_trip).ffill().fillna(0)
+        departure = departure.groupby(st_trip).ffill().fillna(0)
+
+        trip_offsets = np.zeros(len(trip_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(st_trip, minlength=len(trip_ids)), out=trip_offsets[1:])
+
+        # Stop -> (trip, position) index; the stable sort keeps a trip's visits in sequence order
+        by_stop = np.argsort(st_stop, kind='stable')
+        stop_offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(st_stop, minlength=len(stop_ids)), out=stop_offsets[1:])
+        stop_trip = st_trip[by_stop]
+        stop_pos = (by_stop - trip_offsets[stop_trip]).astype(np.int32)
+
+        return cls(
+            stop_ids=np.asarray(stop_ids, dtype=object),
+            trip_ids=np.asarray(trip_ids, dtype=object),
+            trip_offsets=trip_offsets,
+            st_stop=st_stop,
+            st_arrival=arrival.to_numpy(dtype=np.int32),
+            st_departure=departure.to_numpy(dtype=np.int32),
+            stop_offsets=stop_offsets,
+            stop_trip=stop_trip,
+            stop_pos=stop_pos,
+        )
+
+    def save(self, directory):
+        save_arrays(directory, {
+            'stop_ids': self.stop_ids,
+            'trip_ids': self.trip_ids,
+            'trip_offsets': self.trip_offsets,
+            'st_stop': self.st_stop,
+            'st_arrival': self.st_arrival,
+            'st_departure': self.st_departure,
+            'stop_offsets': self.stop_offsets,
+            'stop_trip': self.stop_trip,
+            'stop_pos': self.stop_pos,
+        })
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Timetable written by save(), with its arrays memory-mapped so processes share one copy."""
+        arrays = load_arrays(directory, mmap_mode)
+        arrays['stop_ids'] = arrays['stop_ids'].astype(object)
+        arrays['trip_ids'] = arrays['trip_ids'].astype(object)
+        return cls(**arrays)
+
+    @property
+    def n_stops(self):
+        return len(self.stop_ids)
+
+    @property
+    def n_trips(self):
+        return len(self.trip_ids)
+
+    def trip_bounds(self, trip):
+        return self.trip_offsets[trip], self.trip_offsets[trip + 1]
+
+    def trips_at(self, stop):
+        start, end = self.stop_offsets[stop], self.stop_offsets[stop + 1]
+        return self.stop_trip[start:end], self.stop_pos[start:end]
+
+    def stop_indices(self, stop_ids):
+        return [self.stop_index[stop_id] for stop_id in stop_ids if stop_id in self.stop_index]
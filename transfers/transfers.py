@@ -1,140 +1,108 @@
-import numpy as np
+import os
+from functools import lru_cache
+
 import pandas as pd
 import folium
-from heapq import heappop, heappush
-from collections import defaultdict
-from tqdm import tqdm
 
-# Load data from the uploaded files
-agency = pd.read_csv('../gtfs/agency.txt')
-calendar = pd.read_csv('../gtfs/calendar.txt')
-calendar_dates = pd.read_csv('../gtfs/calendar_dates.txt')
-feed_info = pd.read_csv('../gtfs/feed_info.txt')
-routes_df = pd.read_csv('../gtfs/routes.txt')
-stops_df = pd.read_csv('../gtfs/cleaned_filtered_stops.txt')  # change to ../gtfs/cleaned_filtered_stops.txt' if you want to filter out small cities
-stop_times_df = pd.read_csv('../gtfs/stop_times.txt')
-transfers = pd.read_csv('../gtfs/transfers.txt')
-trips_df = pd.read_csv('../gtfs/trips.txt')
+from feed.cache import read_gtfs
+from feed.calendar import ServiceCalendar
+from feed.names import StopNameIndex
+from transfers.precompute import time_intervals
+from transfers.raptor import Raptor, departing_at, departing_between
+from transfers.stop_clusters import cluster_ids, cluster_members, load_stop_clusters
+from transfers.timetable import Timetable
+
+# Set base directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
+gtfs_dir = os.path.join(base_dir, '..', 'gtfs')
+
+# Load data from the compiled feed cache
+agency = read_gtfs('agency', gtfs_dir)
+calendar = read_gtfs('calendar', gtfs_dir)
+calendar_dates = read_gtfs('calendar_dates', gtfs_dir)
+feed_info = read_gtfs('feed_info', gtfs_dir)
+routes_df = read_gtfs('routes', gtfs_dir)
+stops_df = read_gtfs('cleaned_filtered_stops', gtfs_dir)  # change to 'stops' if you don't want to filter out small cities
+stop_times_df = read_gtfs('stop_times', gtfs_dir, categorical=True)
+transfers = read_gtfs('transfers', gtfs_dir)
+trips_df = read_gtfs('trips', gtfs_dir)
+
+# Compile the timetable once and group its trips into RAPTOR patterns
+timetable = Timetable.from_stop_times(stop_times_df)
+raptor = Raptor.from_timetable(timetable, trips_df, transfers)
+
+# Active days of every service, and the service of every timetable trip
+service_calendar = ServiceCalendar.from_feed(calendar, calendar_dates, feed_info)
+trip_services = service_calendar.service_codes(
+    trips_df.set_index('trip_id')['service_id'].reindex(timetable.trip_ids))
+
+# Word index over the stop names, resolves a city to its stops without scanning the stop table
+stop_name_index = StopNameIndex(stops_df['stop_id'], stops_df['stop_name'])
+
+# Stop to city mapping from remove_multiple_stops_from_cities.py, None when it hasn't been run
+stop_clusters = load_stop_clusters(gtfs_dir)
 
+def get_time_interval(interval):
+    # An interval name or a custom (start, end) window in seconds
+    if isinstance(interval, tuple):
+        return interval
+    return time_intervals.get(interval, (0, 24 * 3600))
 
-def normalize_time(t):
-    if pd.isna(t):
-        return t
-    h, m, s = map(int, t.split(':'))
-    return pd.Timedelta(hours=h % 24, minutes=m, seconds=s) + pd.Timedelta(days=h // 24)
 
+def get_raptor(travel_date=None):
+    # Without a date every trip of the feed period is used, as if they all ran on the same day
+    if travel_date is None:
+        return raptor
+    return raptor.restricted_to(service_calendar.is_active(trip_services, travel_date))
 
-# Normalize arrival_time and departure_time
-stop_times_df['arrival_time'] = stop_times_df['arrival_time'].apply(normalize_time)
-stop_times_df['departure_time'] = stop_times_df['departure_time'].apply(normalize_time)
 
-# Merge stop_times with stops to get stop information
-stop_times_df = stop_times_df.merge(stops_df, on='stop_id', how='left')
+def get_city_stop_ids(city_name):
+    # Every stop of the matching cities, not only the primary stops kept in the filtered stop list
+    return cluster_members(stop_name_index.lookup(city_name), stop_clusters)
 
 
-def get_time_interval(interval):
-    intervals = {
-        'early_morning': (pd.Timedelta(hours=0), pd.Timedelta(hours=6)),
-        'morning': (pd.Timedelta(hours=6), pd.Timedelta(hours=10)),
-        'midday': (pd.Timedelta(hours=10), pd.Timedelta(hours=14)),
-        'afternoon': (pd.Timedelta(hours=14), pd.Timedelta(hours=18)),
-        'late_afternoon': (pd.Timedelta(hours=18), pd.Timedelta(hours=21)),
-        'night': (pd.Timedelta(hours=21), pd.Timedelta(hours=24))
-    }
-    return intervals.get(interval, (pd.Timedelta(hours=0), pd.Timedelta(hours=24)))
-
-
-def find_reachable_destinations(city_name, time_limit, max_transfers, time_interval=None):
+@lru_cache(maxsize=32)
+def get_profiles(city_name, time_limit, max_transfers, travel_date=None, window=(0, 24 * 3600)):
+    """Pareto journeys from the city leaving inside window, computed once per query and reused for any departure."""
+    return get_raptor(travel_date).reachable_profiles(get_city_stop_ids(city_name), max_transfers, window, time_limit)
+
+
+def find_reachable_destinations(city_name, time_limit, max_transfers, time_interval=None, travel_date=None,
+                                departure_time=None, by_city=False):
     print("Starting process to find reachable destinations...")
 
     # Identify stop ID(s) for the specified city
-    city_stops = stops_df[stops_df['stop_name'].str.contains(city_name, case=False, na=False, regex=False)]
-    city_stop_ids = city_stops['stop_id'].tolist()
+    city_stop_ids = get_city_stop_ids(city_name)
     print(f"City stops for {city_name}: {city_stop_ids}")
 
-    # Initialize data structures
-    priority_queue = [(pd.Timedelta(0), 0, stop_id, None) for stop_id in city_stop_ids]
-    travel_times = defaultdict(lambda: pd.Timedelta.max)
-    transfer_counts = defaultdict(lambda: float('inf'))
-    explored_routes = defaultdict(set)
-    all_reachable_stops = pd.DataFrame(
-        columns=['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'travel_time', 'transfer_count'])
-
-    for stop_id in city_stop_ids:
-        travel_times[(stop_id, 0)] = pd.Timedelta(0)
-        transfer_counts[(stop_id, 0)] = 0
-
-    trips_found = False
-
-    while priority_queue:
-        current_time, transfers, current_stop, prev_trip_id = heappop(priority_queue)
-
-        if transfers > max_transfers or current_time > time_limit:
-            continue
-
-        next_trips = stop_times_df[stop_times_df['stop_id'] == current_stop]['trip_id'].unique()
-
-        for trip_id in tqdm(next_trips, desc="Processing trips"):
-            if trip_id in explored_routes[prev_trip_id]:
-                continue
-            explored_routes[prev_trip_id].add(trip_id)
-
-            trip_stop_times = stop_times_df[stop_times_df['trip_id'] == trip_id].sort_values(
-                'stop_sequence').reset_index(drop=True)
-            start_index = trip_stop_times[trip_stop_times['stop_id'] == current_stop].index[0]
-
-            cumulative_travel_time = current_time
-
-            for i in range(start_index + 1, len(trip_stop_times)):
-                prev_stop = trip_stop_times.iloc[i - 1]
-                next_stop = trip_stop_times.iloc[i]
-                travel_time = next_stop['arrival_time'] - prev_stop['departure_time']
-                cumulative_travel_time += travel_time
-
-                if prev_trip_id is not None and trip_id != prev_trip_id:
-                    # Add waiting time for transfer
-                    waiting_time = next_stop['departure_time'] - prev_stop['arrival_time']
-                    cumulative_travel_time += waiting_time
-
-                if cumulative_travel_time > time_limit:
-                    break
-
-                next_stop_id = next_stop['stop_id']
-                next_transfers = transfers if trip_id == prev_trip_id else transfers + 1
-
-                # Filter trips by desired time interval
-                if time_interval is not None:
-                    interval_start, interval_end = get_time_interval(time_interval)
-                    if not (interval_start <= prev_stop['departure_time'] < interval_end):
-                        continue
-
-                trips_found = True
-
-                if next_stop_id in city_stop_ids:
-                    continue  # Skip adding the starting city's stops
-
-                if (next_stop_id, next_transfers) not in travel_times or cumulative_travel_time < travel_times[
-                    (next_stop_id, next_transfers)]:
-                    travel_times[(next_stop_id, next_transfers)] = cumulative_travel_time
-                    transfer_counts[(next_stop_id, next_transfers)] = next_transfers
-                    heappush(priority_queue, (cumulative_travel_time, next_transfers, next_stop_id, trip_id))
-
-                    if next_stop_id not in all_reachable_stops['stop_id'].values:
-                        if not np.isnan(next_stop['stop_lat']):
-                            all_reachable_stops = pd.concat([all_reachable_stops, pd.DataFrame({
-                                'stop_id': [next_stop_id],
-                                'stop_name': [next_stop['stop_name']],
-                                'stop_lat': [next_stop['stop_lat']],
-                                'stop_lon': [next_stop['stop_lon']],
-                                'travel_time': [cumulative_travel_time],
-                                'transfer_count': [next_transfers - 1]
-                            })])
-
-    if not trips_found:
+    # Leaving at departure_time (a Timedelta), or the shortest journey leaving inside the time interval
+    if departure_time is not None:
+        profiles = get_profiles(city_name, time_limit, max_transfers, travel_date)
+        reachable = departing_at(profiles, departure_time)
+        reachable = reachable[reachable['travel_time'] <= time_limit]
+    else:
+        # Searched over the window itself, a whole-day profile drops journeys beaten by one leaving after it
+        start, end = get_time_interval(time_interval)
+        profiles = get_profiles(city_name, time_limit, max_transfers, travel_date, (start, end))
+        reachable = departing_between(profiles, pd.Timedelta(seconds=start), pd.Timedelta(seconds=end))
+
+    if reachable.empty:
         print("No trips found for the specified time interval.")
     else:
         print("Finished processing all stops.")
 
+    # Skip the starting city's stops and stops without coordinates
+    all_reachable_stops = reachable[~reachable['stop_id'].isin(city_stop_ids)].merge(stops_df, on='stop_id')
+    all_reachable_stops = all_reachable_stops.dropna(subset=['stop_lat'])[
+        ['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'travel_time', 'transfer_count']].reset_index(drop=True)
+
+    # Only the fastest stop of every destination city
+    if by_city:
+        city = cluster_ids(all_reachable_stops['stop_id'], stop_clusters)
+        all_reachable_stops = all_reachable_stops.assign(city=city).sort_values(['travel_time', 'transfer_count'])
+        all_reachable_stops = all_reachable_stops.drop_duplicates(subset=['city']).drop(columns='city')
+        all_reachable_stops = all_reachable_stops.sort_index().reset_index(drop=True)
+
     print(all_reachable_stops)
     return all_reachable_stops
 
@@ -142,14 +110,16 @@ def find_reachable_destinations(city_name, time_limit, max_transfers, time_inter
 city_name = "Budapest"
 max_transfers = 3
 time_limit = pd.Timedelta(hours=8)
-time_interval = None
-reachable_stops_info = find_reachable_destinations(city_name, time_limit, max_transfers, time_interval)
+time_interval = None  # an interval name, a (start, end) window in seconds, or None for the whole day
+travel_date = None  # e.g. pd.Timestamp('2024-07-15') to only use services running on that day
+departure_time = None  # e.g. pd.Timedelta(hours=7, minutes=40) to leave at a given time instead
+reachable_stops_info = find_reachable_destinations(city_name, time_limit, max_transfers, time_interval, travel_date,
+                                                   departure_time)
 
 
 def visualize_reachable_destinations(city_name, reachable_stops_info):
     # Get coordinates for the specified city
-    city_coords = stops_df[stops_df['stop_name'].str.contains(city_name, case=False, na=False, regex=False)][
-        ['stop_lat', 'stop_lon']].values[0].tolist()
+    city_coords = stops_df.iloc[stop_name_index.lookup_rows(city_name)[0]][['stop_lat', 'stop_lon']].tolist()
 
     # Create a map centered around the specified city
     map_city = folium.Map(location=city_coords, zoom_start=6)
@@ -164,7 +134,7 @@ def visualize_reachable_destinations(city_name, reachable_stops_info):
             popup_info = f"{row['transfer_count']} Transfers: {row['stop_name']}<br>Travel Time: {row['travel_time']}"
             folium.Marker(location=stop_coords, popup=popup_info, icon=folium.Icon(color='blue')).add_to(map_city)
 
-    map_path = f'all_reachable_from_{city_name.lower()}_map.html'
+    map_path = os.path.join(base_dir, f'all_reachable_from_{city_name.lower()}_map.html')
     map_city.save(map_path)
 
     return map_city